@@ -1,6 +1,41 @@
 """pybloom
 
+Modules that need NumPy or a compiled extension are only imported when
+one of their classes is first used (eagerly before Python 3.7).
 """
-from pybloom import BloomFilter, ScalableBloomFilter, __version__, __author__
-from cdbf import CountdownBloomFilter, ScalableCountdownBloomFilter
-from hashfilter import HashFilter
+import sys
+
+from .pybloom import BloomFilter, ScalableBloomFilter, HashCache, __version__, __author__
+from .hyperloglog import HyperLogLog
+from .storage import BitStorage, BitarrayStorage
+
+_LAZY = {
+    'CountdownBloomFilter': 'cdbf',
+    'ScalableCountdownBloomFilter': 'cdbf',
+    'HashFilter': 'hashfilter',
+    'BloomFilterBank': 'bank',
+    'NumpyStorage': 'npstorage',
+    'MmapStorage': 'npstorage',
+    'SharedMemoryStorage': 'npstorage',
+    'MemoryBudget': 'budget',
+    'DurableScalableBloomFilter': 'wal',
+}
+
+if sys.version_info < (3, 7):
+    from .cdbf import CountdownBloomFilter, ScalableCountdownBloomFilter
+    from .hashfilter import HashFilter
+    from .bank import BloomFilterBank
+    from .npstorage import NumpyStorage, MmapStorage, SharedMemoryStorage
+    from .budget import MemoryBudget
+    from .wal import DurableScalableBloomFilter
+else:
+    def __getattr__(name):
+        if name not in _LAZY:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+        import importlib
+        value = getattr(importlib.import_module('.' + _LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY))
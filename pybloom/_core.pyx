@@ -0,0 +1,132 @@
+'''
+Cython accelerator for BloomFilter hashing and probing
+
+Optional: pybloom falls back to pure Python when it is not built. Bits
+are addressed in little-endian bitarray buffers, bit i being bit (i & 7)
+of byte (i >> 3).
+'''
+
+import cython
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t
+from libc.string cimport memcpy
+from cpython.array cimport array, clone
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+cdef array _uint8_template = array('B')
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline uint64_t _read_index(const uint8_t[::1] digests, Py_ssize_t i, int chunk_size) nogil:
+    cdef uint16_t v16
+    cdef uint32_t v32
+    cdef uint64_t v64
+    if chunk_size == 2:
+        memcpy(&v16, &digests[i * 2], 2)
+        return v16
+    if chunk_size == 4:
+        memcpy(&v32, &digests[i * 4], 4)
+        return v32
+    memcpy(&v64, &digests[i * 8], 8)
+    return v64
+
+
+def indexes(const uint8_t[::1] digests, int chunk_size, int num_slices, uint64_t num_bits):
+    '''
+    Read `num_slices' native unsigned integers of `chunk_size' bytes from
+    the concatenated `digests' and return them modulo `num_bits', as
+    make_hashfuncs does with struct.unpack
+    '''
+    if digests.shape[0] < num_slices * chunk_size:
+        raise ValueError("Digests too short for %d slices" % num_slices)
+    cdef Py_ssize_t i
+    return [_read_index(digests, i, chunk_size) % num_bits for i in range(num_slices)]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint _test(uint8_t[::1] bits, uint64_t position) nogil:
+    return (bits[position >> 3] >> (position & 7)) & 1
+
+
+def contains(uint8_t[::1] bits, hashes, uint64_t bits_per_slice):
+    '''
+    True if every bit of `hashes', one index per slice, is set
+    '''
+    cdef uint64_t offset = 0
+    cdef uint64_t k
+    for k in hashes:
+        if k >= bits_per_slice or offset + k >= <uint64_t>bits.shape[0] * 8:
+            raise ValueError("Hash out of range")
+        if not _test(bits, offset + k):
+            return False
+        offset += bits_per_slice
+    return True
+
+
+def add(uint8_t[::1] bits, hashes, uint64_t bits_per_slice):
+    '''
+    Set the bits of `hashes'. Returns True if they were all set already.
+    '''
+    cdef uint64_t offset = 0
+    cdef uint64_t k, position
+    cdef bint existing = True
+    for k in hashes:
+        position = offset + k
+        if k >= bits_per_slice or position >= <uint64_t>bits.shape[0] * 8:
+            raise ValueError("Hash out of range")
+        if not _test(bits, position):
+            existing = False
+            bits[position >> 3] |= 1 << (position & 7)
+        offset += bits_per_slice
+    return existing
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _contains_batch(uint8_t[::1] bits, uint64_t *positions, Py_ssize_t num_keys,
+                          int num_slices, uint64_t bits_per_slice, uint8_t[::1] out) noexcept nogil:
+    cdef Py_ssize_t i, j
+    cdef uint64_t offset
+    for i in range(num_keys):
+        out[i] = 1
+        offset = 0
+        for j in range(num_slices):
+            if not _test(bits, offset + positions[i * num_slices + j]):
+                out[i] = 0
+                break
+            offset += bits_per_slice
+
+
+def contains_batch(uint8_t[::1] bits, hashes, int num_slices, uint64_t bits_per_slice):
+    '''
+    Probe a batch of keys, given the list of their hashes. The indexes
+    are copied to a C array and probed without holding the GIL. Returns
+    an array('B') of 0/1 results.
+    '''
+    cdef Py_ssize_t num_keys = len(hashes)
+    cdef Py_ssize_t i, j
+    cdef array out = clone(_uint8_template, num_keys, False)
+    cdef uint8_t[::1] results = out
+    cdef uint64_t *positions
+    if not num_keys:
+        return out
+    positions = <uint64_t *>PyMem_Malloc(num_keys * num_slices * sizeof(uint64_t))
+    if positions == NULL:
+        raise MemoryError()
+    try:
+        for i in range(num_keys):
+            key_hashes = hashes[i]
+            if len(key_hashes) != num_slices:
+                raise ValueError("Expected %d hashes per key" % num_slices)
+            for j in range(num_slices):
+                positions[i * num_slices + j] = key_hashes[j]
+                if positions[i * num_slices + j] >= bits_per_slice:
+                    raise ValueError("Hash out of range")
+        if <uint64_t>num_slices * bits_per_slice > <uint64_t>bits.shape[0] * 8:
+            raise ValueError("Bits too short for %d slices" % num_slices)
+        with nogil:
+            _contains_batch(bits, positions, num_keys, num_slices, bits_per_slice, results)
+    finally:
+        PyMem_Free(positions)
+    return out
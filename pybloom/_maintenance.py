@@ -0,0 +1,56 @@
+'''
+Vectorized NumPy version of the maintenance module, used when the Cython
+extension is not built
+'''
+import numpy as np
+
+
+def maintenance_chunk(cells, cells_size, num_iterations, head, start, stop, counter_bits=8):
+    '''
+    Apply the effect of `num_iterations' maintenance steps starting at
+    `head' to the cells in [start, stop) only. `start' must be aligned on
+    a byte of the cellarray.
+
+    Returns the number of cells that were decremented to zero.
+    '''
+    passes, remainder = divmod(num_iterations, cells_size)
+    per_byte = 8 // counter_bits
+    first = start // per_byte
+    last = -(-stop // per_byte)
+    base = first * per_byte
+    amount = np.zeros((last - first) * per_byte, dtype=np.int64)
+    amount[start - base:stop - base] = passes
+    # Cells in [head, head + remainder), wrapping around, are visited
+    # once more than the others.
+    end = head + remainder
+    for lo, hi in ((head, min(end, cells_size)), (0, end - cells_size)):
+        lo, hi = max(lo, start), min(hi, stop)
+        if lo < hi:
+            amount[lo - base:hi - base] += 1
+
+    if counter_bits == 8:
+        values = cells[first:last].astype(np.int64)
+    else:
+        shifts = np.arange(0, 8, counter_bits, dtype=np.uint8)
+        values = ((cells[first:last, np.newaxis] >> shifts) & ((1 << counter_bits) - 1))
+        values = values.reshape(-1).astype(np.int64)
+    active = (values != 0) & (amount > 0)
+    cleared = int((active & (values <= amount)).sum())
+    values = np.where(active, np.maximum(values - amount, 0), values)
+
+    if counter_bits == 8:
+        cells[first:last] = values
+    else:
+        cells[first:last] = (values.reshape(-1, per_byte) << shifts.astype(np.int64)).sum(axis=1)
+    return cleared
+
+
+def maintenance(cells, cells_size, num_iterations, head, counter_bits=8):
+    '''
+    Maintenance process for the Countdown Bloom Filter
+
+    Returns the new head and the number of cells that were decremented
+    to zero.
+    '''
+    cleared = maintenance_chunk(cells, cells_size, num_iterations, head, 0, cells_size, counter_bits)
+    return (head + num_iterations) % cells_size, cleared
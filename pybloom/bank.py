@@ -0,0 +1,162 @@
+import math
+import numpy as np
+
+from struct import unpack, pack, calcsize
+from .pybloom import make_hashfuncs
+
+
+def _unpack_ids(row, num_filters):
+    '''
+    Ids of the bits set in the packed `row', lowest id in the lowest bit
+    '''
+    bits = np.unpackbits(row.reshape(-1, 1), axis=1)[:, ::-1].ravel()
+    return bits[:num_filters].nonzero()[0]
+
+
+class BloomFilterBank(object):
+    '''
+    Bit-sliced index of many BloomFilters sharing the same geometry
+
+    Filters are stored transposed, BitFunnel style: one row per bit
+    position, holding that bit of every filter. Querying a key hashes it
+    once and ANDs its num_slices rows, giving the ids of the filters that
+    contain it.
+
+    >>> from pybloom import BloomFilter
+    >>> bank = BloomFilterBank(capacity=1000, error_rate=0.001)
+    >>> a = BloomFilter(capacity=1000, error_rate=0.001)
+    >>> _ = a.add('hello')
+    >>> bank.add_filter(a), bank.add_filter()
+    (0, 1)
+    >>> _ = bank.add(1, 'world')
+    >>> bank.lookup('hello').tolist(), bank.lookup('world').tolist()
+    ([0], [1])
+    '''
+    FILE_FMT = '<dQQQQ'
+
+    def __init__(self, capacity, error_rate=0.001, hash_cache=None):
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        num_slices = int(math.ceil(math.log(1.0 / error_rate, 2)))
+        bits_per_slice = int(math.ceil(
+            (capacity * abs(math.log(error_rate))) /
+            (num_slices * (math.log(2) ** 2))))
+        self.hash_cache = hash_cache
+        self._setup(error_rate, num_slices, bits_per_slice, capacity, 0)
+        self.rows = np.zeros((self.num_bits, 1), dtype=np.uint8)
+
+    def _setup(self, error_rate, num_slices, bits_per_slice, capacity, num_filters):
+        self.error_rate = error_rate
+        self.num_slices = num_slices
+        self.bits_per_slice = bits_per_slice
+        self.capacity = capacity
+        self.num_bits = num_slices * bits_per_slice
+        self.num_filters = num_filters
+        self.offsets = np.arange(num_slices) * bits_per_slice
+        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice,
+                                          self.hash_cache)
+
+    def __len__(self):
+        return self.num_filters
+
+    def _grow(self):
+        '''
+        Double the number of filter columns of the rows
+        '''
+        rows = np.zeros((self.num_bits, self.rows.shape[1] * 2), dtype=np.uint8)
+        rows[:, :self.rows.shape[1]] = self.rows
+        self.rows = rows
+
+    def add_filter(self, filter=None):
+        '''
+        Append `filter' (a BloomFilter with the geometry of this bank), or
+        an empty filter. Returns the id of the new filter.
+        '''
+        if filter is not None and (filter.num_slices != self.num_slices or
+                                   filter.bits_per_slice != self.bits_per_slice):
+            raise ValueError("Filters of a bank must have the same capacity \
+and error rate")
+        filter_id = self.num_filters
+        if filter_id >= self.rows.shape[1] * 8:
+            self._grow()
+        if filter is not None:
+            bits = np.frombuffer(filter.storage.tobytes(), dtype=np.uint8)
+            bits = np.unpackbits(bits.reshape(-1, 1), axis=1)[:, ::-1].ravel()
+            set_bits = bits[:self.num_bits].nonzero()[0]
+            self.rows[set_bits, filter_id >> 3] |= 1 << (filter_id & 7)
+        self.num_filters += 1
+        return filter_id
+
+    def add(self, filter_id, key):
+        '''
+        Add `key' to the filter `filter_id'. Returns True if the filter
+        already contained it.
+        '''
+        if not 0 <= filter_id < self.num_filters:
+            raise IndexError("No filter %d in this bank" % filter_id)
+        positions = np.asarray(self.make_hashes(key)) + self.offsets
+        bit = 1 << (filter_id & 7)
+        if (self.rows[positions, filter_id >> 3] & bit).all():
+            return True
+        self.rows[positions, filter_id >> 3] |= bit
+        return False
+
+    def lookup(self, key):
+        '''
+        Return the ids of the filters that contain `key'
+        '''
+        rows = self.rows[np.asarray(self.make_hashes(key)) + self.offsets]
+        return _unpack_ids(np.bitwise_and.reduce(rows, axis=0), self.num_filters)
+
+    def lookup_many(self, keys):
+        '''
+        Batch version of lookup(). Returns one array of filter ids per key.
+        '''
+        if not keys:
+            return []
+        positions = np.array([self.make_hashes(key) for key in keys]) + self.offsets
+        matches = np.bitwise_and.reduce(self.rows[positions], axis=1)
+        return [_unpack_ids(row, self.num_filters) for row in matches]
+
+    def __contains__(self, key):
+        '''
+        True if any filter of the bank contains `key'
+        '''
+        rows = self.rows[np.asarray(self.make_hashes(key)) + self.offsets]
+        return bool(np.bitwise_and.reduce(rows, axis=0).any())
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes
+
+    def tofile(self, f):
+        '''
+        Write the bank to file object `f': a header followed by the rows,
+        ceil(num_filters / 8) bytes each
+        '''
+        f.write(pack(self.FILE_FMT, self.error_rate, self.num_slices,
+                     self.bits_per_slice, self.capacity, self.num_filters))
+        row_bytes = max((self.num_filters + 7) // 8, 1)
+        f.write(np.ascontiguousarray(self.rows[:, :row_bytes]).tobytes())
+
+    @classmethod
+    def fromfile(cls, f, mmap=False):
+        '''
+        Read a bank serialized with tofile() from file object `f'. With
+        mmap the rows are mapped read-only from the file instead of read
+        in memory; filters can then be queried but not added to.
+        '''
+        bank = cls(1)  # Bogus instantiation, we will `_setup'.
+        bank._setup(*unpack(cls.FILE_FMT, f.read(calcsize(cls.FILE_FMT))))
+        shape = (bank.num_bits, max((bank.num_filters + 7) // 8, 1))
+        if mmap:
+            bank.rows = np.memmap(f.name, dtype=np.uint8, mode='r',
+                                  offset=f.tell(), shape=shape)
+        else:
+            data = f.read(shape[0] * shape[1])
+            if len(data) != shape[0] * shape[1]:
+                raise ValueError('Bit length mismatch!')
+            bank.rows = np.frombuffer(data, dtype=np.uint8).reshape(shape).copy()
+        return bank
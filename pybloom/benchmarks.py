@@ -1,47 +1,72 @@
 #!/usr/bin/env python
 #
 """Test performance of BloomFilter at a set capacity and error rate."""
+from __future__ import print_function
 import sys
 from pybloom import BloomFilter
-import bitarray, math, time
+import bitarray, math, time, subprocess
+
+IMPORT_STATEMENT = "import pybloom; pybloom.BloomFilter(capacity=1000)"
+
+def import_time(runs=10):
+    """Time `import pybloom' and a first BloomFilter in fresh interpreters,
+    which must not pull in NumPy."""
+    check = IMPORT_STATEMENT + "; import sys; sys.exit('numpy' in sys.modules)"
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        heavy = subprocess.call([sys.executable, "-c", check])
+        times.append(time.time() - start)
+    baseline = min(interpreter_startup() for _ in range(runs))
+    print("{:5.3f} seconds for '{}' (best of {}, interpreter start-up excluded)".format(
+            min(times) - baseline, IMPORT_STATEMENT, runs))
+    if heavy:
+        print("Warning: NumPy imported by '{}'".format(IMPORT_STATEMENT))
+
+def interpreter_startup():
+    start = time.time()
+    subprocess.call([sys.executable, "-c", "pass"])
+    return time.time() - start
 
 def main(capacity=100000, request_error_rate=0.1):
     f = BloomFilter(capacity=capacity, error_rate=request_error_rate)
     assert (capacity == f.capacity)
     start = time.time()
-    for i in xrange(0, f.capacity):
+    for i in range(0, f.capacity):
         f.add(i, skip_check=True)
     end = time.time()
-    print "{:5.3f} seconds to add to capacity, {:10.2f} entries/second".format(
-            end - start, f.capacity / (end - start))
+    print("{:5.3f} seconds to add to capacity, {:10.2f} entries/second".format(
+            end - start, f.capacity / (end - start)))
     oneBits = f.bitarray.count(True)
     zeroBits = f.bitarray.count(False)
-    #print "Number of 1 bits:", oneBits
-    #print "Number of 0 bits:", zeroBits
-    print "Number of Filter Bits:", f.num_bits
-    print "Number of slices:", f.num_slices
-    print "Bits per slice:", f.bits_per_slice
-    print "------"
-    print "Fraction of 1 bits at capacity: {:5.3f}".format(
-            oneBits / float(f.num_bits))
+    #print("Number of 1 bits:", oneBits)
+    #print("Number of 0 bits:", zeroBits)
+    print("Number of Filter Bits:", f.num_bits)
+    print("Number of slices:", f.num_slices)
+    print("Bits per slice:", f.bits_per_slice)
+    print("------")
+    print("Fraction of 1 bits at capacity: {:5.3f}".format(
+            oneBits / float(f.num_bits)))
     # Look for false positives and measure the actual fp rate
     trials = f.capacity
     fp = 0
     start = time.time()
-    for i in xrange(f.capacity, f.capacity + trials + 1):
+    for i in range(f.capacity, f.capacity + trials + 1):
         if i in f:
             fp += 1
     end = time.time()
     print ("{:5.3f} seconds to check false positives, "
            "{:10.2f} checks/second".format(end - start, trials / (end - start)))
-    print "Requested FP rate: {:2.4f}".format(request_error_rate)
-    print "Experimental false positive rate: {:2.4f}".format(fp / float(trials))
+    print("Requested FP rate: {:2.4f}".format(request_error_rate))
+    print("Experimental false positive rate: {:2.4f}".format(fp / float(trials)))
     # Compute theoretical fp max (Goel/Gupta)
     k = f.num_slices
     m = f.num_bits
     n = f.capacity
     fp_theory = math.pow((1 - math.exp(-k * (n + 0.5) / (m - 1))), k)
-    print "Projected FP rate (Goel/Gupta): {:2.6f}".format(fp_theory)
+    print("Projected FP rate (Goel/Gupta): {:2.6f}".format(fp_theory))
+    print("------")
+    import_time()
 
 if __name__ == '__main__' :
     status = main()
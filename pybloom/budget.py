@@ -0,0 +1,210 @@
+'''
+Process-wide memory budget shared by many filters
+
+>>> from pybloom import ScalableBloomFilter
+>>> budget = MemoryBudget(limit=4096)
+>>> sbf = budget.register(ScalableBloomFilter(initial_capacity=100), 'users')
+>>> for i in range(10000):
+...     _ = sbf.add(i)
+Traceback (most recent call last):
+...
+IndexError: Memory budget of 4096 bytes exceeded
+>>> budget.usage() <= 4096
+True
+>>> list(budget.report())
+['users']
+'''
+import itertools
+import sys
+import weakref
+
+from .pybloom import BloomFilter
+from .slidingwindow import SlidingWindowScalableBloomFilter
+
+REFUSE = 'refuse'
+SPILL = 'spill'
+EVICT = 'evict'
+POLICIES = (REFUSE, SPILL, EVICT)
+
+
+def memory_usage(filter):
+    '''
+    Bytes of process memory held by `filter': the bits or cells of its
+    filters and the lists holding them. Bits spilled to files and windows
+    not read yet by a lazy fromfile() are not counted.
+    '''
+    if isinstance(filter, BloomFilter):
+        return filter.storage.nbytes if filter.storage.in_memory else 0
+    if isinstance(filter, SlidingWindowScalableBloomFilter):
+        return sys.getsizeof(filter.ring) + sum(memory_usage(w) for w in filter.ring)
+    if getattr(filter, '_pending', None) is not None:
+        return 0
+    if hasattr(filter, 'cellarray'):
+        return filter.cellarray.nbytes
+    return sys.getsizeof(filter.filters) + sum(memory_usage(f) for f in filter.filters)
+
+
+def _bloom_filters(filter):
+    '''
+    The BloomFilters holding the bits of `filter', already read
+    '''
+    if isinstance(filter, BloomFilter):
+        yield filter
+    elif isinstance(filter, SlidingWindowScalableBloomFilter):
+        for window in filter.ring:
+            for f in _bloom_filters(window):
+                yield f
+    elif getattr(filter, '_pending', None) is None and not hasattr(filter, 'cellarray'):
+        for child in filter.filters:
+            for f in _bloom_filters(child):
+                yield f
+
+
+class MemoryBudget(object):
+    '''
+    Ceiling of `limit' bytes on the memory held by the filters registered
+    with it.
+
+    Scalable filters (ScalableBloomFilter, ScalableCountdownBloomFilter
+    and the windows of a SlidingWindowScalableBloomFilter) reserve the
+    bytes of each sub-filter before allocating it. When the budget would
+    be exceeded, `policy' frees memory:
+
+    REFUSE
+        nothing: the growth is refused
+    SPILL
+        the bits of the coldest filters, those least recently grown or
+        touched, are moved to memory-mapped files in `directory'
+    EVICT
+        the oldest windows of the registered sliding window filters are
+        dropped, expiring their keys early
+
+    Whatever the policy, the filters kept by the ring slots of expired
+    windows are released first. Countdown filters keep their cells in
+    memory: SPILL frees nothing from them.
+
+    The add that needs the sub-filter raises IndexError, as a full
+    BloomFilter does, when not enough memory could be freed.
+    '''
+    def __init__(self, limit, policy=REFUSE, directory=None):
+        if policy not in POLICIES:
+            raise ValueError("Policy must be one of %s" % (POLICIES,))
+        if policy == SPILL and directory is None:
+            raise ValueError("The spill policy requires a directory")
+        self.limit = limit
+        self.policy = policy
+        self.directory = directory
+        # Registered filter -> [name, last use]
+        self._filters = weakref.WeakKeyDictionary()
+        # Window -> its sliding window filter
+        self._owners = weakref.WeakKeyDictionary()
+        self._clock = itertools.count()
+        self._ids = itertools.count()
+
+    def register(self, filter, name=None):
+        '''
+        Account for `filter' under `name' and return it
+        '''
+        if name is None:
+            name = '%s-%d' % (type(filter).__name__, next(self._ids))
+        self._filters[filter] = [name, next(self._clock)]
+        filter.budget = self
+        if isinstance(filter, SlidingWindowScalableBloomFilter):
+            for window in filter.ring:
+                window.budget = self
+                self._owners[window] = filter
+        return filter
+
+    def unregister(self, filter):
+        del self._filters[filter]
+        filter.budget = None
+        if isinstance(filter, SlidingWindowScalableBloomFilter):
+            for window in filter.ring:
+                window.budget = None
+                self._owners.pop(window, None)
+
+    def __len__(self):
+        return len(self._filters)
+
+    def __contains__(self, filter):
+        return filter in self._filters
+
+    def touch(self, filter):
+        '''
+        Mark `filter' as recently used, the last one to be spilled
+        '''
+        self._filters[self._owners.get(filter, filter)][1] = next(self._clock)
+
+    def usage(self, filter=None):
+        '''
+        Bytes held by `filter', or by every registered filter
+        '''
+        if filter is not None:
+            return memory_usage(filter)
+        return sum(memory_usage(f) for f in list(self._filters.keys()))
+
+    def report(self):
+        '''
+        Bytes held by each registered filter, by name
+        '''
+        return dict((name, memory_usage(f))
+                    for f, (name, _) in list(self._filters.items()))
+
+    def reserve(self, filter, nbytes):
+        '''
+        Make room for `filter' to allocate `nbytes', applying the policy.
+        Raises IndexError when the budget would be exceeded.
+        '''
+        owner = self._owners.get(filter, filter)
+        if owner in self._filters:
+            self.touch(owner)
+        while self.usage() + nbytes > self.limit:
+            if not self._free(filter):
+                raise IndexError("Memory budget of %d bytes exceeded" % self.limit)
+
+    def _free(self, requester):
+        '''
+        Release memory according to the policy, never from the window
+        `requester' is growing. Returns the bytes freed.
+        '''
+        freed = 0
+        for owner in list(self._filters.keys()):
+            if isinstance(owner, SlidingWindowScalableBloomFilter):
+                before = memory_usage(owner)
+                owner.release_expired()
+                freed += before - memory_usage(owner)
+        if freed:
+            return freed
+        if self.policy == SPILL:
+            for filter, _ in sorted(self._filters.items(), key=lambda item: item[1][1]):
+                freed = self.spill(filter)
+                if freed:
+                    return freed
+        elif self.policy == EVICT:
+            windows = [(window.timestamp, owner)
+                       for owner in list(self._filters.keys())
+                       if isinstance(owner, SlidingWindowScalableBloomFilter)
+                       for window in owner.filters[:1] if window is not requester]
+            for _, owner in sorted(windows, key=lambda window: window[0]):
+                before = memory_usage(owner)
+                owner.evict_oldest()
+                freed = before - memory_usage(owner)
+                if freed:
+                    return freed
+        return 0
+
+    def spill(self, filter):
+        '''
+        Move the bits of `filter' held in memory to memory-mapped files.
+        Returns the bytes freed.
+        '''
+        from .npstorage import MmapStorage
+        factory = MmapStorage.in_directory(self.directory)
+        freed = 0
+        for f in _bloom_filters(filter):
+            if f.storage.in_memory:
+                storage = factory(f.num_bits)
+                storage.load(f.storage.tobytes())
+                freed += f.storage.nbytes
+                f.storage = storage
+        return freed
@@ -1,13 +1,21 @@
 import math
 import hashlib
+import heapq
 import numpy as np
 
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
+
 from math import floor
 from struct import unpack, pack, calcsize
-from pybloom import BloomFilter, ScalableBloomFilter, make_hashfuncs
-from maintenance import maintenance
+from .pybloom import BloomFilter, ScalableBloomFilter, make_hashfuncs
+from .events import Observable, FILTER_ADDED, CAPACITY_REACHED, MAINTENANCE
+try:
+    from .maintenance import maintenance_chunk
+except ImportError:
+    from ._maintenance import maintenance_chunk
 
-class CountdownBloomFilter(object):
+class CountdownBloomFilter(Observable):
     '''
     Implementation of a Modified Countdown Bloom Filter. Uses a batched maintenance process instead of a continuous one.
 
@@ -15,61 +23,124 @@ class CountdownBloomFilter(object):
     Communications (ICC), 2012 IEEE International Conference on. IEEE, 2012.
 
     http://www-mobile.ecs.soton.ac.uk/home/conference/ICC2012/symposia/papers/a_lightweight_algorithm_for_traffic_filtering_over_sliding__.pdf
+
+    counter_bits sets the width of each cell (2, 4 or 8 bits). Narrower
+    counters are packed several per byte of the cellarray.
+
+    hash_cache is an optional HashCache memoizing the hashes of hot keys.
     '''
-    def __init__(self, capacity, error_rate=0.001, expiration=60, disable_hard_capacity=False):
+    COUNTER_BITS = (2, 4, 8)
+    # Smallest number of cells handed to a thread by parallel maintenance
+    MAINTENANCE_CHUNK = 1 << 18
+
+    def __init__(self, capacity, error_rate=0.001, expiration=60, disable_hard_capacity=False, counter_bits=8, hash_cache=None):
         self.expiration = expiration
         if not (0 < error_rate < 1):
             raise ValueError("Error_Rate must be between 0 and 1.")
         if not capacity > 0:
             raise ValueError("Capacity must be > 0")
+        if counter_bits not in self.COUNTER_BITS:
+            raise ValueError("Counter_Bits must be one of %s" % (self.COUNTER_BITS,))
         num_slices = int(math.ceil(math.log(1.0 / error_rate, 2)))
         bits_per_slice = int(math.ceil(
             (capacity * abs(math.log(error_rate))) /
             (num_slices * (math.log(2) ** 2))))
-        self._setup(error_rate, num_slices, bits_per_slice, capacity, 0)
-        self.cellarray = np.zeros(self.num_bits).astype(np.uint8)
-        self.counter_init = 255
+        self.hash_cache = hash_cache
+        self._setup(error_rate, num_slices, bits_per_slice, capacity)
+        self.counter_bits = counter_bits
+        self.counters_per_byte = 8 // counter_bits
+        self.counter_mask = (1 << counter_bits) - 1
+        num_bytes = int(math.ceil(self.num_bits / float(self.counters_per_byte)))
+        self.cellarray = np.zeros(num_bytes).astype(np.uint8)
+        self.counter_init = self.counter_mask
         self.refresh_head = 0
         # This is the unset ratio ... and we keep it constant at 0.5
         # since the BF will operate most of the time at his optimal
         # set ratio (50 %) and the overall effect of this parameter
         # on the refresh rate is very minimal anyway.
         self.z = 0.5
-        self.estimate_z = 0
+        # Exact number of nonzero cells, kept up to date by add() and by
+        # the maintenance process.
+        self.occupied = 0
         self.disable_hard_capacity = disable_hard_capacity
 
-    def _setup(self, error_rate, num_slices, bits_per_slice, capacity, count):
+    def _setup(self, error_rate, num_slices, bits_per_slice, capacity):
         self.error_rate = error_rate
         self.num_slices = num_slices
         self.bits_per_slice = bits_per_slice
         self.capacity = capacity
         self.num_bits = num_slices * bits_per_slice
-        self.count = count
-        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice)
+        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice,
+                                          self.hash_cache)
+
+    def _get_cell(self, index):
+        '''
+        Read the counter of cell `index'
+        '''
+        if self.counter_bits == 8:
+            return self.cellarray[index]
+        byte, slot = divmod(index, self.counters_per_byte)
+        return (self.cellarray[byte] >> (slot * self.counter_bits)) & self.counter_mask
+
+    def _set_cell(self, index, value):
+        '''
+        Write `value' into the counter of cell `index'
+        '''
+        if self.counter_bits == 8:
+            self.cellarray[index] = value
+            return
+        byte, slot = divmod(index, self.counters_per_byte)
+        shift = slot * self.counter_bits
+        cell = int(self.cellarray[byte]) & ~(self.counter_mask << shift)
+        self.cellarray[byte] = cell | (value << shift)
+
+    def cells(self):
+        '''
+        Return the counters unpacked, one uint8 per cell
+        '''
+        if self.counter_bits == 8:
+            return self.cellarray
+        shifts = np.arange(0, 8, self.counter_bits, dtype=np.uint8)
+        cells = (self.cellarray[:, np.newaxis] >> shifts) & self.counter_mask
+        return cells.ravel()[:self.num_bits]
 
     def _compute_z(self):
         '''
         Compute the unset ratio (exact)
         '''
-        return self.cellarray.nonzero()[0].shape[0] / self.num_bits
+        return float(self.occupied) / self.num_bits
+
+    @property
+    def estimate_z(self):
+        '''
+        The unset ratio, always current
+        '''
+        return self._compute_z()
+
+    @property
+    def count(self):
+        '''
+        Number of keys, estimated from the occupied cells
+        '''
+        z = min(self._compute_z(), 0.999999)
+        return int(-self.bits_per_slice * math.log(1 - z))
 
-    def _estimate_count(self):
+    def _full(self):
         '''
-        Update the count number using the estimation of the unset ratio
+        Whether the count or the occupied cells reached the capacity
         '''
-        if self.estimate_z == 0:
-            self.estimate_z = (1.0 / self.num_bits)
-        self.estimate_z = min(self.estimate_z, 0.999999)
-        #self.count = int(self.num_bits * (math.log(self.estimate_z) * math.log(1-self.estimate_z)) / (- math.log(self.error_rate)))
-        self.count = int(-(self.num_bits / self.num_slices) * math.log(1 - self.estimate_z))
+        return self.count > self.capacity or self.occupied > 0.5 * self.num_bits
 
     def expiration_maintenance(self):
         '''
         Decrement cell value if not zero
         This maintenance process need to executed each self.compute_refresh_time()
         '''
-        if self.cellarray[self.refresh_head] != 0:
-            self.cellarray[self.refresh_head] -= 1
+        value = self._get_cell(self.refresh_head)
+        if value != 0:
+            self._set_cell(self.refresh_head, value - 1)
+            if value == 1:
+                self.occupied -= 1
         self.refresh_head = (self.refresh_head + 1) % self.num_bits
 
     def batched_expiration_maintenance_dev(self, elapsed_time):
@@ -80,22 +151,64 @@ class CountdownBloomFilter(object):
         for i in range(num_iterations):
             self.expiration_maintenance()
 
-    def batched_expiration_maintenance(self, elapsed_time):
+    def _maintenance_chunks(self, num_iterations, num_chunks=1):
+        '''
+        Split a batch of maintenance steps into (num_iterations, start, stop)
+        chunks over disjoint, byte-aligned cell ranges
+        '''
+        step = self.num_bits
+        if num_chunks > 1:
+            step = max(self.MAINTENANCE_CHUNK, -(-self.num_bits // num_chunks))
+            step += -step % self.counters_per_byte
+        return [(num_iterations, start, min(start + step, self.num_bits))
+                for start in range(0, self.num_bits, step)]
+
+    def _run_maintenance_chunk(self, chunk):
+        '''
+        Run one chunk of _maintenance_chunks(), releasing the GIL.
+        Returns the number of cells decremented to zero.
+        '''
+        num_iterations, start, stop = chunk
+        return maintenance_chunk(self.cellarray, self.num_bits, num_iterations, self.refresh_head, start, stop, self.counter_bits)
+
+    def _finish_maintenance(self, num_iterations, cleared):
+        '''
+        Advance the refresh head and the occupied cells once every
+        chunk of a batch has been processed
+        '''
+        self.refresh_head = (self.refresh_head + num_iterations) % self.num_bits
+        self.occupied -= cleared
+        processed_interval = num_iterations * self.compute_refresh_time()
+        return processed_interval
+
+    def batched_expiration_maintenance(self, elapsed_time, pool=None, num_chunks=1):
         '''
         Batched version of expiration_maintenance()
         Cython version
+
+        With a thread pool (e.g. multiprocessing.pool.ThreadPool) the
+        cellarray is split in up to `num_chunks' ranges processed in
+        parallel.
         '''
+        start = default_timer()
         num_iterations = self.num_batched_maintenance(elapsed_time)
-        self.refresh_head, nonzero = maintenance(self.cellarray, self.num_bits, num_iterations, self.refresh_head)
-        if num_iterations != 0:
-            self.estimate_z = float(nonzero) / float(num_iterations)
-            self._estimate_count()
-        processed_interval = num_iterations * self.compute_refresh_time()
+        chunks = self._maintenance_chunks(num_iterations, num_chunks)
+        if pool is None:
+            cleared = sum(map(self._run_maintenance_chunk, chunks))
+        else:
+            cleared = sum(pool.map(self._run_maintenance_chunk, chunks))
+        processed_interval = self._finish_maintenance(num_iterations, cleared)
+        self._emit(MAINTENANCE, iterations=num_iterations,
+                   elapsed=default_timer() - start, cleared=cleared,
+                   nonzero=self.occupied)
         return processed_interval
 
     def compute_refresh_time(self):
         '''
         Compute the refresh period for the given expiration delay
+
+        A cell is only decremented once per sweep of the whole cellarray,
+        so narrower counters (smaller counter_init) get a longer period.
         '''
         if self.z == 0:
             self.z = 1E-10
@@ -112,7 +225,7 @@ class CountdownBloomFilter(object):
             hashes = key
         offset = 0
         for k in hashes:
-            if self.cellarray[offset + k] == 0:
+            if self._get_cell(offset + k) == 0:
                 return False
             offset += self.bits_per_slice
         return True
@@ -121,40 +234,77 @@ class CountdownBloomFilter(object):
         """Return the number of keys stored by this bloom filter."""
         return self.count
 
+    def _refresh(self, hashes):
+        '''
+        Reset the cells of `hashes' to counter_init, counting the cells
+        that become occupied
+        '''
+        offset = 0
+        for k in hashes:
+            if self._get_cell(offset + k) == 0:
+                self.occupied += 1
+            self._set_cell(offset + k, self.counter_init)
+            offset += self.bits_per_slice
+
     def add(self, key, skip_check=False):
-        hashes = self.make_hashes(key)
+        if not isinstance(key, list):
+            hashes = self.make_hashes(key)
+        else:
+            hashes = key
         if not skip_check and hashes in self:
-            offset = 0
-            for k in hashes:
-                self.cellarray[offset + k] = self.counter_init
-                offset += self.bits_per_slice
+            self._refresh(hashes)
             return True
-        if (self.count > self.capacity or self.estimate_z > 0.5) and not self.disable_hard_capacity:
+        if self._full() and not self.disable_hard_capacity:
+            self._emit(CAPACITY_REACHED, capacity=self.capacity, count=self.count)
             raise IndexError("BloomFilter is at capacity")
-        offset = 0
-        for k in hashes:
-            self.cellarray[offset + k] = self.counter_init
-            offset += self.bits_per_slice
-        self.count += 1
+        self._refresh(hashes)
         return False
 
 
-class ScalableCountdownBloomFilter(object):
+class ScalableCountdownBloomFilter(Observable):
     SMALL_SET_GROWTH = 2
     LARGE_SET_GROWTH = 4
     FILE_FMT = '<idQd'
+    # MemoryBudget this SCBF is registered with
+    budget = None
+    # Maintenance thread pool, created on first use
+    _pool = None
+    _transient = ('_listeners', 'budget', '_pool')
 
     def __init__(self, initial_capacity=100,
                        error_rate=0.001,
                        mode=SMALL_SET_GROWTH,
-                       expiration = 60):
+                       expiration = 60,
+                       counter_bits = 8,
+                       max_memory = None,
+                       threads = None,
+                       hash_cache = None):
+        '''
+        max_memory optionally caps the bytes used by the sub-filters'
+        cellarrays. Past it the SCBF compacts itself by dropping the
+        sub-filters holding the fewest keys, which expires them early.
+
+        threads runs batched_expiration_maintenance on a pool of that many
+        threads, splitting large sub-filters in chunks. close(), or using
+        the SCBF as a context manager, stops them.
+
+        hash_cache is an optional HashCache shared by every sub-filter.
+        '''
         if not error_rate or error_rate < 0:
             raise ValueError("Error_Rate must be a decimal less than 0.")
         self._setup(mode, 0.9, initial_capacity, error_rate)
         self.filters = []
         self.filters_count = 0
         self.expiration = expiration
+        self.counter_bits = counter_bits
+        self.max_memory = max_memory
+        self.threads = threads
+        self.hash_cache = hash_cache
+        self._pool = None
         self.pointer = 0
+        # Min-heap of the indexes of sub-filters (other than the current
+        # one) with spare capacity, rebuilt after each maintenance run.
+        self.available = []
 
     def _setup(self, mode, ratio, initial_capacity, error_rate):
         self.scale = mode
@@ -162,51 +312,137 @@ class ScalableCountdownBloomFilter(object):
         self.initial_capacity = initial_capacity
         self.error_rate = error_rate
 
+    def _locate(self, key):
+        '''
+        Find the sub-filter containing `key'. Returns its index (or None)
+        along with the hashes of `key' computed so far, one list per probed
+        level (None for levels that were not probed).
+        '''
+        hashes = [None] * len(self.filters)
+        for i in reversed(range(len(self.filters))):
+            hashes[i] = self.filters[i].make_hashes(key)
+            if hashes[i] in self.filters[i]:
+                return i, hashes
+        return None, hashes
+
     def __contains__(self, key):
-        for f in reversed(self.filters):
-            if key in f:
-                return True
-        return False
+        return self._locate(key)[0] is not None
+
+    def _cells_nbytes(self, capacity, error_rate):
+        '''
+        Bytes of the cellarray of a sub-filter of `capacity' and `error_rate'
+        '''
+        num_slices, bits_per_slice = BloomFilter.geometry(capacity, error_rate)
+        counters_per_byte = 8 // self.counter_bits
+        return -(-num_slices * bits_per_slice // counters_per_byte)
 
     def _add_filter(self):
         if self.filters:
-            filter = self.filters[-1]
-            filter = CountdownBloomFilter(capacity=filter.capacity * self.scale,
-                                  error_rate=filter.error_rate * self.ratio,
-                                  expiration=self.expiration)
+            capacity = self.filters[-1].capacity * self.scale
+            error_rate = self.filters[-1].error_rate * self.ratio
         else:
-            filter = CountdownBloomFilter(capacity=self.initial_capacity,
-                                          error_rate=self.error_rate * self.ratio)
+            capacity = self.initial_capacity
+            error_rate = self.error_rate * self.ratio
+        if self.max_memory is not None and \
+                self._cells_nbytes(capacity, error_rate) > self.max_memory:
+            # A level larger than max_memory on its own could never be
+            # compacted under it: start over from the first level
+            capacity = self.initial_capacity
+            error_rate = self.error_rate * self.ratio
+        if self.budget is not None:
+            self.budget.reserve(self, self._cells_nbytes(capacity, error_rate))
+        filter = CountdownBloomFilter(capacity=capacity,
+                                      error_rate=error_rate,
+                                      expiration=self.expiration,
+                                      counter_bits=self.counter_bits,
+                                      hash_cache=self.hash_cache)
         self.filters.append(filter)
         self.filters_count += 1
         self.pointer = self.filters_count-1
+        self._emit(FILTER_ADDED, filter=filter, capacity=filter.capacity,
+                   error_rate=filter.error_rate, nbytes=filter.cellarray.nbytes)
+        if self.max_memory is not None and self.nbytes > self.max_memory:
+            self.compact(keep=filter)
+            self._update_available()
 
     def _get_filter(self):
         '''
-        Get a Filter
+        Get a Filter: the current one, or once it is full the first
+        sub-filter with spare capacity, or a new one
         '''
         filter = self.filters[self.pointer]
-        if filter.count >= filter.capacity:
-            self.pointer = 0
+        while filter._full():
+            self._emit(CAPACITY_REACHED, capacity=filter.capacity,
+                       count=filter.count)
+            if self.available:
+                self.pointer = heapq.heappop(self.available)
+            else:
+                self._add_filter()
             filter = self.filters[self.pointer]
-            while filter.count >= filter.capacity:
-                self.pointer =+ 1
-                if self.pointer >= self.filters_count-1:
-                    self._add_filter()
-                filter = self.filters[self.pointer]
         return filter
 
+    def _retire(self, filters):
+        '''
+        Drop `filters' from this SCBF, keeping the pointer on the current
+        filter when it survives
+        '''
+        current = self.filters[self.pointer] if self.filters else None
+        self.filters = [f for f in self.filters if f not in filters]
+        self.filters_count = len(self.filters)
+        if current in self.filters:
+            self.pointer = self.filters.index(current)
+        else:
+            self.pointer = 0
+
+    def compact(self, keep=None):
+        '''
+        Release drained sub-filters (no cell left set) other than `keep'.
+        Then, while above max_memory, drop the sub-filters with the lowest
+        count, never the current one.
+        '''
+        self._retire([f for f in self.filters if f.occupied == 0 and f is not keep])
+        if self.max_memory is None:
+            return
+        current = self.filters[self.pointer] if self.filters else None
+        candidates = sorted([f for f in self.filters if f is not current],
+                            key=lambda f: f.count)
+        evicted = []
+        nbytes = self.nbytes
+        while candidates and nbytes > self.max_memory:
+            filter = candidates.pop(0)
+            evicted.append(filter)
+            nbytes -= filter.cellarray.nbytes
+        self._retire(evicted)
+
+    def _update_available(self):
+        '''
+        Rebuild the heap of sub-filters with spare capacity from their
+        current count estimates
+        '''
+        self.available = [i for i, f in enumerate(self.filters)
+                          if i != self.pointer and not f._full()]
+        heapq.heapify(self.available)
+
     def add(self, key):
-        if key in self:
-            filter = self._get_filter() ### Update this: retrieve the existing filter containing the key
-            filter.add(key, skip_check=True)
+        index, hashes = self._locate(key)
+        if index is not None:
+            # Refresh the counters in the filter that holds the key
+            self.filters[index].add(hashes[index])
             return True
+        # Getting a filter may add and compact levels, shifting their
+        # indexes: the hashes are matched to the probed filters themselves
+        probed = list(self.filters)
         if not self.filters:
             self._add_filter()
             filter = self.filters[self.pointer]
         else:
             filter = self._get_filter()
-        filter.add(key, skip_check=True)
+        for level, level_hashes in zip(probed, hashes):
+            if level is filter:
+                filter.add(level_hashes, skip_check=True)
+                break
+        else:
+            filter.add(key, skip_check=True)
         return False
 
     @property
@@ -218,17 +454,84 @@ class ScalableCountdownBloomFilter(object):
     def count(self):
         return len(self)
 
+    @property
+    def nbytes(self):
+        """Returns the memory used by the cellarrays of all filters"""
+        return sum([f.cellarray.nbytes for f in self.filters])
+
     def __len__(self):
         """Returns the total number of elements stored in this SBF"""
         return sum([f.count for f in self.filters])
 
-    def batched_expiration_maintenance(self, elapsed_time):
-        #self.pointer = None
+    def _parallel_maintenance(self, elapsed_times):
+        '''
+        Fan the maintenance chunks of every level, for its elapsed time,
+        out to the thread pool. Returns the processed intervals and the
+        iterations and cleared cells of every level.
+        '''
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        batches = []
+        tasks = []
+        for filter, elapsed_time in zip(self.filters, elapsed_times):
+            num_iterations = filter.num_batched_maintenance(elapsed_time)
+            chunks = filter._maintenance_chunks(num_iterations, self.threads)
+            batches.append((filter, num_iterations, len(chunks)))
+            tasks.extend((filter, chunk) for chunk in chunks)
+        cleared = self._pool.map(lambda task: task[0]._run_maintenance_chunk(task[1]), tasks)
         processed_interval = []
-        for f,filter in enumerate(self.filters):
-            processed_interval.append(filter.batched_expiration_maintenance(elapsed_time))
-            #if self.pointer == None and filter.z < 0.5:
-             #   self.pointer = f
+        iterations = total_cleared = 0
+        for filter, num_iterations, num_chunks in batches:
+            level_cleared = sum(cleared[:num_chunks])
+            processed_interval.append(filter._finish_maintenance(num_iterations, level_cleared))
+            iterations += num_iterations
+            total_cleared += level_cleared
+            del cleared[:num_chunks]
+        return processed_interval, iterations, total_cleared
+
+    def close(self):
+        '''
+        Stop the maintenance threads. A later maintenance run starts new
+        ones.
+        '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def batched_expiration_maintenance(self, elapsed_time):
+        '''
+        Run the batched maintenance of every level for `elapsed_time'
+        seconds, or a sequence of seconds with one entry per level.
+        Returns the interval processed by each level.
+        '''
+        start = default_timer()
+        if isinstance(elapsed_time, (list, tuple)):
+            elapsed_times = elapsed_time
+        else:
+            elapsed_times = [elapsed_time] * len(self.filters)
+        if self.threads and self.threads > 1:
+            processed_interval, iterations, cleared = self._parallel_maintenance(elapsed_times)
+        else:
+            processed_interval = []
+            iterations = cleared = 0
+            for filter, elapsed_time in zip(self.filters, elapsed_times):
+                occupied = filter.occupied
+                iterations += filter.num_batched_maintenance(elapsed_time)
+                processed_interval.append(filter.batched_expiration_maintenance(elapsed_time))
+                cleared += occupied - filter.occupied
+        nonzero = sum(f.occupied for f in self.filters)
+        self.compact()
+        self._update_available()
+        self._emit(MAINTENANCE, iterations=iterations,
+                   elapsed=default_timer() - start, cleared=cleared,
+                   nonzero=nonzero)
         return tuple(processed_interval)
 
 
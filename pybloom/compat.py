@@ -0,0 +1,64 @@
+'''
+Python 2/3 compatibility helpers
+'''
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    range = xrange
+    text_type = unicode
+else:
+    range = range
+    text_type = str
+
+# Keys hashed as they are, without a copy
+BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+
+def _float_str(value):
+    '''
+    str() of a float as Python 2 writes it: 12 significant digits, with
+    an exponent from 1e11 on
+    '''
+    s = '%.12g' % value
+    if s.lstrip('-').isdigit():
+        if len(s.lstrip('-')) > 11:
+            mantissa, exponent = ('%.11e' % value).split('e')
+            s = mantissa.rstrip('0').rstrip('.') + 'e' + exponent
+        else:
+            s += '.0'
+    return s
+
+
+def encode_key(key):
+    '''
+    Bytes hashed for `key'. Byte strings, bytearrays and memoryviews are
+    returned as is, text is encoded to UTF-8, anything else goes through
+    str() the way Python 2 did, so that filters written by either version
+    hash keys identically.
+    '''
+    if isinstance(key, BUFFER_TYPES):
+        return key
+    if isinstance(key, text_type):
+        return key.encode('utf-8')
+    if isinstance(key, float):
+        key = _float_str(key)
+    else:
+        key = str(key)
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return key
+
+
+def encode_key_bytes(key):
+    '''
+    encode_key(), copying bytearrays and memoryviews to a hashable
+    byte string
+    '''
+    key = encode_key(key)
+    if isinstance(key, memoryview):
+        return key.tobytes()
+    if isinstance(key, bytearray):
+        return bytes(key)
+    return key
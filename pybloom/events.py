@@ -0,0 +1,77 @@
+'''
+Event hooks of the filters
+
+Callbacks subscribed to an event are called with the filter emitting it
+and keyword arguments describing the event. Events are only emitted on
+rare operations, never by lookups or plain adds:
+
+FILTER_ADDED
+    a scalable filter allocated a sub-filter: filter, capacity,
+    error_rate, nbytes
+CAPACITY_REACHED
+    a filter is full: capacity, count. A BloomFilter emits it before
+    raising IndexError, a scalable filter before growing.
+MAINTENANCE
+    a countdown filter ran its batched maintenance: iterations, elapsed
+    (seconds), cleared (cells decremented to zero), nonzero (cells still
+    set)
+WINDOW_ROTATED
+    a SlidingWindowScalableBloomFilter started a new window: window,
+    capacity, previous (cardinality of the previous window)
+
+>>> from pybloom import ScalableBloomFilter
+>>> sbf = ScalableBloomFilter(initial_capacity=10)
+>>> sizes = []
+>>> _ = sbf.subscribe(FILTER_ADDED, lambda source, **info: sizes.append(info['capacity']))
+>>> for i in range(50):
+...     _ = sbf.add(i)
+>>> sizes
+[10, 20, 40]
+'''
+FILTER_ADDED = 'filter_added'
+CAPACITY_REACHED = 'capacity_reached'
+MAINTENANCE = 'maintenance'
+WINDOW_ROTATED = 'window_rotated'
+EVENTS = (FILTER_ADDED, CAPACITY_REACHED, MAINTENANCE, WINDOW_ROTATED)
+
+
+class Observable(object):
+    '''
+    Mixin holding the callbacks subscribed to the events of a filter.
+    Callbacks, like the other _transient attributes, are not pickled
+    with the filter.
+    '''
+    _listeners = None
+    _transient = ('_listeners',)
+
+    def subscribe(self, event, callback):
+        '''
+        Call `callback(filter, **info)' on each `event'. Returns the
+        callback, so that this can be used as a decorator factory.
+        '''
+        if event not in EVENTS:
+            raise ValueError("Unknown event %r" % (event,))
+        if self._listeners is None:
+            self._listeners = {}
+        self._listeners.setdefault(event, []).append(callback)
+        return callback
+
+    def unsubscribe(self, event, callback):
+        if not self._listeners or callback not in self._listeners.get(event, ()):
+            raise ValueError("Callback not subscribed to %r" % (event,))
+        self._listeners[event].remove(callback)
+
+    def _observed(self, event):
+        return bool(self._listeners and self._listeners.get(event))
+
+    def _emit(self, event, **info):
+        if self._listeners:
+            for callback in list(self._listeners.get(event, ())):
+                callback(self, **info)
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for name in self._transient:
+            d.pop(name, None)
+        return d
+
@@ -1,31 +1,218 @@
 import time
+import heapq
+import numpy as np
+
+from math import floor
+from .compat import encode_key_bytes
+
+
+class FixedSizeKeyTable(object):
+    '''
+    Open addressing table of fixed-size byte string keys and their
+    expiration times, stored in NumPy arrays
+    '''
+    EMPTY, USED, DELETED = 0, 1, 2
+
+    def __init__(self, key_size, capacity=1024):
+        self.key_size = key_size
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.keys = np.zeros((capacity, self.key_size), dtype=np.uint8)
+        self.expiry = np.zeros(capacity, dtype=np.float64)
+        self.state = np.zeros(capacity, dtype=np.uint8)
+        self.mask = capacity - 1
+        self.used = 0
+        self.filled = 0
+
+    def _find(self, key):
+        '''
+        Return the slot holding `key' (or -1) and the first slot it could
+        be inserted in
+        '''
+        slot = hash(key) & self.mask
+        free = -1
+        while True:
+            state = self.state[slot]
+            if state == self.EMPTY:
+                return -1, slot if free < 0 else free
+            if state == self.DELETED:
+                if free < 0:
+                    free = slot
+            elif self.keys[slot].tobytes() == key:
+                return slot, slot
+            slot = (slot + 1) & self.mask
+
+    def _check(self, key):
+        key = encode_key_bytes(key)
+        if len(key) != self.key_size:
+            raise ValueError("Keys must be %d bytes long" % self.key_size)
+        return key
+
+    def get(self, key):
+        key = self._check(key)
+        slot, _ = self._find(key)
+        if slot < 0:
+            return None
+        return self.expiry[slot]
+
+    def set(self, key, expiry):
+        key = self._check(key)
+        slot, free = self._find(key)
+        if slot < 0:
+            slot = free
+            if self.state[slot] == self.EMPTY:
+                self.filled += 1
+            self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+            self.state[slot] = self.USED
+            self.used += 1
+        self.expiry[slot] = expiry
+        if self.filled * 2 > self.mask + 1:
+            self._resize((self.mask + 1) * (2 if self.used * 4 > self.mask + 1 else 1))
+
+    def delete(self, key):
+        key = self._check(key)
+        slot, _ = self._find(key)
+        if slot >= 0:
+            self.state[slot] = self.DELETED
+            self.used -= 1
+
+    def purge(self, now):
+        '''
+        Delete every key expired at `now'. Returns the number of keys
+        deleted.
+        '''
+        expired = (self.state == self.USED) & (self.expiry <= now)
+        num_expired = int(expired.sum())
+        self.state[expired] = self.DELETED
+        self.used -= num_expired
+        if (self.filled - self.used) * 4 > self.mask + 1:
+            self._resize(self.mask + 1)
+        return num_expired
+
+    def _resize(self, capacity):
+        used = (self.state == self.USED).nonzero()[0]
+        keys, expiry = self.keys[used], self.expiry[used]
+        self._allocate(capacity)
+        for i in range(len(used)):
+            self.set(keys[i].tobytes(), expiry[i])
+
+    def __len__(self):
+        return self.used
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.expiry.nbytes + self.state.nbytes
+
 
 class HashFilter(object):
     '''
     Plain Temporal Hash Filter for testing purposes
+
+    Expired keys are purged proactively: keys are filed in a timer wheel
+    of `resolution' second buckets and add/contains purge the elapsed
+    buckets at most once per `resolution'. Timestamps are expected to be
+    non-decreasing.
+
+    With `key_size' keys must encode to exactly that many bytes, and are
+    stored in a compact FixedSizeKeyTable instead of a dict.
     '''
-    def __init__(self, expiration):
+    def __init__(self, expiration, resolution=1.0, key_size=None):
         self.expiration = expiration
-        self.unique_items = {}
+        self.resolution = resolution
+        self.key_size = key_size
+        if key_size is None:
+            self.unique_items = {}
+        else:
+            self.unique_items = FixedSizeKeyTable(key_size)
+        # Timer wheel: bucket number -> keys expiring in that bucket, and
+        # a heap of the bucket numbers
+        self._buckets = {}
+        self._bucket_heap = []
+        self._next_purge = None
+
+    def __len__(self):
+        return len(self.unique_items)
+
+    def _get(self, key):
+        return self.unique_items.get(key)
+
+    def _set(self, key, expiry, previous=None):
+        if self.key_size is not None:
+            self.unique_items.set(key, expiry)
+            return
+        self.unique_items[key] = expiry
+        bucket = int(floor(expiry / self.resolution))
+        if previous is not None and int(floor(previous / self.resolution)) == bucket:
+            return
+        if bucket not in self._buckets:
+            self._buckets[bucket] = []
+            heapq.heappush(self._bucket_heap, bucket)
+        self._buckets[bucket].append(key)
+
+    def _delete(self, key):
+        if self.key_size is None:
+            del self.unique_items[key]
+        else:
+            self.unique_items.delete(key)
+
+    def purge(self, now):
+        '''
+        Delete the keys expired at `now'. In the timer wheel, buckets that
+        are not entirely elapsed are left for a later purge. Returns the
+        number of keys deleted.
+        '''
+        now = float(now)
+        if self.key_size is not None:
+            return self.unique_items.purge(now)
+        num_expired = 0
+        items = self.unique_items
+        while self._bucket_heap and (self._bucket_heap[0] + 1) * self.resolution <= now:
+            bucket = heapq.heappop(self._bucket_heap)
+            for key in self._buckets.pop(bucket):
+                expiry = items.get(key)
+                # Refreshed keys were also filed in a later bucket
+                if expiry is not None and expiry <= now:
+                    del items[key]
+                    num_expired += 1
+        return num_expired
+
+    def _tick(self, timestamp):
+        if self._next_purge is None or timestamp >= self._next_purge:
+            self.purge(timestamp)
+            self._next_purge = timestamp + self.resolution
 
     def add(self, key, timestamp = None):
         timestamp = float(timestamp)
-        if key in self.unique_items:
-            if timestamp < self.unique_items[key]:
-                self.unique_items[key] = timestamp + self.expiration
-                return True
-            else:
-                self.unique_items[key] = timestamp + self.expiration
-                return False
-        else:
-            self.unique_items[key] = timestamp + self.expiration
-            return False
+        self._tick(timestamp)
+        expiry = self._get(key)
+        self._set(key, timestamp + self.expiration, expiry)
+        return expiry is not None and timestamp < expiry
 
     def contains(self, key, timestamp):
         timestamp = float(timestamp)
-        if key in self.unique_items:
-            if timestamp < self.unique_items[key]:
-                return True
-            else:
-                del self.unique_items[key]
-                return False
+        self._tick(timestamp)
+        expiry = self._get(key)
+        if expiry is None:
+            return False
+        if timestamp < expiry:
+            return True
+        self._delete(key)
+        return False
+
+    def add_many(self, keys, timestamp):
+        '''
+        Add every key of `keys' at `timestamp'. Returns the list of add()
+        results.
+        '''
+        timestamp = float(timestamp)
+        self._tick(timestamp)
+        return [self.add(key, timestamp) for key in keys]
+
+    def contains_many(self, keys, timestamp):
+        '''
+        Test every key of `keys' at `timestamp'. Returns a list of bools.
+        '''
+        timestamp = float(timestamp)
+        self._tick(timestamp)
+        return [self.contains(key, timestamp) for key in keys]
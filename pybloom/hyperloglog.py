@@ -0,0 +1,64 @@
+import math
+import hashlib
+from struct import unpack
+from .compat import encode_key
+
+
+class HyperLogLog(object):
+    '''
+    HyperLogLog cardinality estimator
+
+    Flajolet, Philippe, et al. "HyperLogLog: the analysis of a near-optimal
+    cardinality estimation algorithm." AofA: Analysis of Algorithms, 2007.
+
+    Uses 2 ** precision one-byte registers, for a relative standard error
+    of about 1.04 / sqrt(2 ** precision). Small cardinalities are
+    estimated by linear counting.
+
+    >>> hll = HyperLogLog()
+    >>> hll.update(str(i % 1000) for i in range(10000))
+    >>> 980 < hll.cardinality() < 1020
+    True
+    '''
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("Precision must be between 4 and 18")
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+        m = self.num_registers
+        if m >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+    @property
+    def standard_error(self):
+        return 1.04 / math.sqrt(self.num_registers)
+
+    def add(self, key):
+        x, = unpack('<Q', hashlib.sha1(encode_key(key)).digest()[:8])
+        index = x & (self.num_registers - 1)
+        w = x >> self.precision
+        rank = 64 - self.precision - w.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def cardinality(self):
+        '''
+        Estimated number of distinct keys added
+        '''
+        m = self.num_registers
+        estimate = self.alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(b'\x00')
+            if zeros:
+                estimate = m * math.log(m / float(zeros))
+        return estimate
+
+    def __len__(self):
+        return int(round(self.cardinality()))
@@ -2,32 +2,102 @@
 Cython module for fast maintenance process
 '''
 
-from libc.stdlib cimport malloc, free
-from libc.math cimport sqrt, pow
 import cython
-cimport numpy as np
+from libc.stdint cimport uint8_t
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
 @cython.cdivision(True)
-cdef tuple maintenance_cyt(np.ndarray[np.uint8_t, ndim=1, mode="c"] cells, long int cells_size, long int num_iterations, long int head):
+cdef long int decrement_cyt(uint8_t[::1] cells, long int start, long int stop, long int amount, int counter_bits) nogil:
     '''
-    Maintenance process for the Countdown Bloom Filter
+    Decrement the cells in [start, stop) by `amount', stopping at zero.
+    Returns the number of cells that were decremented to zero.
+
+    Counters are packed `8 / counter_bits` per byte, lowest cell in the
+    lowest bits.
+    '''
+    cdef long int idx
+    cdef long int cleared = 0
+    cdef long int byte
+    cdef int per_byte = 8 / counter_bits
+    cdef int shift
+    cdef uint8_t mask = (1 << counter_bits) - 1
+    cdef uint8_t value
+
+    if amount <= 0:
+        return 0
+
+    if counter_bits == 8:
+        for idx in range(start, stop):
+            if cells[idx] != 0:
+                if cells[idx] <= amount:
+                    cells[idx] = 0
+                    cleared += 1
+                else:
+                    cells[idx] -= amount
+        return cleared
+
+    for idx in range(start, stop):
+        byte = idx / per_byte
+        shift = (idx % per_byte) * counter_bits
+        value = (cells[byte] >> shift) & mask
+        if value != 0:
+            if value <= amount:
+                value = 0
+                cleared += 1
+            else:
+                value -= amount
+            cells[byte] = (cells[byte] & ~(mask << shift)) | (value << shift)
+    return cleared
+
+
+cdef long int decrement_range(uint8_t[::1] cells, long int start, long int stop, long int lo, long int hi, long int amount, int counter_bits):
     '''
-    cdef long int refresh_head = head
-    cdef long int itr
-    cdef long int nonzero = 0
+    Decrement the cells of [lo, hi) that fall in [start, stop), without
+    holding the GIL
+    '''
+    cdef long int cleared
+    lo = max(lo, start)
+    hi = min(hi, stop)
+    if lo >= hi:
+        return 0
+    with nogil:
+        cleared = decrement_cyt(cells, lo, hi, amount, counter_bits)
+    return cleared
+
+
+def maintenance_chunk(uint8_t[::1] cells, long int cells_size, long int num_iterations, long int head, long int start, long int stop, int counter_bits=8):
+    '''
+    Apply the effect of `num_iterations' maintenance steps starting at
+    `head' to the cells in [start, stop) only. Chunks covering disjoint,
+    byte-aligned cell ranges can be processed concurrently.
 
-    for itr in xrange(num_iterations):
-        if cells[refresh_head] != 0:
-            cells[refresh_head] -= 1
-            if cells[refresh_head] != 0:
-                nonzero += 1
-        refresh_head = (refresh_head + 1) % cells_size
-    return refresh_head, nonzero
+    Returns the number of cells that were decremented to zero.
+    '''
+    cdef long int passes = num_iterations // cells_size
+    cdef long int remainder = num_iterations % cells_size
+    cdef long int end = head + remainder
+    cdef long int cleared = 0
 
+    # Cells in [head, head + remainder), wrapping around, are visited
+    # once more than the others.
+    if end <= cells_size:
+        cleared += decrement_range(cells, start, stop, head, end, passes + 1, counter_bits)
+        cleared += decrement_range(cells, start, stop, 0, head, passes, counter_bits)
+        cleared += decrement_range(cells, start, stop, end, cells_size, passes, counter_bits)
+    else:
+        cleared += decrement_range(cells, start, stop, head, cells_size, passes + 1, counter_bits)
+        cleared += decrement_range(cells, start, stop, 0, end - cells_size, passes + 1, counter_bits)
+        cleared += decrement_range(cells, start, stop, end - cells_size, head, passes, counter_bits)
+    return cleared
 
-def maintenance(np.ndarray[np.uint8_t, ndim=1, mode="c"] cells, long int cells_size, long int num_iterations, head):
-    return maintenance_cyt(cells, cells_size, num_iterations, head)
 
+def maintenance(uint8_t[::1] cells, long int cells_size, long int num_iterations, long int head, int counter_bits=8):
+    '''
+    Maintenance process for the Countdown Bloom Filter
 
+    Returns the new head and the number of cells that were decremented
+    to zero.
+    '''
+    cleared = maintenance_chunk(cells, cells_size, num_iterations, head, 0, cells_size, counter_bits)
+    return (head + num_iterations) % cells_size, cleared
@@ -0,0 +1,188 @@
+'''
+NumPy bit storage backends: in-memory words, mmap'd files and shared
+memory
+'''
+import os
+import tempfile
+import weakref
+import numpy as np
+
+from .storage import BitStorage
+
+
+# Weak references removing the file of a temporary storage once dropped,
+# by id: storages compare by value and are not hashable
+_temporary = {}
+
+
+def _remove_when_dropped(storage, path):
+    def remove(ref):
+        del _temporary[id(ref)]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    ref = weakref.ref(storage, remove)
+    _temporary[id(ref)] = ref
+
+
+def _popcount(words):
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(words).sum())
+    return int(np.unpackbits(words.view(np.uint8)).sum())
+
+
+class NumpyStorage(BitStorage):
+    '''
+    Bits kept in an array of uint64 words, with vectorized batch
+    operations. `words' may be given to use an existing array or buffer
+    of ceil(num_bits / 64) words.
+    '''
+    def __init__(self, num_bits, words=None):
+        self.num_bits = num_bits
+        if words is None:
+            words = np.zeros(self.num_words(num_bits), dtype=np.uint64)
+        self._attach(words)
+
+    @staticmethod
+    def num_words(num_bits):
+        return (num_bits + 63) // 64
+
+    def _attach(self, words):
+        self.words = words
+        # Bits are addressed through the bytes, which keeps the bitarray
+        # layout whatever the byte order of the words
+        self.bytes = words.view(np.uint8)
+
+    def get(self, index):
+        return bool((self.bytes[index >> 3] >> (index & 7)) & 1)
+
+    def set(self, index, value=True):
+        if value:
+            self.bytes[index >> 3] |= 1 << (index & 7)
+        else:
+            self.bytes[index >> 3] &= ~(1 << (index & 7)) & 0xff
+
+    def get_many(self, indexes):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        return ((self.bytes[indexes >> 3] >> (indexes & 7)) & 1).astype(bool)
+
+    def set_many(self, indexes):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        np.bitwise_or.at(self.bytes, indexes >> 3,
+                         np.left_shift(1, indexes & 7).astype(np.uint8))
+
+    def count(self):
+        return _popcount(self.words)
+
+    def clear(self):
+        self.words[:] = 0
+
+    def buffer(self):
+        return self.bytes
+
+    def tobytes(self):
+        return self.bytes[:(self.num_bits + 7) // 8].tobytes()
+
+    def load(self, data):
+        data = np.frombuffer(data, dtype=np.uint8)[:self.bytes.shape[0]]
+        self.bytes[:data.shape[0]] = data
+        self.bytes[data.shape[0]:] = 0
+
+    def copy(self):
+        return NumpyStorage(self.num_bits, self.words.copy())
+
+    def _words_of(self, other):
+        if isinstance(other, NumpyStorage):
+            return other.words
+        words = np.zeros_like(self.words)
+        data = np.frombuffer(other.tobytes(), dtype=np.uint8)
+        words.view(np.uint8)[:data.shape[0]] = data
+        return words
+
+    def union(self, other):
+        return NumpyStorage(self.num_bits, self.words | self._words_of(other))
+
+    def intersection(self, other):
+        return NumpyStorage(self.num_bits, self.words & self._words_of(other))
+
+    def count_or(self, other):
+        return _popcount(self.words | self._words_of(other))
+
+    def count_and(self, other):
+        return _popcount(self.words & self._words_of(other))
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+
+class MmapStorage(NumpyStorage):
+    '''
+    Bits kept in a memory-mapped file at `path', created when missing.
+    Copies, unions and intersections are in-memory NumpyStorages.
+    '''
+    in_memory = False
+
+    def __init__(self, num_bits, path):
+        self.path = path
+        shape = (self.num_words(num_bits),)
+        mode = 'r+' if os.path.exists(path) and os.path.getsize(path) >= shape[0] * 8 else 'w+'
+        super(MmapStorage, self).__init__(num_bits, np.memmap(path, dtype=np.uint64,
+                                                              mode=mode, shape=shape))
+
+    @classmethod
+    def in_directory(cls, directory):
+        '''
+        Factory creating each storage in a new file of `directory', for
+        filters with several sub-filters such as ScalableBloomFilter.
+        The file is removed when its storage is dropped.
+        '''
+        def storage(num_bits):
+            fd, path = tempfile.mkstemp(suffix='.bits', dir=directory)
+            os.close(fd)
+            storage = cls(num_bits, path)
+            _remove_when_dropped(storage, path)
+            return storage
+        return storage
+
+    def flush(self):
+        self.words.flush()
+
+
+class SharedMemoryStorage(NumpyStorage):
+    '''
+    Bits kept in a multiprocessing.shared_memory block (Python 3.8+).
+    A new block is created unless the `name' of an existing one is given,
+    which other processes use to attach to the same bits.
+    '''
+    def __init__(self, num_bits, name=None):
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise ImportError('SharedMemoryStorage requires Python 3.8+')
+        size = self.num_words(num_bits) * 8
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            np.ndarray((size,), dtype=np.uint8, buffer=self.shm.buf)[:] = 0
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        super(SharedMemoryStorage, self).__init__(
+            num_bits, np.ndarray((size // 8,), dtype=np.uint64, buffer=self.shm.buf))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        '''
+        Detach from the block, which the storage can no longer use
+        '''
+        self.words = self.bytes = None
+        self.shm.close()
+
+    def unlink(self):
+        '''
+        Destroy the block once every process has closed it
+        '''
+        self.shm.unlink()
@@ -7,7 +7,7 @@ Requires the bitarray library: http://pypi.python.org/pypi/bitarray/
 
     >>> from pybloom import BloomFilter
     >>> f = BloomFilter(capacity=10000, error_rate=0.001)
-    >>> for i in xrange(0, f.capacity):
+    >>> for i in range(0, f.capacity):
     ...     _ = f.add(i)
     ...
     >>> 0 in f
@@ -22,7 +22,7 @@ Requires the bitarray library: http://pypi.python.org/pypi/bitarray/
     >>> from pybloom import ScalableBloomFilter
     >>> sbf = ScalableBloomFilter(mode=ScalableBloomFilter.SMALL_SET_GROWTH)
     >>> count = 10000
-    >>> for i in xrange(0, count):
+    >>> for i in range(0, count):
     ...     _ = sbf.add(i)
     ...
     >>> sbf.capacity > count
@@ -34,20 +34,86 @@ Requires the bitarray library: http://pypi.python.org/pypi/bitarray/
 
 """
 import math
+import time
 import hashlib
+from collections import OrderedDict
 from struct import unpack, pack, calcsize
+from .compat import range, encode_key, encode_key_bytes
+from .hyperloglog import HyperLogLog
+from .storage import BitarrayStorage
+from .events import Observable, FILTER_ADDED, CAPACITY_REACHED
 
 try:
     import bitarray
 except ImportError:
-    raise ImportError('pybloom requires bitarray >= 0.3.4')
+    raise ImportError('pybloom requires bitarray >= 1.1.0')
+
+# Optional compiled hashing and probing, pure Python when not built
+try:
+    from . import _core
+except ImportError:
+    _core = None
 
 __version__ = '2.0'
 __author__  = "Jay Baird <jay.baird@me.com>, Bob Ippolito <bob@redivi.com>,\
                Marius Eriksen <marius@monkey.org>,\
                Alex Brasetvik <alex@brasetvik.com>"
 
-def make_hashfuncs(num_slices, num_bits):
+class HashCache(object):
+    """Bounded LRU cache of the slice indexes computed by make_hashfuncs
+
+    A single HashCache can be shared by any number of filters, whatever
+    their geometry: entries are keyed on (num_slices, num_bits, encoded
+    key). Hot keys then skip the digest computation entirely. The hashes
+    returned are shared lists and must not be modified.
+
+    >>> cache = HashCache(maxsize=1000)
+    >>> b = BloomFilter(capacity=100, hash_cache=cache)
+    >>> b.add("hello")
+    False
+    >>> "hello" in b
+    True
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+    def __init__(self, maxsize=4096):
+        if not maxsize > 0:
+            raise ValueError("Maxsize must be > 0")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def lookup(self, num_slices, num_bits, key, compute):
+        """Return the hashes of the encoded `key', calling `compute(key)'
+        on a miss."""
+        entries = self._entries
+        entry = (num_slices, num_bits, key)
+        hashes = entries.pop(entry, None)
+        if hashes is None:
+            self.misses += 1
+            hashes = compute(key)
+            if len(entries) >= self.maxsize:
+                entries.popitem(last=False)
+        else:
+            self.hits += 1
+        entries[entry] = hashes
+        return hashes
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+
+def make_hashfuncs(num_slices, num_bits, cache=None):
     if num_bits >= (1 << 31):
         fmt_code, chunk_size = 'Q', 8
     elif num_bits >= (1 << 15):
@@ -69,12 +135,16 @@ def make_hashfuncs(num_slices, num_bits):
     num_salts, extra = divmod(num_slices, len(fmt))
     if extra:
         num_salts += 1
-    salts = [hashfn(hashfn(pack('I', i)).digest()) for i in xrange(num_salts)]
-    def _make_hashfuncs(key):
-        if isinstance(key, unicode):
-            key = key.encode('utf-8')
-        else:
-            key = str(key)
+    salts = [hashfn(hashfn(pack('I', i)).digest()) for i in range(num_salts)]
+    core = _core
+    def _hashes(key):
+        if core is not None:
+            digests = []
+            for salt in salts:
+                h = salt.copy()
+                h.update(key)
+                digests.append(h.digest())
+            return core.indexes(b''.join(digests), chunk_size, num_slices, num_bits)
         rval = []
         for salt in salts:
             h = salt.copy()
@@ -82,13 +152,18 @@ def make_hashfuncs(num_slices, num_bits):
             rval.extend(uint % num_bits for uint in unpack(fmt, h.digest()))
         del rval[num_slices:]
         return rval
+    def _make_hashfuncs(key):
+        if cache is not None:
+            return cache.lookup(num_slices, num_bits, encode_key_bytes(key), _hashes)
+        return _hashes(encode_key(key))
     return _make_hashfuncs
 
 
-class BloomFilter(object):
+class BloomFilter(Observable):
     FILE_FMT = '<dQQQQ'
 
-    def __init__(self, capacity, error_rate=0.001):
+    def __init__(self, capacity, error_rate=0.001, hash_cache=None,
+                 storage=None):
         """Implements a space-efficient probabilistic data structure
 
         capacity
@@ -99,6 +174,12 @@ class BloomFilter(object):
             the error_rate of the filter returning false positives. This
             determines the filters capacity. Inserting more than capacity
             elements greatly increases the chance of false positives.
+        hash_cache
+            an optional HashCache memoizing the hashes of hot keys, which
+            can be shared with other filters
+        storage
+            factory of the bit storage backend, called with the number of
+            bits (see pybloom.storage). An in-memory bitarray by default.
 
         >>> b = BloomFilter(capacity=100000, error_rate=0.001)
         >>> b.add("test")
@@ -111,6 +192,20 @@ class BloomFilter(object):
             raise ValueError("Error_Rate must be between 0 and 1.")
         if not capacity > 0:
             raise ValueError("Capacity must be > 0")
+        num_slices, bits_per_slice = self.geometry(capacity, error_rate)
+        self.hash_cache = hash_cache
+        self._setup(error_rate, num_slices, bits_per_slice, capacity, 0)
+        self.storage = (storage or BitarrayStorage)(self.num_bits)
+
+    @staticmethod
+    def geometry(capacity, error_rate):
+        """Return the number of slices and of bits per slice of a filter
+        holding `capacity' keys at `error_rate'.
+
+        >>> BloomFilter.geometry(1000, 0.001)
+        (10, 1438)
+
+        """
         # given M = num_bits, k = num_slices, P = error_rate, n = capacity
         #       k = log2(1/P)
         # solving for m = bits_per_slice
@@ -121,9 +216,7 @@ class BloomFilter(object):
         bits_per_slice = int(math.ceil(
             (capacity * abs(math.log(error_rate))) /
             (num_slices * (math.log(2) ** 2))))
-        self._setup(error_rate, num_slices, bits_per_slice, capacity, 0)
-        self.bitarray = bitarray.bitarray(self.num_bits, endian='little')
-        self.bitarray.setall(False)
+        return num_slices, bits_per_slice
 
     def _setup(self, error_rate, num_slices, bits_per_slice, capacity, count):
         self.error_rate = error_rate
@@ -132,7 +225,8 @@ class BloomFilter(object):
         self.capacity = capacity
         self.num_bits = num_slices * bits_per_slice
         self.count = count
-        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice)
+        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice,
+                                          self.hash_cache)
 
     def __contains__(self, key):
         """Tests a key's membership in this bloom filter.
@@ -145,18 +239,38 @@ class BloomFilter(object):
 
         """
         bits_per_slice = self.bits_per_slice
-        bitarray = self.bitarray
         if not isinstance(key, list):
             hashes = self.make_hashes(key)
         else:
             hashes = key
+        if _core is not None:
+            return _core.contains(self.storage.buffer(), hashes, bits_per_slice)
+        get = self.storage.get
         offset = 0
         for k in hashes:
-            if not bitarray[offset + k]:
+            if not get(offset + k):
                 return False
             offset += bits_per_slice
         return True
 
+    def contains_many(self, keys):
+        """Tests the membership of every key of `keys'. Returns a list of
+        bools. With the compiled core the probes run without the GIL.
+
+        >>> b = BloomFilter(capacity=100)
+        >>> b.add("hello")
+        False
+        >>> b.contains_many(["hello", "world"])
+        [True, False]
+
+        """
+        hashes = [self.make_hashes(key) for key in keys]
+        if _core is None:
+            return [h in self for h in hashes]
+        found = _core.contains_batch(self.storage.buffer(), hashes,
+                                     self.num_slices, self.bits_per_slice)
+        return [bool(f) for f in found]
+
     def __len__(self):
         """Return the number of keys stored by this bloom filter."""
         return self.count
@@ -172,25 +286,100 @@ class BloomFilter(object):
         True
 
         """
-        bitarray = self.bitarray
-        bits_per_slice = self.bits_per_slice
         hashes = self.make_hashes(key)
         if not skip_check and hashes in self:
             return True
         if self.count > self.capacity:
+            self._emit(CAPACITY_REACHED, capacity=self.capacity, count=self.count)
             raise IndexError("BloomFilter is at capacity")
-        offset = 0
-        for k in hashes:
-            self.bitarray[offset + k] = True
-            offset += bits_per_slice
-        self.count += 1
+        self._insert(hashes)
         return False
 
+    def _insert(self, hashes):
+        """Set the bits of `hashes', counting a new key, whatever the
+        count."""
+        bits_per_slice = self.bits_per_slice
+        if _core is not None:
+            _core.add(self.storage.buffer(), hashes, bits_per_slice)
+        else:
+            self.storage.set_many([i * bits_per_slice + k
+                                   for i, k in enumerate(hashes)])
+        self.count += 1
+
+    def fill_ratio(self):
+        """Return the fraction of the bits that are set.
+
+        >>> b = BloomFilter(capacity=100, error_rate=0.01)
+        >>> b.fill_ratio()
+        0.0
+        >>> _ = b.add("hello")
+        >>> b.fill_ratio() == b.num_slices / float(b.num_bits)
+        True
+
+        """
+        return self.storage.count() / float(self.num_bits)
+
+    @property
+    def bitarray(self):
+        """The bits of this filter as a bitarray: the storage's own with
+        the default backend. With the others it is a read-only copy, a
+        frozenbitarray: write through the storage instead."""
+        if isinstance(self.storage, BitarrayStorage):
+            return self.storage.bits
+        bits = bitarray.bitarray(endian='little')
+        bits.frombytes(self.storage.tobytes())
+        return bitarray.frozenbitarray(bits[:self.num_bits])
+
+    @bitarray.setter
+    def bitarray(self, bits):
+        self.storage = BitarrayStorage(self.num_bits, bits)
+
+    @classmethod
+    def from_iterable(cls, source, error_rate=0.001, precision=14,
+                      hash_cache=None, storage=None):
+        """Build a bloom filter sized for the distinct keys of `source'.
+
+        A HyperLogLog of 2 ** precision registers first estimates the
+        number of distinct keys; the filter is given that capacity plus
+        three standard errors, then every key is added. Re-iterable
+        sources (lists, sets, files reopened...) are read twice, while
+        iterators are buffered during the estimation pass. When the
+        estimate falls short, or a source yields more keys the second
+        time, the keys past capacity are still added, above the error
+        rate, rather than raise IndexError.
+
+        >>> b = BloomFilter.from_iterable(str(i % 5000) for i in range(20000))
+        >>> 5000 <= b.capacity < 5300, len(b) <= 5000
+        (True, True)
+        >>> "4999" in b
+        True
+
+        """
+        hll = HyperLogLog(precision)
+        if iter(source) is source:
+            buffered = []
+            for key in source:
+                hll.add(key)
+                buffered.append(key)
+            source = buffered
+        else:
+            hll.update(source)
+        capacity = int(math.ceil(hll.cardinality() *
+                                 (1 + 3 * hll.standard_error))) or 1
+        filter = cls(capacity, error_rate, hash_cache=hash_cache,
+                     storage=storage)
+        for key in source:
+            hashes = filter.make_hashes(key)
+            if hashes not in filter:
+                filter._insert(hashes)
+        return filter
+
     def copy(self):
         """Return a copy of this bloom filter.
         """
-        new_filter = BloomFilter(self.capacity, self.error_rate)
-        new_filter.bitarray = self.bitarray.copy()
+        new_filter = BloomFilter(self.capacity, self.error_rate, self.hash_cache)
+        new_filter.storage = self.storage.copy()
+        new_filter.count = self.count
         return new_filter
 
     def union(self, other):
@@ -201,7 +390,7 @@ class BloomFilter(object):
             raise ValueError("Unioning filters requires both filters to have \
 both the same capacity and error rate")
         new_bloom = self.copy()
-        new_bloom.bitarray = new_bloom.bitarray | other.bitarray
+        new_bloom.storage = self.storage | other.storage
         return new_bloom
 
     def __or__(self, other):
@@ -215,59 +404,139 @@ both the same capacity and error rate")
             raise ValueError("Intersecting filters requires both filters to \
 have equal capacity and error rate")
         new_bloom = self.copy()
-        new_bloom.bitarray = new_bloom.bitarray & other.bitarray
+        new_bloom.storage = self.storage & other.storage
         return new_bloom
 
     def __and__(self, other):
         return self.intersection(other)
 
+    def _estimate(self, bits_set):
+        """Number of distinct keys expected to set `bits_set' bits
+        (Swamidass & Baldi). A saturated filter gives the largest finite
+        estimate."""
+        fill = min(bits_set, self.num_bits - 1) / float(self.num_bits)
+        return math.log(1 - fill) / math.log(1 - 1.0 / self.bits_per_slice)
+
+    def _check_geometry(self, other):
+        if self.capacity != other.capacity or \
+            self.error_rate != other.error_rate:
+            raise ValueError("Estimating the overlap of filters requires \
+both filters to have the same capacity and error rate")
+
+    def estimate_cardinality(self):
+        """Estimate the number of distinct keys added from the number of
+        bits set. Unlike len(), it holds for copies, unions and
+        intersections.
+
+        >>> b = BloomFilter(capacity=10000, error_rate=0.01)
+        >>> for i in range(5000):
+        ...     _ = b.add(i)
+        >>> 4900 < b.estimate_cardinality() < 5100
+        True
+
+        """
+        return self._estimate(self.storage.count())
+
+    def estimate_union_size(self, other):
+        """Estimate the number of distinct keys added to this filter or
+        `other', of the same capacity and error rate."""
+        self._check_geometry(other)
+        return self._estimate(self.storage.count_or(other.storage))
+
+    def estimate_intersection_size(self, other):
+        """Estimate the number of distinct keys added to both this filter
+        and `other', by inclusion-exclusion of the estimates."""
+        self._check_geometry(other)
+        return max(0.0, self.estimate_cardinality() + other.estimate_cardinality()
+                   - self.estimate_union_size(other))
+
+    def estimate_jaccard(self, other):
+        """Estimate the Jaccard similarity of the keys of this filter and
+        `other'.
+
+        >>> a, b = BloomFilter(10000, 0.01), BloomFilter(10000, 0.01)
+        >>> for i in range(4000):
+        ...     _ = a.add(i)
+        ...     _ = b.add(i + 2000)
+        >>> 0.3 < a.estimate_jaccard(b) < 0.37
+        True
+
+        """
+        union = self.estimate_union_size(other)
+        if not union:
+            return 0.0
+        intersection = (self.estimate_cardinality() +
+                        other.estimate_cardinality() - union)
+        return max(0.0, intersection) / union
+
     def tofile(self, f):
         """Write the bloom filter to file object `f'. Underlying bits
         are written as machine values. This is much more space
         efficient than pickling the object."""
         f.write(pack(self.FILE_FMT, self.error_rate, self.num_slices,
                      self.bits_per_slice, self.capacity, self.count))
-        self.bitarray.tofile(f)
+        self.storage.tofile(f)
 
     @classmethod
-    def fromfile(cls, f, n=-1):
+    def fromfile(cls, f, n=-1, storage=None):
         """Read a bloom filter from file-object `f' serialized with
-        ``BloomFilter.tofile''. If `n' > 0 read only so many bytes."""
+        ``BloomFilter.tofile''. If `n' > 0 read only so many bytes.
+        The bits are loaded in a `storage' backend, a bitarray by
+        default."""
         headerlen = calcsize(cls.FILE_FMT)
 
         if 0 < n < headerlen:
-            raise ValueError, 'n too small!'
+            raise ValueError('n too small!')
 
         filter = cls(1)  # Bogus instantiation, we will `_setup'.
         filter._setup(*unpack(cls.FILE_FMT, f.read(headerlen)))
-        filter.bitarray = bitarray.bitarray(endian='little')
+        bits = bitarray.bitarray(endian='little')
         if n > 0:
-            filter.bitarray.fromfile(f, n - headerlen)
+            bits.fromfile(f, n - headerlen)
         else:
-            filter.bitarray.fromfile(f)
-        if filter.num_bits != filter.bitarray.length() and \
+            bits.fromfile(f)
+        if filter.num_bits != len(bits) and \
                (filter.num_bits + (8 - filter.num_bits % 8)
-                != filter.bitarray.length()):
-            raise ValueError, 'Bit length mismatch!'
+                != len(bits)):
+            raise ValueError('Bit length mismatch!')
+        if storage is None:
+            filter.storage = BitarrayStorage(filter.num_bits, bits)
+        else:
+            filter.storage = storage(filter.num_bits)
+            filter.storage.load(bits.tobytes())
 
         return filter
 
     def __getstate__(self):
-        d = self.__dict__.copy()
+        d = super(BloomFilter, self).__getstate__()
         del d['make_hashes']
+        d['hash_cache'] = None
         return d
 
     def __setstate__(self, d):
+        d.setdefault('hash_cache', None)
+        if 'bitarray' in d:
+            # Pickled before storage backends
+            d['storage'] = BitarrayStorage(d['num_bits'], d.pop('bitarray'))
         self.__dict__.update(d)
-        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice)
+        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice,
+                                          self.hash_cache)
 
-class ScalableBloomFilter(object):
+class ScalableBloomFilter(Observable):
     SMALL_SET_GROWTH = 2 # slower, but takes up less memory
     LARGE_SET_GROWTH = 4 # faster, but takes up more memory faster
     FILE_FMT = '<idQd'
+    # MemoryBudget this SBF is registered with
+    budget = None
+    _transient = ('_listeners', 'budget')
+    # Adaptive growth state, class defaults for SBFs pickled without it
+    adaptive = False
+    _next_check = 0
+    _start = _level_start = None
 
     def __init__(self, initial_capacity=100, error_rate=0.001,
-                 mode=SMALL_SET_GROWTH):
+                 mode=SMALL_SET_GROWTH, hash_cache=None, storage=None,
+                 adaptive=False, clock=None):
         """Implements a space-efficient probabilistic data structure that
         grows as more items are added while maintaining a steady false
         positive rate
@@ -283,6 +552,21 @@ class ScalableBloomFilter(object):
             ScalableBloomFilter.LARGE_SET_GROWTH. SMALL_SET_GROWTH is slower
             but uses less memory. LARGE_SET_GROWTH is faster but consumes
             memory faster.
+        hash_cache
+            an optional HashCache shared by every filter of this SBF
+        storage
+            factory of the bit storage backend of every filter
+        adaptive
+            grow when the fill ratio of the current filter reaches the
+            one giving its error rate, instead of at its nominal capacity,
+            and size the next filter from the observed insert rate: at
+            least `mode' times larger, as large as the keys expected at
+            that rate for as long as this SBF has run, up to `mode'
+            squared times larger. The flag is not serialized by tofile():
+            pass it again to fromfile().
+        clock
+            callable returning the current time for the insert rate,
+            time.time by default
 
         >>> b = ScalableBloomFilter(initial_capacity=512, error_rate=0.001, \
                                     mode=ScalableBloomFilter.SMALL_SET_GROWTH)
@@ -299,6 +583,10 @@ class ScalableBloomFilter(object):
         if not error_rate or error_rate < 0:
             raise ValueError("Error_Rate must be a decimal less than 0.")
         self._setup(mode, 0.9, initial_capacity, error_rate)
+        self.hash_cache = hash_cache
+        self.storage = storage
+        self.adaptive = adaptive
+        self.clock = clock or time.time
         self.filters = []
 
     def _setup(self, mode, ratio, initial_capacity, error_rate):
@@ -339,32 +627,138 @@ class ScalableBloomFilter(object):
         if key in self:
             return True
         if not self.filters:
-            filter = BloomFilter(
-                capacity=self.initial_capacity,
-                error_rate=self.error_rate * (1.0 - self.ratio))
-            self.filters.append(filter)
+            filter = self._add_filter(self.initial_capacity,
+                                      self.error_rate * (1.0 - self.ratio))
         else:
             filter = self.filters[-1]
-            if filter.count >= filter.capacity:
-                filter = BloomFilter(
-                    capacity=filter.capacity * self.scale,
-                    error_rate=filter.error_rate * self.ratio)
-                self.filters.append(filter)
-        filter.add(key, skip_check=True)
+            if self._full(filter):
+                self._emit(CAPACITY_REACHED, capacity=filter.capacity,
+                           count=filter.count)
+                filter = self._add_filter(self._next_capacity(filter),
+                                          filter.error_rate * self.ratio)
+        self._insert(filter, filter.make_hashes(key))
         return False
 
+    def _insert(self, filter, hashes):
+        """Store a new key, of `hashes', in the last `filter', which add()
+        made sure is not full."""
+        filter._insert(hashes)
+
+    def _full(self, filter):
+        """Whether `filter' must not take more keys. In adaptive mode its
+        bits are only counted at checkpoints, halfway to the fill ratio
+        expected to reach its error rate."""
+        if not self.adaptive:
+            return filter.count >= filter.capacity
+        if filter.count < self._next_check:
+            return False
+        fill = filter.fill_ratio()
+        # Each key sets one bit per slice: the false positive rate is at
+        # most fill ** num_slices
+        threshold = filter.error_rate ** (1.0 / filter.num_slices)
+        if fill >= threshold:
+            return True
+        remaining = filter.bits_per_slice * math.log((1 - fill) / (1 - threshold))
+        self._next_check = filter.count + max(1, int(remaining // 2))
+        return False
+
+    def _next_capacity(self, filter):
+        """Capacity of the filter following the full `filter'."""
+        capacity = filter.capacity * self.scale
+        if not self.adaptive or self._level_start is None:
+            return capacity
+        now = self.clock()
+        elapsed = now - self._level_start
+        if elapsed <= 0:
+            return filter.capacity * self.scale ** 2
+        keys = filter.estimate_cardinality()
+        expected = int(keys / elapsed * (now - self._start))
+        return min(max(capacity, expected), filter.capacity * self.scale ** 2)
+
+    def _add_filter(self, capacity, error_rate):
+        if self.budget is not None:
+            num_slices, bits_per_slice = BloomFilter.geometry(capacity, error_rate)
+            self.budget.reserve(self, (num_slices * bits_per_slice + 7) // 8)
+        filter = BloomFilter(capacity=capacity, error_rate=error_rate,
+                             hash_cache=self.hash_cache, storage=self.storage)
+        self.filters.append(filter)
+        if self.adaptive:
+            self._next_check = 0
+            self._level_start = self.clock()
+            if self._start is None:
+                self._start = self._level_start
+        self._emit(FILTER_ADDED, filter=filter, capacity=capacity,
+                   error_rate=error_rate, nbytes=filter.storage.nbytes)
+        return filter
+
     @property
     def capacity(self):
         """Returns the total capacity for all filters in this SBF"""
         return sum([f.capacity for f in self.filters])
 
+    def _paired_levels(self, other):
+        """The filters of this SBF and `other', level by level. Levels
+        missing on one side are None."""
+        if self.initial_capacity != other.initial_capacity or \
+            self.error_rate != other.error_rate or self.scale != other.scale:
+            raise ValueError("Estimating the overlap of filters requires \
+both filters to have the same initial capacity, error rate and mode")
+        mine, theirs = list(self.filters), list(other.filters)
+        levels = max(len(mine), len(theirs))
+        mine += [None] * (levels - len(mine))
+        theirs += [None] * (levels - len(theirs))
+        return zip(mine, theirs)
+
+    def estimate_cardinality(self):
+        """Estimate the number of distinct keys added, level by level, from
+        the bits set.
+
+        >>> b = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        >>> for i in range(5000):
+        ...     _ = b.add(i)
+        >>> 4800 < b.estimate_cardinality() < 5200
+        True
+
+        """
+        return sum(f.estimate_cardinality() for f in self.filters)
+
+    def estimate_union_size(self, other):
+        """Estimate the number of distinct keys added to this SBF or
+        `other', grown from the same initial capacity, error rate and mode.
+        Levels are merged pairwise: a key stored in different levels of
+        the two SBFs counts twice."""
+        return sum((f if g is None else g).estimate_cardinality()
+                   if f is None or g is None else f.estimate_union_size(g)
+                   for f, g in self._paired_levels(other))
+
+    def estimate_intersection_size(self, other):
+        """Estimate the number of distinct keys added to both this SBF and
+        `other', level by level. A key stored in different levels of the
+        two SBFs, as when they received it after different numbers of
+        keys, is missed: the estimate is biased towards zero for SBFs
+        with different insertion histories. BloomFilters of the same
+        capacity and error rate do not have this limit."""
+        return sum(f.estimate_intersection_size(g)
+                   for f, g in self._paired_levels(other)
+                   if f is not None and g is not None)
+
+    def estimate_jaccard(self, other):
+        """Estimate the Jaccard similarity of the keys of this SBF and
+        `other'. Levels are paired as in estimate_intersection_size(), so
+        the estimate is biased towards zero when the shared keys landed
+        in different levels."""
+        union = self.estimate_union_size(other)
+        if not union:
+            return 0.0
+        return self.estimate_intersection_size(other) / union
+
     @property
     def count(self):
         return len(self)
 
     def tofile(self, f):
         """Serialize this ScalableBloomFilter into the file-object
-        `f'."""
+        `f'. Adaptive growth is not part of the format."""
         f.write(pack(self.FILE_FMT, self.scale, self.ratio,
                      self.initial_capacity, self.error_rate))
 
@@ -376,20 +770,25 @@ class ScalableBloomFilter(object):
             # their lengths.
             headerpos = f.tell()
             headerfmt = '<' + 'Q'*(len(self.filters))
-            f.write('.' * calcsize(headerfmt))
+            f.write(b'.' * calcsize(headerfmt))
             filter_sizes = []
             for filter in self.filters:
                 begin = f.tell()
                 filter.tofile(f)
                 filter_sizes.append(f.tell() - begin)
 
+            endpos = f.tell()
             f.seek(headerpos)
             f.write(pack(headerfmt, *filter_sizes))
+            f.seek(endpos)
 
     @classmethod
-    def fromfile(cls, f):
-        """Deserialize the ScalableBloomFilter in file object `f'."""
-        filter = cls()
+    def fromfile(cls, f, storage=None, adaptive=False):
+        """Deserialize the ScalableBloomFilter in file object `f', loading
+        the bits of its filters in `storage' backends. An SBF written
+        with adaptive growth must be restored with `adaptive': its levels
+        may hold more keys than their capacity."""
+        filter = cls(storage=storage, adaptive=adaptive)
         filter._setup(*unpack(cls.FILE_FMT, f.read(calcsize(cls.FILE_FMT))))
         nfilters, = unpack('<l', f.read(calcsize('<l')))
         if nfilters > 0:
@@ -397,7 +796,7 @@ class ScalableBloomFilter(object):
             bytes = f.read(calcsize(header_fmt))
             filter_lengths = unpack(header_fmt, bytes)
             for fl in filter_lengths:
-                filter.filters.append(BloomFilter.fromfile(f, fl))
+                filter.filters.append(BloomFilter.fromfile(f, fl, storage))
         else:
             filter.filters = []
 
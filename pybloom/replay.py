@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+#
+"""Replay a timestamped key stream through the time-decaying filters.
+
+Every structure sees the same events in simulated time and is compared
+against a HashFilter used as the exact ground truth. For each event the
+structure is asked whether the key was seen within the window, then the
+key is added. The report gives false positives/negatives, throughput and
+memory sampled over time.
+
+    python -m pybloom.replay --duration 600 --rate 500 --uniqueness 0.3 --skew 1.2
+    python -m pybloom.replay --trace events.csv --window-period 30_Sec
+
+Recorded traces are CSV files of `timestamp,key' lines.
+"""
+import sys
+import csv
+import time
+import argparse
+import numpy as np
+
+from .cdbf import CountdownBloomFilter, ScalableCountdownBloomFilter
+from .slidingwindow import SlidingWindowScalableBloomFilter, AgePartitionedBloomFilter, VALID_RES
+from .hashfilter import HashFilter
+
+
+class SimulatedClock(object):
+    '''
+    Clock advanced by the replay, passed to the sliding-window filters
+    '''
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def synthetic_trace(duration, rate, uniqueness=0.5, skew=1.2, start=0.0, seed=0):
+    '''
+    Generate (timestamp, key) events for `duration' seconds at `rate'
+    events per second on average (Poisson arrivals). Each event is a new
+    key with probability `uniqueness', otherwise a key seen before whose
+    popularity follows a Zipf law of exponent `skew' > 1, or is uniform
+    when skew is 0.
+    '''
+    if skew != 0 and skew <= 1:
+        raise ValueError("Skew must be 0 or > 1")
+    return _synthetic_events(duration, rate, uniqueness, skew, start, seed)
+
+
+def _synthetic_events(duration, rate, uniqueness, skew, start, seed):
+    random = np.random.RandomState(seed)
+    timestamp = start
+    num_keys = 0
+    while True:
+        timestamp += random.exponential(1.0 / rate)
+        if timestamp >= start + duration:
+            return
+        if not num_keys or random.random_sample() < uniqueness:
+            num_keys += 1
+            key = num_keys
+        elif skew:
+            # Redraw rather than clip, which would hand the whole tail
+            # of the law to the newest key
+            key = random.zipf(skew)
+            while key > num_keys:
+                key = random.zipf(skew)
+        else:
+            key = random.randint(1, num_keys + 1)
+        yield timestamp, str(key)
+
+
+def read_trace(f):
+    '''
+    Read (timestamp, key) events from a CSV file object
+    '''
+    for row in csv.reader(f):
+        if row:
+            yield float(row[0]), row[1]
+
+
+def default_structures(window_period, capacity, error_rate, clock):
+    '''
+    Build the structures under test for a window of `window_period'
+    ('<amount>_<Sec|Min|Hour|Day>') holding about `capacity' keys
+    '''
+    amount, res = window_period.split('_')
+    expiration = int(amount) * VALID_RES[res]
+    return [
+        ('CountdownBloomFilter',
+         CountdownBloomFilter(capacity, error_rate, expiration, disable_hard_capacity=True)),
+        ('ScalableCountdownBloomFilter',
+         ScalableCountdownBloomFilter(initial_capacity=max(capacity // 4, 1),
+                                      error_rate=error_rate, expiration=expiration)),
+        ('SlidingWindowScalableBloomFilter',
+         SlidingWindowScalableBloomFilter(initial_capacity=max(capacity // int(amount), 1),
+                                          window_period=window_period, clock=clock)),
+        ('AgePartitionedBloomFilter',
+         AgePartitionedBloomFilter(capacity=max(capacity // int(amount), 1),
+                                   window_period=window_period,
+                                   error_rate=error_rate, clock=clock)),
+    ]
+
+
+def memory_usage(structure):
+    '''
+    Bytes held by the bits or cells of `structure'
+    '''
+    if isinstance(structure, CountdownBloomFilter):
+        return structure.cellarray.nbytes
+    if isinstance(structure, SlidingWindowScalableBloomFilter):
+        return sum(f.storage.nbytes
+                   for window in structure.filters for f in window.filters)
+    if isinstance(structure, HashFilter):
+        if structure.key_size is not None:
+            return structure.unique_items.nbytes
+        return sys.getsizeof(structure.unique_items) + sum(
+            sys.getsizeof(key) for key in structure.unique_items)
+    return structure.nbytes
+
+
+class Result(object):
+    '''
+    Accuracy, throughput and memory of one structure over a replay
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.events = 0
+        self.false_positives = 0
+        self.false_negatives = 0
+        self.elapsed = 0.0
+        self.memory = []
+
+    @property
+    def throughput(self):
+        return self.events / self.elapsed if self.elapsed else float('inf')
+
+    def __repr__(self):
+        return '<Result %s fp=%d fn=%d>' % (self.name, self.false_positives,
+                                           self.false_negatives)
+
+
+def _check_and_add(structure, key):
+    if isinstance(structure, (CountdownBloomFilter, ScalableCountdownBloomFilter)):
+        seen = key in structure
+        structure.add(key)
+        return seen
+    return structure.add(key)
+
+
+def replay(trace, structures, truth, clock, maintenance_period=0.1, sample_period=None):
+    '''
+    Replay `trace' through `structures' (a list of (name, structure)),
+    checking their answers against the HashFilter `truth'. `clock' is the
+    SimulatedClock given to the structures. Countdown filters run their
+    maintenance every `maintenance_period' simulated seconds; memory is
+    sampled every `sample_period' seconds. Returns the truth's Result
+    followed by one Result per structure.
+    '''
+    results = [Result(name) for name, _ in structures]
+    truth_result = Result('HashFilter')
+    # Maintenance time left over, by level for scalable countdown filters
+    pending = [{} if isinstance(structure, ScalableCountdownBloomFilter) else 0.0
+               for _, structure in structures]
+    last_maintenance = last_sample = None
+    for timestamp, key in trace:
+        if last_maintenance is None:
+            last_maintenance = last_sample = timestamp
+        clock.now = timestamp
+        elapsed = timestamp - last_maintenance
+        if elapsed >= maintenance_period:
+            last_maintenance = timestamp
+            for i, (name, structure) in enumerate(structures):
+                if isinstance(structure, ScalableCountdownBloomFilter):
+                    # Levels have their own refresh periods: each one
+                    # carries its own leftover
+                    levels = list(structure.filters)
+                    elapsed_times = [pending[i].get(level, 0.0) + elapsed for level in levels]
+                    start = time.time()
+                    processed = structure.batched_expiration_maintenance(elapsed_times)
+                    results[i].elapsed += time.time() - start
+                    pending[i] = dict((level, t - p) for level, t, p
+                                      in zip(levels, elapsed_times, processed))
+                elif hasattr(structure, 'batched_expiration_maintenance'):
+                    pending[i] += elapsed
+                    start = time.time()
+                    processed = structure.batched_expiration_maintenance(pending[i])
+                    results[i].elapsed += time.time() - start
+                    pending[i] -= processed
+        if sample_period is not None and timestamp - last_sample >= sample_period:
+            last_sample = timestamp
+            truth_result.memory.append((timestamp, memory_usage(truth)))
+            for result, (name, structure) in zip(results, structures):
+                result.memory.append((timestamp, memory_usage(structure)))
+
+        start = time.time()
+        expected = truth.contains(key, timestamp)
+        truth.add(key, timestamp)
+        truth_result.elapsed += time.time() - start
+        truth_result.events += 1
+        for result, (name, structure) in zip(results, structures):
+            start = time.time()
+            seen = _check_and_add(structure, key)
+            result.elapsed += time.time() - start
+            result.events += 1
+            if seen and not expected:
+                result.false_positives += 1
+            elif expected and not seen:
+                result.false_negatives += 1
+    return [truth_result] + results
+
+
+def report(results, out=sys.stdout):
+    out.write('{:<34}{:>10}{:>10}{:>10}{:>10}{:>14}{:>14}\n'.format(
+        'structure', 'events', 'FP', 'FN', 'FP rate', 'events/s', 'peak bytes'))
+    for result in results:
+        peak = max([m for _, m in result.memory] or [0])
+        out.write('{:<34}{:>10}{:>10}{:>10}{:>10.4f}{:>14.0f}{:>14}\n'.format(
+            result.name, result.events, result.false_positives,
+            result.false_negatives,
+            result.false_positives / float(result.events or 1),
+            result.throughput, peak))
+    if results and results[0].memory:
+        out.write('\nmemory over time (bytes)\n')
+        out.write('{:>10}'.format('time') +
+                  ''.join('{:>34}'.format(r.name) for r in results) + '\n')
+        for samples in zip(*[r.memory for r in results]):
+            out.write('{:>10.1f}'.format(samples[0][0]) +
+                      ''.join('{:>34}'.format(m) for _, m in samples) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trace', help='CSV file of timestamp,key events')
+    parser.add_argument('--duration', type=float, default=120.0)
+    parser.add_argument('--rate', type=float, default=200.0)
+    parser.add_argument('--uniqueness', type=float, default=0.5)
+    parser.add_argument('--skew', type=float, default=1.2,
+                        help='Zipf exponent (> 1) of the repeated keys, 0 for uniform')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--window-period', default='30_Sec')
+    parser.add_argument('--capacity', type=int, default=None,
+                        help='keys per window (default: estimated from the rate)')
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--maintenance-period', type=float, default=0.1)
+    parser.add_argument('--sample-period', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    amount, res = args.window_period.split('_')
+    expiration = int(amount) * VALID_RES[res]
+    capacity = args.capacity or int(args.rate * expiration * 1.5)
+    clock = SimulatedClock()
+    structures = default_structures(args.window_period, capacity, args.error_rate, clock)
+    if args.trace:
+        with open(args.trace) as f:
+            results = replay(read_trace(f), structures, HashFilter(expiration), clock,
+                             maintenance_period=args.maintenance_period,
+                             sample_period=args.sample_period)
+    else:
+        trace = synthetic_trace(args.duration, args.rate, args.uniqueness,
+                                args.skew, seed=args.seed)
+        results = replay(trace, structures, HashFilter(expiration), clock,
+                         maintenance_period=args.maintenance_period,
+                         sample_period=args.sample_period)
+    report(results)
+
+if __name__ == '__main__' :
+    status = main()
+    sys.exit(status)
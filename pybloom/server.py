@@ -0,0 +1,455 @@
+'''
+Serve named filters to the processes of a host over a Unix or TCP socket
+
+Every request and response is a frame:
+
+    request   <BHI opcode, name length, payload length; name; payload
+    response  <BI  status, payload length; payload
+
+Batches of keys are a <I count followed by <I length-prefixed keys, and
+ADD/CONTAINS answer one byte per key. An ADD failing part-way answers
+AT_CAPACITY with a <I count and one byte for each key added before the
+failure, followed by the error message. Requests are answered in order,
+so a client may pipeline many of them before reading the responses.
+
+>>> import os, tempfile
+>>> from pybloom import ScalableBloomFilter
+>>> path = os.path.join(tempfile.mkdtemp(), 'filters.sock')
+>>> server = FilterServer(path, {'users': ScalableBloomFilter()}).start()
+>>> client = FilterClient(path)
+>>> client.add_many('users', ['alice', 'bob'])
+[False, False]
+>>> client.contains_many('users', ['alice', 'carol'])
+[True, False]
+>>> pipeline = client.pipeline()
+>>> pipeline.add('users', 'carol')
+>>> pipeline.count('users')
+>>> pipeline.execute()
+[False, 3]
+>>> client.close()
+>>> server.shutdown()
+'''
+import argparse
+import io
+import os
+import socket
+import sys
+import threading
+from struct import pack, unpack, unpack_from, calcsize
+
+try:
+    import socketserver
+    import queue
+except ImportError:
+    import SocketServer as socketserver
+    import Queue as queue
+
+from .compat import encode_key_bytes
+
+ADD = 1
+CONTAINS = 2
+COUNT = 3
+SNAPSHOT = 4
+NAMES = 5
+
+OK = 0
+ERROR = 1
+UNKNOWN_FILTER = 2
+AT_CAPACITY = 3
+
+REQUEST_FMT = '<BHI'
+RESPONSE_FMT = '<BI'
+REQUEST_SIZE = calcsize(REQUEST_FMT)
+RESPONSE_SIZE = calcsize(RESPONSE_FMT)
+
+
+def encode_keys(keys):
+    '''
+    Payload of a batch of keys, encoded as filters hash them
+    '''
+    keys = [encode_key_bytes(key) for key in keys]
+    parts = [pack('<I', len(keys))]
+    for key in keys:
+        parts.append(pack('<I', len(key)))
+        parts.append(key)
+    return b''.join(parts)
+
+
+def decode_keys(payload):
+    count, = unpack_from('<I', payload)
+    offset = 4
+    keys = []
+    for _ in range(count):
+        length, = unpack_from('<I', payload, offset)
+        offset += 4
+        keys.append(payload[offset:offset + length])
+        offset += length
+    return keys
+
+
+class CapacityError(IndexError):
+    '''
+    A filter reached its capacity during an add. `results' holds the
+    answers for the keys added before the failure, which stay in the
+    filter.
+    '''
+    def __init__(self, message, results=()):
+        super(CapacityError, self).__init__(message)
+        self.results = list(results)
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError('Connection closed')
+    return data
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.filter_server
+        while True:
+            header = self.rfile.read(REQUEST_SIZE)
+            if len(header) != REQUEST_SIZE:
+                # Closed by the client, possibly mid-frame
+                return
+            opcode, name_length, payload_length = unpack(REQUEST_FMT, header)
+            try:
+                name = _read_exact(self.rfile, name_length)
+                payload = _read_exact(self.rfile, payload_length)
+            except EOFError:
+                return
+            try:
+                name = name.decode('utf-8')
+            except UnicodeDecodeError:
+                status, response = ERROR, b'Filter name is not UTF-8'
+            else:
+                status, response = server.handle(opcode, name, payload)
+            self.wfile.write(pack(RESPONSE_FMT, status, len(response)) + response)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    _UnixServer = None
+
+
+class FilterServer(object):
+    '''
+    Serve `filters', a dict of filters by name, on `address': the path of
+    a Unix socket or a (host, port) tuple. Any filter with add() and
+    membership tests can be served; snapshots need tofile() and counts
+    len(). Each filter is used by one connection at a time.
+
+    The ticker thread of a CoarseClock runs outside these locks: it only
+    moves the cached time, which sliding window filters read, and act
+    on, within a request.
+    '''
+    def __init__(self, address, filters=None):
+        self.filters = {}
+        self._locks = {}
+        for name, filter in (filters or {}).items():
+            self.register(name, filter)
+        if isinstance(address, tuple):
+            self.server = _TCPServer(address, _Handler)
+        elif _UnixServer is None:
+            raise ValueError("Unix sockets are not available on this platform")
+        else:
+            self.server = _UnixServer(address, _Handler)
+        self.server.filter_server = self
+        self.address = self.server.server_address
+        self._thread = None
+
+    def register(self, name, filter):
+        self._locks[name] = threading.Lock()
+        self.filters[name] = filter
+
+    def handle(self, opcode, name, payload):
+        '''
+        Run one request, returning the status and payload of its response
+        '''
+        if opcode == NAMES:
+            return OK, '\n'.join(sorted(self.filters)).encode('utf-8')
+        if name not in self.filters:
+            return UNKNOWN_FILTER, name.encode('utf-8')
+        filter = self.filters[name]
+        try:
+            with self._locks[name]:
+                if opcode == ADD:
+                    response = bytearray()
+                    try:
+                        for key in decode_keys(payload):
+                            response.append(filter.add(key) and 1 or 0)
+                    except IndexError as e:
+                        message = str(e).encode('utf-8')
+                        return AT_CAPACITY, pack('<I', len(response)) + bytes(response) + message
+                elif opcode == CONTAINS:
+                    response = bytearray(key in filter and 1 or 0
+                                         for key in decode_keys(payload))
+                elif opcode == COUNT:
+                    response = pack('<Q', len(filter))
+                elif opcode == SNAPSHOT:
+                    f = io.BytesIO()
+                    filter.tofile(f)
+                    response = f.getvalue()
+                else:
+                    return ERROR, ('Unknown opcode %d' % opcode).encode('utf-8')
+        except Exception as e:
+            return ERROR, ('%s: %s' % (type(e).__name__, e)).encode('utf-8')
+        return OK, bytes(response)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        '''
+        Serve from a daemon thread. Returns the server.
+        '''
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server.server_close()
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class _Connection(object):
+    def __init__(self, address, timeout):
+        if isinstance(address, tuple):
+            family = socket.AF_INET
+        elif hasattr(socket, 'AF_UNIX'):
+            family = socket.AF_UNIX
+        else:
+            raise ValueError("Unix sockets are not available on this platform")
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(address)
+        self.rfile = self.socket.makefile('rb')
+
+    def call(self, requests):
+        '''
+        Send the (opcode, name, payload) `requests' at once and read their
+        (status, payload) responses
+        '''
+        frames = []
+        for opcode, name, payload in requests:
+            name = name.encode('utf-8')
+            frames.append(pack(REQUEST_FMT, opcode, len(name), len(payload)))
+            frames.append(name)
+            frames.append(payload)
+        data = b''.join(frames)
+        writer = None
+        if len(requests) > 1:
+            # Responses are read while a pipeline is sent, so that neither
+            # side blocks on a full socket buffer
+            writer = threading.Thread(target=self.socket.sendall, args=(data,))
+            writer.daemon = True
+            writer.start()
+        else:
+            self.socket.sendall(data)
+        responses = []
+        for _ in requests:
+            status, length = unpack(RESPONSE_FMT, _read_exact(self.rfile, RESPONSE_SIZE))
+            responses.append((status, _read_exact(self.rfile, length)))
+        if writer is not None:
+            writer.join()
+        return responses
+
+    def close(self):
+        self.rfile.close()
+        self.socket.close()
+
+
+def _bools(payload):
+    return [bool(b) for b in bytearray(payload)]
+
+
+def _count(payload):
+    return unpack('<Q', payload)[0]
+
+
+def _names(payload):
+    return payload.decode('utf-8').split('\n') if payload else []
+
+
+def _raw(payload):
+    return payload
+
+
+class FilterClient(object):
+    '''
+    Client of a FilterServer at `address'. Up to `pool_size' idle
+    connections are kept for reuse, so that a client can be shared by
+    threads.
+    '''
+    def __init__(self, address, pool_size=4, timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self._pool = queue.Queue(pool_size)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return _Connection(self.address, self.timeout)
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def execute(self, requests):
+        '''
+        Pipeline the (opcode, name, payload, decode) `requests' on one
+        connection and return their decoded results. Raises the error of
+        the first failed request once every response has been read.
+        '''
+        connection = self._acquire()
+        try:
+            responses = connection.call([request[:3] for request in requests])
+        except Exception:
+            connection.close()
+            raise
+        self._release(connection)
+        results = []
+        for (opcode, name, _, decode), (status, payload) in zip(requests, responses):
+            if status == UNKNOWN_FILTER:
+                raise KeyError(name)
+            if status == AT_CAPACITY:
+                count, = unpack_from('<I', payload)
+                raise CapacityError(payload[4 + count:].decode('utf-8'),
+                                    _bools(payload[4:4 + count]))
+            if status != OK:
+                raise ValueError(payload.decode('utf-8'))
+            results.append(decode(payload))
+        return results
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def add(self, name, key):
+        return self.add_many(name, [key])[0]
+
+    def add_many(self, name, keys):
+        '''
+        Add `keys' to `name'. Raises CapacityError, holding the results of
+        the keys added before, when the filter fills up.
+        '''
+        return self.execute([(ADD, name, encode_keys(keys), _bools)])[0]
+
+    def contains(self, name, key):
+        return self.contains_many(name, [key])[0]
+
+    def contains_many(self, name, keys):
+        return self.execute([(CONTAINS, name, encode_keys(keys), _bools)])[0]
+
+    def count(self, name):
+        return self.execute([(COUNT, name, b'', _count)])[0]
+
+    def names(self):
+        return self.execute([(NAMES, '', b'', _names)])[0]
+
+    def snapshot(self, name, f=None):
+        '''
+        Serialized `name', as written by its tofile(), into the file
+        object `f' or returned
+        '''
+        data = self.execute([(SNAPSHOT, name, b'', _raw)])[0]
+        if f is None:
+            return data
+        f.write(data)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Pipeline(object):
+    '''
+    Requests queued to be sent at once by execute(), which returns their
+    results in order
+    '''
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, name, key):
+        self.requests.append((ADD, name, encode_keys([key]), lambda p: _bools(p)[0]))
+
+    def add_many(self, name, keys):
+        self.requests.append((ADD, name, encode_keys(keys), _bools))
+
+    def contains(self, name, key):
+        self.requests.append((CONTAINS, name, encode_keys([key]), lambda p: _bools(p)[0]))
+
+    def contains_many(self, name, keys):
+        self.requests.append((CONTAINS, name, encode_keys(keys), _bools))
+
+    def count(self, name):
+        self.requests.append((COUNT, name, b'', _count))
+
+    def execute(self):
+        requests, self.requests = self.requests, []
+        if not requests:
+            return []
+        return self.client.execute(requests)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('address', help='Unix socket path, or host:port')
+    parser.add_argument('--filter', action='append', default=[], metavar='NAME',
+                        help='serve a new ScalableBloomFilter')
+    parser.add_argument('--load', action='append', default=[], metavar='NAME=FILE',
+                        help='serve a ScalableBloomFilter snapshot')
+    parser.add_argument('--error-rate', type=float, default=0.001)
+    args = parser.parse_args(argv)
+
+    from .pybloom import ScalableBloomFilter
+    filters = dict((name, ScalableBloomFilter(error_rate=args.error_rate))
+                   for name in args.filter)
+    for spec in args.load:
+        name, path = spec.split('=', 1)
+        with open(path, 'rb') as f:
+            filters[name] = ScalableBloomFilter.fromfile(f)
+    address = args.address
+    if ':' in address and os.path.sep not in address:
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+    server = FilterServer(address, filters)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__' :
+    status = main()
+    sys.exit(status)
@@ -1,9 +1,9 @@
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Distutils import build_ext
-import numpy
 
 setup(
     cmdclass = {'build_ext': build_ext},
-    ext_modules = [Extension("maintenance", ["maintenance.pyx"], include_dirs=[numpy.get_include()]),]
+    ext_modules = [Extension("maintenance", ["maintenance.pyx"]),
+                   Extension("_core", ["_core.pyx"]),]
 )
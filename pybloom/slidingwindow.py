@@ -1,21 +1,87 @@
+import math
 import time
+import threading
+
+import bitarray
 
 from collections import deque
-from pybloom import ScalableBloomFilter
+from struct import unpack, pack, calcsize
+from .pybloom import ScalableBloomFilter, make_hashfuncs
+from .events import Observable, WINDOW_ROTATED
 
 VALID_RES = {'Sec': 1,
              'Min': 60,
              'Hour': 3600,
              'Day': 86400}
+RES_NAMES = dict((seconds, res) for res, seconds in VALID_RES.items())
+
+class CoarseClock(object):
+    '''
+    Cached timestamp read from `source' (time.time by default). Reading
+    the clock returns the cached value, which only moves on tick(), or
+    every `interval' seconds once start() has been called.
+
+    The ticker thread only moves the timestamp: filters reading the clock
+    drop what expired on their next lookup or add.
+    '''
+    def __init__(self, source=None):
+        self.source = source or time.time
+        self.now = self.source()
+        self._ticker = None
+
+    def __call__(self):
+        return self.now
+
+    def tick(self):
+        self.now = self.source()
+        return self.now
+
+    def start(self, interval=1.0):
+        '''
+        Refresh the cached timestamp from a daemon thread, replacing the
+        one of a previous start()
+        '''
+        self.stop()
+        stopped = threading.Event()
+        def run():
+            while not stopped.wait(interval):
+                self.tick()
+        self._ticker = stopped
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._ticker is not None:
+            self._ticker.set()
+            self._ticker = None
+
+    @property
+    def running(self):
+        return self._ticker is not None
+
+    def refresh(self):
+        '''
+        The current time: the cached one while the ticker runs, else a
+        fresh one from tick()
+        '''
+        return self.now if self._ticker is not None else self.tick()
+
 
 class DecayScalableBloomFilter(ScalableBloomFilter):
     '''
     Stepwise decaying Bloom Filter
+
+    `clock' is a callable returning the current time, time.time by default.
     '''
-    def __init__(self, initial_capacity=1000, error_rate=0.01, window_period = '10_Min'):
+    WINDOW_FMT = '<dQQ'
+    # (file, position) of filters not read yet by a lazy fromfile()
+    _pending = None
+    def __init__(self, initial_capacity=1000, error_rate=0.01, window_period = '10_Min', clock=None):
         super(DecayScalableBloomFilter, self).__init__(initial_capacity, error_rate)
+        self.clock = clock or time.time
         self.window_period = 60
-        self.timestamp = time.time()
+        self.timestamp = self.clock()
         self._setup_window_period(window_period)
         self._expired = False
         self._locked = False
@@ -30,15 +96,25 @@ class DecayScalableBloomFilter(ScalableBloomFilter):
                     return True
         return False
 
+    @property
+    def filters(self):
+        if self._pending is not None:
+            self._load()
+        return self._filters
+
+    @filters.setter
+    def filters(self, filters):
+        self._filters = filters
+
     @property
     def expired(self):
-        if time.time() - self.timestamp > self.expiration:
+        if self.clock() - self.timestamp > self.expiration:
             self._expired = True
         return self._expired
 
     @property
     def locked(self):
-        if time.time() - self.timestamp > self.window_period:
+        if self.clock() - self.timestamp > self.window_period:
             self._locked = True
         return self._locked
 
@@ -52,15 +128,93 @@ class DecayScalableBloomFilter(ScalableBloomFilter):
         self.expiration = self.amount * VALID_RES[self.res]
         self.filters = deque(maxlen = self.amount)
 
+    def recycle(self, initial_capacity=None):
+        '''
+        Reuse this filter for a new window. The bits of the first filter
+        are cleared in place when the capacity is unchanged, the other
+        filters are released.
+        '''
+        if initial_capacity is None:
+            initial_capacity = self.initial_capacity
+        # Filters of a lazily restored window are dropped unread
+        self._pending = None
+        first = None
+        if self.filters and initial_capacity == self.initial_capacity:
+            first = self.filters[0]
+            first.storage.clear()
+            first.count = 0
+        self.initial_capacity = initial_capacity
+        self.filters.clear()
+        if first is not None:
+            self.filters.append(first)
+        self.timestamp = self.clock()
+        self._expired = False
+        self._locked = False
+
+    def tofile(self, f):
+        """Serialize this DecayScalableBloomFilter, its timestamp and
+        window period included, into the file-object `f'."""
+        f.write(pack(self.WINDOW_FMT, self.timestamp, self.amount,
+                     VALID_RES[self.res]))
+        super(DecayScalableBloomFilter, self).tofile(f)
+
+    @classmethod
+    def fromfile(cls, f, clock=None, lazy=False):
+        """Deserialize the DecayScalableBloomFilter in file object `f'.
+        With `lazy' its filters are only read from `f', which must stay
+        open, on first use."""
+        timestamp, amount, resolution = unpack(
+            cls.WINDOW_FMT, f.read(calcsize(cls.WINDOW_FMT)))
+        filter = cls(window_period='%d_%s' % (amount, RES_NAMES[resolution]),
+                     clock=clock)
+        filter.timestamp = timestamp
+        filter._pending = (f, f.tell())
+        if not lazy:
+            filter._load()
+        return filter
+
+    def _load(self):
+        f, position = self._pending
+        self._pending = None
+        f.seek(position)
+        sbf = ScalableBloomFilter.fromfile(f)
+        self._setup(sbf.scale, sbf.ratio, sbf.initial_capacity, sbf.error_rate)
+        self._filters.extend(sbf.filters)
+
 
-class SlidingWindowScalableBloomFilter(object):
+class SlidingWindowScalableBloomFilter(Observable):
     '''
     Sliding Window Bloom Filter using a coarse expiration
+
+    Window filters live in a fixed ring and are recycled in place when the
+    window rotates. Each new window is sized from the cardinality of the
+    previous one, rounded up to a power of two times initial_capacity so
+    that similar windows reuse the same bits.
+
+    Time is read from a CoarseClock, refreshed once per add() unless its
+    ticker runs, or by tick(). Expired windows are dropped whenever a
+    lookup or add sees the time move. `clock' may be a CoarseClock or a
+    callable used as its time source.
+
+    Callbacks subscribed to this filter also receive the events of its
+    window filters, which share them.
     '''
 
-    def __init__(self, initial_capacity=1000, window_period = "10_Min"):
+    FILE_FMT = '<QdQQQ'
+    INDEX_FMT = '<dQQ'
+    # MemoryBudget this filter is registered with
+    budget = None
+    _transient = ('_listeners', 'budget')
+    # Time of the last pruning
+    _now = None
+
+    def __init__(self, initial_capacity=1000, window_period = "10_Min", clock=None):
         self.initial_capacity = initial_capacity
         self.error_rate = 0.01
+        if not isinstance(clock, CoarseClock):
+            clock = CoarseClock(clock)
+        self.clock = clock
+        self._listeners = {}
         self._setup_window_period(window_period)
 
     def _setup_window_period(self, window_period):
@@ -70,10 +224,45 @@ class SlidingWindowScalableBloomFilter(object):
         except ValueError:
             raise Exception('Invalid window period')
         self.window_period = self.amount * VALID_RES[self.res]
+        self.ring = [DecayScalableBloomFilter(initial_capacity=self.initial_capacity,
+                                              error_rate=self.error_rate,
+                                              window_period="%s_%s" % (str(self.amount),self.res),
+                                              clock=self.clock)
+                     for _ in range(self.amount)]
+        for window in self.ring:
+            window._listeners = self._listeners
+        self.head = -1
         self._reset_filters()
 
     def _reset_filters(self):
-        self.filters = deque(maxlen = self.amount)
+        self.size = 0
+
+    @property
+    def filters(self):
+        '''
+        The live window filters, oldest first
+        '''
+        return [self.ring[(self.head - i) % self.amount]
+                for i in reversed(range(self.size))]
+
+    def _window_capacity(self, cardinality):
+        capacity = self.initial_capacity
+        while capacity < cardinality:
+            capacity *= 2
+        return capacity
+
+    def _rotate(self):
+        '''
+        Recycle the oldest ring slot as the newest window filter
+        '''
+        cardinality = len(self.ring[self.head]) if self.head >= 0 else 0
+        self.head = (self.head + 1) % self.amount
+        filter = self.ring[self.head]
+        filter.recycle(self._window_capacity(cardinality))
+        self.size = min(self.size + 1, self.amount)
+        self._emit(WINDOW_ROTATED, window=filter,
+                   capacity=filter.initial_capacity, previous=cardinality)
+        return filter
 
     def total_error(self):
         '''
@@ -84,20 +273,116 @@ class SlidingWindowScalableBloomFilter(object):
         return total_error
 
     def __contains__(self, key):
-        for f in reversed(self.filters):
-            if key in f:
+        # Expired windows are pruned once per clock move, skip the
+        # per-window check
+        self._advance(self.clock())
+        for i in range(self.size):
+            if ScalableBloomFilter.__contains__(self.ring[(self.head - i) % self.amount], key):
                 return True
         return False
 
+    def _advance(self, now):
+        '''
+        Prune the expired windows when the clock moved to `now'
+        '''
+        if now != self._now:
+            self._now = now
+            self._prune()
+
+    def _prune(self):
+        '''
+        Drop the expired windows, oldest first
+        '''
+        while self.size and self.ring[(self.head - self.size + 1) % self.amount].expired:
+            self.size -= 1
+
+    def evict_oldest(self):
+        '''
+        Drop the oldest live window before it expires, releasing its
+        filters. Returns the window, or None without live windows.
+        '''
+        if not self.size:
+            return None
+        window = self.ring[(self.head - self.size + 1) % self.amount]
+        self.size -= 1
+        window._pending = None
+        window.filters.clear()
+        return window
+
+    def release_expired(self):
+        '''
+        Release the filters of the ring slots without a live window, kept
+        until then to be recycled in place
+        '''
+        self._prune()
+        live = self.filters
+        for window in self.ring:
+            if not any(window is w for w in live):
+                window._pending = None
+                window.filters.clear()
+
+    def tick(self):
+        '''
+        Refresh the clock and prune the expired windows
+        '''
+        self.clock.tick()
+        self._prune()
+
     def check_expiration(self):
-        filter = self.filters[0]
-        if filter.expired:
-            filter = DecayScalableBloomFilter(initial_capacity=self.initial_capacity,
-                                              error_rate=self.error_rate,
-                                              window_period="%s_%s" % (str(self.amount),self.res))
-            self.filters.append(filter)
+        self.tick()
+
+    def tofile(self, f):
+        """Snapshot this filter into the file-object `f'. The live
+        windows are written oldest first, after an index of their
+        timestamps and positions."""
+        start = f.tell()
+        filters = self.filters
+        f.write(pack(self.FILE_FMT, self.initial_capacity, self.error_rate,
+                     self.amount, VALID_RES[self.res], len(filters)))
+        indexpos = f.tell()
+        f.write(b'.' * calcsize(self.INDEX_FMT) * len(filters))
+        index = []
+        for filter in filters:
+            begin = f.tell()
+            filter.tofile(f)
+            index.append((filter.timestamp, begin - start, f.tell() - begin))
+        endpos = f.tell()
+        f.seek(indexpos)
+        for entry in index:
+            f.write(pack(self.INDEX_FMT, *entry))
+        f.seek(endpos)
+
+    @classmethod
+    def fromfile(cls, f, clock=None, lazy=False):
+        """Restore a snapshot written by tofile() from file object `f'.
+        Windows expired since the snapshot are skipped without being
+        read. With `lazy' the other windows are only read on first use,
+        and `f' must stay open."""
+        start = f.tell()
+        initial_capacity, error_rate, amount, resolution, size = unpack(
+            cls.FILE_FMT, f.read(calcsize(cls.FILE_FMT)))
+        index = [unpack(cls.INDEX_FMT, f.read(calcsize(cls.INDEX_FMT)))
+                 for _ in range(size)]
+        filter = cls(initial_capacity=initial_capacity,
+                     window_period='%d_%s' % (amount, RES_NAMES[resolution]),
+                     clock=clock)
+        filter.error_rate = error_rate
+        now = filter.clock()
+        for timestamp, offset, length in index:
+            if now - timestamp > amount * resolution:
+                continue
+            f.seek(start + offset)
+            window = DecayScalableBloomFilter.fromfile(f, clock=filter.clock, lazy=lazy)
+            window._listeners = filter._listeners
+            filter.head += 1
+            filter.ring[filter.head] = window
+            filter.size += 1
+        if index:
+            f.seek(start + index[-1][1] + index[-1][2])
+        return filter
 
     def add(self, key):
+        self._advance(self.clock.refresh())
         if key in self:
             '''
             Here we return True because one of the BF contains the key
@@ -107,24 +392,149 @@ class SlidingWindowScalableBloomFilter(object):
             in a day in the same as the whole month. In this case the month's BF will consume 30X more
             memory than a plain BF containing the same number of uniques .
             '''
-            filter = self.filters[-1]
+            filter = self.ring[self.head]
             filter.add(key)
             return True
-        if not self.filters:
-            filter = DecayScalableBloomFilter(initial_capacity=self.initial_capacity,
-                                              error_rate=self.error_rate,
-                                              window_period="%s_%s" % (str(self.amount),self.res))
-            self.filters.append(filter)
+        if not self.size:
+            filter = self._rotate()
         else:
-            filter = self.filters[-1]
+            filter = self.ring[self.head]
             if filter.locked:
-                if filter.expired:
-                    self._reset_filters()
-                filter = DecayScalableBloomFilter(initial_capacity=self.initial_capacity,
-                                              error_rate=self.error_rate,
-                                              window_period="%s_%s" % (str(self.amount),self.res))
-                self.filters.append(filter)
+                filter = self._rotate()
 
         filter.add(key)
         return False
 
+
+class AgePartitionedBloomFilter(object):
+    '''
+    Sliding Window Bloom Filter kept in a single bitarray
+
+    The bitarray is split in k + l slices used as a circular buffer, with
+    l + 1 generations per window (one per window resolution). A key is set
+    in the k newest slices and is present when k consecutive slices hold
+    it. Each generation the oldest slice is cleared and becomes the newest
+    one, so lookups probe at most k + l slices and a repeated key never
+    takes more memory.
+
+    A generation that goes over `capacity' keys is closed early, which
+    shortens the window instead of degrading the error rate.
+
+    Lookups and adds start the generations elapsed by the CoarseClock,
+    which add() refreshes unless its ticker runs.
+
+    Shtul, Ariel, Carlos Baquero, and Paulo Sergio Almeida. "Age-Partitioned Bloom Filters."
+    arXiv preprint arXiv:2001.03147 (2020).
+    '''
+
+    def __init__(self, capacity=1000, window_period="10_Min", error_rate=0.01, clock=None):
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        if not isinstance(clock, CoarseClock):
+            clock = CoarseClock(clock)
+        self.clock = clock
+        self._setup_window_period(window_period)
+        # Any of the l + 1 runs of k consecutive slices can match, each
+        # with a 2 ** -k chance when slices are half full.
+        self.generations = self.amount
+        self.num_hashes = int(math.ceil(math.log(self.generations / error_rate, 2)))
+        self.num_slices = self.num_hashes + self.generations - 1
+        # A slice stays among the k newest ones for k generations
+        self.bits_per_slice = int(math.ceil(
+            self.num_hashes * capacity / math.log(2)))
+        self.num_bits = self.num_slices * self.bits_per_slice
+        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice)
+        self.bitarray = bitarray.bitarray(self.num_bits, endian='little')
+        self.bitarray.setall(False)
+        # Physical slice holding the newest generation
+        self.head = 0
+        self.counts = deque([0], maxlen=self.generations)
+        self.timestamp = self.clock()
+
+    def _setup_window_period(self, window_period):
+        try:
+            self.amount, self.res = window_period.split('_')
+            self.amount = int(self.amount)
+        except ValueError:
+            raise Exception('Invalid window period')
+        self.generation_period = VALID_RES[self.res]
+        self.window_period = self.amount * VALID_RES[self.res]
+
+    @property
+    def count(self):
+        return self.counts[-1]
+
+    @property
+    def nbytes(self):
+        return self.bitarray.buffer_info()[1]
+
+    def __len__(self):
+        """Returns the number of keys added in the current window"""
+        return sum(self.counts)
+
+    def _shift(self, generations=1):
+        '''
+        Start `generations' new generations, clearing the oldest slices
+        '''
+        for _ in range(min(generations, self.num_slices)):
+            self.head = (self.head - 1) % self.num_slices
+            start = self.head * self.bits_per_slice
+            self.bitarray[start:start + self.bits_per_slice] = False
+        for _ in range(min(generations, self.generations)):
+            self.counts.append(0)
+
+    def _advance(self, now):
+        '''
+        Start the generations elapsed until `now'
+        '''
+        elapsed = int((now - self.timestamp) // self.generation_period)
+        if elapsed > 0:
+            self._shift(elapsed)
+            self.timestamp += elapsed * self.generation_period
+
+    def tick(self):
+        '''
+        Refresh the clock and start the generations elapsed since
+        '''
+        self._advance(self.clock.tick())
+
+    def __contains__(self, key):
+        self._advance(self.clock())
+        if not isinstance(key, list):
+            hashes = self.make_hashes(key)
+        else:
+            hashes = key
+        bitarray = self.bitarray
+        bits_per_slice = self.bits_per_slice
+        k = self.num_hashes
+        run = 0
+        for age in range(self.num_slices):
+            if run + self.num_slices - age < k:
+                break
+            position = (self.head + age) % self.num_slices
+            if bitarray[position * bits_per_slice + hashes[position]]:
+                run += 1
+                if run == k:
+                    return True
+            else:
+                run = 0
+        return False
+
+    def add(self, key):
+        self._advance(self.clock.refresh())
+        hashes = self.make_hashes(key)
+        existing = hashes in self
+        if not existing and self.count >= self.capacity:
+            self._shift()
+            self.timestamp = self.clock()
+        for age in range(self.num_hashes):
+            position = (self.head + age) % self.num_slices
+            self.bitarray[position * self.bits_per_slice + hashes[position]] = True
+        if existing:
+            return True
+        self.counts[-1] += 1
+        return False
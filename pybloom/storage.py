@@ -0,0 +1,205 @@
+'''
+Bit storage backends for BloomFilter
+
+A backend holds `num_bits' bits addressed like a little-endian bitarray:
+bit i is bit (i & 7) of byte (i >> 3) of its buffer. Filters are given a
+backend factory, called with the number of bits of each filter it builds:
+the backend class itself, or any callable such as
+MmapStorage.in_directory(path).
+'''
+import bitarray
+try:
+    from bitarray.util import count_and, count_or
+except ImportError:
+    count_and = count_or = None
+
+
+class BitStorage(object):
+    '''
+    Interface of the bit storage backends
+    '''
+    # False when the bits live in a file mapping rather than process memory
+    in_memory = True
+
+    def get(self, index):
+        raise NotImplementedError
+
+    def set(self, index, value=True):
+        raise NotImplementedError
+
+    def get_many(self, indexes):
+        '''
+        Values of the bits at `indexes', as a sequence of bools
+        '''
+        return [self.get(index) for index in indexes]
+
+    def set_many(self, indexes):
+        '''
+        Set the bits at `indexes'
+        '''
+        for index in indexes:
+            self.set(index)
+
+    def count(self):
+        '''
+        Number of bits set (popcount)
+        '''
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def buffer(self):
+        '''
+        Writable object exporting the raw bytes through the buffer
+        protocol, at least ceil(num_bits / 8) of them
+        '''
+        raise NotImplementedError
+
+    def tobytes(self):
+        '''
+        The ceil(num_bits / 8) bytes of the bits, as written by
+        bitarray.tofile()
+        '''
+        return bytes(memoryview(self.buffer())[:(self.num_bits + 7) // 8])
+
+    def load(self, data):
+        '''
+        Replace the bits with the bytes `data', as returned by tobytes()
+        '''
+        raise NotImplementedError
+
+    def copy(self):
+        raise NotImplementedError
+
+    def union(self, other):
+        '''
+        New storage of the same kind holding self OR other
+        '''
+        result = self.copy()
+        result.load(bytes(bytearray(a | b for a, b in zip(
+            bytearray(self.tobytes()), bytearray(other.tobytes())))))
+        return result
+
+    def intersection(self, other):
+        '''
+        New storage of the same kind holding self AND other
+        '''
+        result = self.copy()
+        result.load(bytes(bytearray(a & b for a, b in zip(
+            bytearray(self.tobytes()), bytearray(other.tobytes())))))
+        return result
+
+    def count_or(self, other):
+        '''
+        Number of bits set in self OR other
+        '''
+        return self.union(other).count()
+
+    def count_and(self, other):
+        '''
+        Number of bits set in self AND other
+        '''
+        return self.intersection(other).count()
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __eq__(self, other):
+        return (isinstance(other, BitStorage) and self.num_bits == other.num_bits
+                and self.tobytes() == other.tobytes())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def tofile(self, f):
+        f.write(self.tobytes())
+
+    @property
+    def nbytes(self):
+        '''
+        Bytes of memory held by the bits
+        '''
+        raise NotImplementedError
+
+
+class BitarrayStorage(BitStorage):
+    '''
+    In-memory bitarray, the default backend
+    '''
+    def __init__(self, num_bits, bits=None):
+        self.num_bits = num_bits
+        if bits is None:
+            bits = bitarray.bitarray(num_bits, endian='little')
+            bits.setall(False)
+        self.bits = bits
+
+    def get(self, index):
+        return self.bits[index]
+
+    def set(self, index, value=True):
+        self.bits[index] = value
+
+    def get_many(self, indexes):
+        bits = self.bits
+        return [bits[index] for index in indexes]
+
+    def set_many(self, indexes):
+        bits = self.bits
+        for index in indexes:
+            bits[index] = True
+
+    def count(self):
+        return self.bits.count(True)
+
+    def clear(self):
+        self.bits.setall(False)
+
+    def buffer(self):
+        return self.bits
+
+    def tobytes(self):
+        return self.bits.tobytes()
+
+    def load(self, data):
+        bits = bitarray.bitarray(endian='little')
+        bits.frombytes(data)
+        self.bits = bits[:self.num_bits]
+
+    def copy(self):
+        return BitarrayStorage(self.num_bits, self.bits.copy())
+
+    def _bits_of(self, other):
+        if isinstance(other, BitarrayStorage) and len(other.bits) == len(self.bits):
+            return other.bits
+        bits = bitarray.bitarray(endian='little')
+        bits.frombytes(other.tobytes())
+        return bits[:len(self.bits)]
+
+    def union(self, other):
+        return BitarrayStorage(self.num_bits, self.bits | self._bits_of(other))
+
+    def intersection(self, other):
+        return BitarrayStorage(self.num_bits, self.bits & self._bits_of(other))
+
+    def count_or(self, other):
+        if count_or is None:
+            return (self.bits | self._bits_of(other)).count(True)
+        return count_or(self.bits, self._bits_of(other))
+
+    def count_and(self, other):
+        if count_and is None:
+            return (self.bits & self._bits_of(other)).count(True)
+        return count_and(self.bits, self._bits_of(other))
+
+    def tofile(self, f):
+        self.bits.tofile(f)
+
+    @property
+    def nbytes(self):
+        return self.bits.buffer_info()[1]
@@ -1,15 +1,27 @@
+from __future__ import absolute_import
 import os
+import sys
 import doctest
+import io
+import subprocess
 import unittest
 import random
 import tempfile
-from pybloom import BloomFilter, ScalableBloomFilter
+from pybloom import BloomFilter, ScalableBloomFilter, HashCache
+import pybloom.pybloom
+from pybloom.pybloom import make_hashfuncs
+from pybloom.hyperloglog import HyperLogLog
+from pybloom import events
 from unittest import TestSuite
 
 def additional_tests():
     proj_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     readme_fn = os.path.join(proj_dir, 'README.txt')
-    suite = TestSuite([doctest.DocTestSuite('pybloom.pybloom')])
+    suite = TestSuite([doctest.DocTestSuite('pybloom.pybloom'),
+                       doctest.DocTestSuite('pybloom.events'),
+                       doctest.DocTestSuite('pybloom.budget'),
+                       doctest.DocTestSuite('pybloom.server'),
+                       doctest.DocTestSuite('pybloom.wal')])
     if os.path.exists(readme_fn):
         suite.addTest(doctest.DocFileSuite(readme_fn, module_relative=False))
     return suite
@@ -19,13 +31,13 @@ class TestUnionIntersection(unittest.TestCase):
         bloom_one = BloomFilter(100, 0.001)
         bloom_two = BloomFilter(100, 0.001)
         chars = [chr(i) for i in range(97, 123)]
-        for char in chars[len(chars)/2:]:
+        for char in chars[len(chars)//2:]:
             bloom_one.add(char)
-        for char in chars[:len(chars)/2]:
+        for char in chars[:len(chars)//2]:
             bloom_two.add(char)
         new_bloom = bloom_one.union(bloom_two)
         for char in chars:
-            self.assert_(char in new_bloom)
+            self.assertTrue(char in new_bloom)
 
     def test_intersection(self):
         bloom_one = BloomFilter(100, 0.001)
@@ -33,13 +45,13 @@ class TestUnionIntersection(unittest.TestCase):
         chars = [chr(i) for i in range(97, 123)]
         for char in chars:
             bloom_one.add(char)
-        for char in chars[:len(chars)/2]:
+        for char in chars[:len(chars)//2]:
             bloom_two.add(char)
         new_bloom = bloom_one.intersection(bloom_two)
-        for char in chars[:len(chars)/2]:
-            self.assert_(char in new_bloom)
-        for char in chars[len(chars)/2:]:
-            self.assert_(char not in new_bloom)
+        for char in chars[:len(chars)//2]:
+            self.assertTrue(char in new_bloom)
+        for char in chars[len(chars)//2:]:
+            self.assertTrue(char not in new_bloom)
 
     def test_intersection_capacity_fail(self):
         bloom_one = BloomFilter(1000, 0.001)
@@ -69,9 +81,327 @@ class TestUnionIntersection(unittest.TestCase):
             new_bloom = bloom_one.union(bloom_two)
         self.assertRaises(ValueError, _run)
 
+class TestEstimators(unittest.TestCase):
+    def filled(self, keys, capacity=20000):
+        bloom = BloomFilter(capacity, 0.01)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def assertClose(self, estimate, expected, tolerance=0.03):
+        self.assertTrue(abs(estimate - expected) <= tolerance * expected + 1,
+                        (estimate, expected))
+
+    def test_cardinality(self):
+        for n in (0, 100, 5000, 15000):
+            self.assertClose(self.filled(range(n)).estimate_cardinality(), n)
+
+    def test_copy(self):
+        bloom = self.filled(range(1000))
+        copy = bloom.copy()
+        self.assertEqual(len(copy), len(bloom))
+        self.assertEqual(copy.estimate_cardinality(), bloom.estimate_cardinality())
+
+    def test_overlap(self):
+        a = self.filled(range(0, 8000))
+        b = self.filled(range(6000, 12000))
+        self.assertClose(a.estimate_union_size(b), 12000)
+        self.assertClose(a.estimate_intersection_size(b), 2000, 0.15)
+        self.assertClose(a.estimate_jaccard(b), 2000 / 12000.0, 0.15)
+        self.assertClose((a | b).estimate_cardinality(), a.estimate_union_size(b), 0)
+        self.assertEqual(a.estimate_jaccard(a), 1.0)
+        empty = self.filled([])
+        self.assertEqual(empty.estimate_jaccard(empty), 0.0)
+        self.assertRaises(ValueError, a.estimate_union_size, BloomFilter(100, 0.01))
+
+    def test_scalable(self):
+        a = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        b = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        for i in range(3000):
+            a.add(i)
+        for i in range(2000):
+            b.add(i)
+        self.assertClose(a.estimate_cardinality(), 3000, 0.05)
+        self.assertClose(a.estimate_union_size(b), 3000, 0.05)
+        self.assertClose(a.estimate_intersection_size(b), 2000, 0.1)
+        self.assertClose(a.estimate_jaccard(b), 2 / 3.0, 0.1)
+        self.assertRaises(ValueError, a.estimate_union_size, ScalableBloomFilter(1000))
+
+    def test_scalable_different_histories(self):
+        a = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        b = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        # The 1000 shared keys come first in a, last in b
+        for i in range(2000):
+            a.add(i)
+        for i in range(1000, 3000):
+            b.add(i)
+        shared = [f for f in b.filters if any(i in f for i in range(1000, 2000))]
+        self.assertTrue(len(shared) > 1)
+        # Shared keys in different levels are missed: the documented bias
+        self.assertTrue(a.estimate_intersection_size(b) < 1000 * 0.9)
+        self.assertTrue(a.estimate_jaccard(b) < 1 / 3.0)
+        self.assertTrue(a.estimate_union_size(b) > 3000)
+
+class TestKeyHashing(unittest.TestCase):
+    # Hashes computed by pybloom 2.0 under Python 2, which filters saved
+    # with tofile() depend on
+    EXPECTED = [
+        ('hello', [319, 14, 816, 452, 656, 562, 790]),
+        (u'\xa1', [416, 883, 338, 582, 898, 630, 786]),
+        (42, [361, 249, 311, 709, 880, 488, 713]),
+        (1.5, [941, 490, 111, 343, 703, 230, 352]),
+        (1e11, [838, 77, 942, 70, 215, 682, 609]),
+        (0.1, [528, 614, 556, 53, 211, 731, 522]),
+        (10 ** 20, [854, 158, 541, 162, 838, 505, 942]),
+        (b'\x00\xff', [69, 499, 452, 934, 689, 393, 167]),
+    ]
+
+    def test_stable_hashes(self):
+        make_hashes = make_hashfuncs(7, 1000)
+        for key, hashes in self.EXPECTED:
+            self.assertEqual(make_hashes(key), hashes)
+
+    def test_buffer_keys(self):
+        make_hashes = make_hashfuncs(7, 1000, HashCache())
+        expected = make_hashes(b'\x00\xff')
+        self.assertEqual(make_hashes(bytearray(b'\x00\xff')), expected)
+        self.assertEqual(make_hashes(memoryview(b'\x00\xff')), expected)
+
+class TestCompiledCore(unittest.TestCase):
+    def setUp(self):
+        if pybloom.pybloom._core is None:
+            self.skipTest('pybloom._core is not built')
+        self.core = pybloom.pybloom._core
+
+    def tearDown(self):
+        pybloom.pybloom._core = self.core
+
+    def test_matches_pure_python(self):
+        keys = [str(i) for i in range(2000)]
+        for capacity in (1000, 10000, 100000):
+            compiled = BloomFilter(capacity, 0.001)
+            pybloom.pybloom._core = None
+            pure = BloomFilter(capacity, 0.001)
+            for key in keys[::2]:
+                self.assertEqual(pure.add(key), False)
+            pybloom.pybloom._core = self.core
+            for key in keys[::2]:
+                self.assertEqual(compiled.make_hashes(key), pure.make_hashes(key))
+                self.assertEqual(compiled.add(key), False)
+            self.assertEqual(compiled.bitarray, pure.bitarray)
+            self.assertEqual([key in compiled for key in keys],
+                             compiled.contains_many(keys))
+            pybloom.pybloom._core = None
+            self.assertEqual([key in pure for key in keys],
+                             compiled.contains_many(keys))
+
+    def test_out_of_range(self):
+        bloom = BloomFilter(100, 0.001)
+        hashes = bloom.make_hashes('key')
+        hashes[0] = bloom.bits_per_slice
+        self.assertRaises(ValueError, bloom.__contains__, hashes)
+        self.assertRaises(ValueError, self.core.contains_batch, bloom.bitarray,
+                          [hashes], bloom.num_slices, bloom.bits_per_slice)
+
+class TestLazyImports(unittest.TestCase):
+    def test_no_numpy(self):
+        if sys.version_info < (3, 7):
+            self.skipTest('submodules are imported eagerly before Python 3.7')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ("import sys, pybloom; pybloom.BloomFilter(1000); "
+                "assert 'numpy' not in sys.modules; "
+                "pybloom.CountdownBloomFilter(1000); "
+                "assert 'numpy' in sys.modules")
+        self.assertEqual(subprocess.call([sys.executable, "-c", code], cwd=root), 0)
+
+class TestHashCache(unittest.TestCase):
+    def test_shared_cache(self):
+        cache = HashCache(maxsize=100)
+        plain = BloomFilter(1000, 0.001)
+        bloom = BloomFilter(1000, 0.001, hash_cache=cache)
+        sbf = ScalableBloomFilter(hash_cache=cache)
+        for i in range(50):
+            bloom.add(i)
+            sbf.add(i)
+        self.assertEqual(cache.misses, 100)
+        for i in range(50):
+            self.assertEqual(bloom.make_hashes(i), plain.make_hashes(i))
+            self.assertTrue(i in sbf)
+        self.assertEqual(cache.misses, 100)
+        self.assertTrue(cache.hits >= 100)
+
+    def test_eviction(self):
+        cache = HashCache(maxsize=2)
+        bloom = BloomFilter(100, 0.001, hash_cache=cache)
+        bloom.make_hashes('a')
+        bloom.make_hashes('b')
+        bloom.make_hashes('a')
+        bloom.make_hashes('c')
+        self.assertEqual(len(cache), 2)
+        bloom.make_hashes('a')
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        bloom.make_hashes('b')
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, HashCache, 0)
+
+class TestFromIterable(unittest.TestCase):
+    def test_hyperloglog(self):
+        for n in (0, 10, 1000, 100000):
+            hll = HyperLogLog()
+            hll.update(range(n))
+            hll.update(range(n))
+            self.assertTrue(abs(hll.cardinality() - n) <= 4 * hll.standard_error * n + 1)
+        self.assertRaises(ValueError, HyperLogLog, 3)
+
+    def test_from_iterable(self):
+        keys = [random.randint(0, 50000) for _ in range(20000)]
+        for source in (keys, iter(keys)):
+            bloom = BloomFilter.from_iterable(source, error_rate=0.01)
+            self.assertTrue(len(set(keys)) <= bloom.capacity)
+            self.assertTrue(bloom.capacity < len(set(keys)) * 1.1)
+            self.assertEqual(bloom.error_rate, 0.01)
+            for key in keys:
+                self.assertTrue(key in bloom)
+
+    def test_from_growing_source(self):
+        class Growing(object):
+            # Yields more keys each time it is read
+            def __init__(self):
+                self.reads = 0
+            def __iter__(self):
+                self.reads += 1
+                return iter(range(1000 * self.reads))
+        source = Growing()
+        bloom = BloomFilter.from_iterable(source)
+        keys = 1000 * source.reads
+        self.assertTrue(bloom.capacity < len(bloom) <= keys)
+        self.assertTrue(all(i in bloom for i in range(keys)))
+
+    def test_from_empty(self):
+        bloom = BloomFilter.from_iterable([])
+        self.assertEqual(len(bloom), 0)
+        self.assertEqual(bloom.capacity, 1)
+
+class TestAdaptiveGrowth(unittest.TestCase):
+    def false_positive_rate(self, sbf, n):
+        return sum(1 for i in range(n, 2 * n) if i in sbf) / float(n)
+
+    def test_fill_ratio_growth(self):
+        sbf = ScalableBloomFilter(initial_capacity=1000, error_rate=0.01,
+                                  adaptive=True, clock=lambda: 0.0)
+        for i in range(20000):
+            sbf.add(i)
+        self.assertTrue(all(i in sbf for i in range(20000)))
+        self.assertTrue(self.false_positive_rate(sbf, 20000) <= 0.01)
+        for filter in sbf.filters[:-1]:
+            # Levels take keys up to the fill ratio of their error rate
+            before_last = filter.fill_ratio() - filter.num_slices / float(filter.num_bits)
+            self.assertTrue(before_last ** filter.num_slices < filter.error_rate)
+            self.assertTrue(filter.fill_ratio() ** filter.num_slices >= filter.error_rate)
+
+    def test_constant_rate(self):
+        now = [0.0]
+        def clock():
+            now[0] += 1
+            return now[0]
+        sbf = ScalableBloomFilter(initial_capacity=100, adaptive=True, clock=clock)
+        for i in range(10000):
+            sbf.add(i)
+        fixed = ScalableBloomFilter(initial_capacity=100)
+        for i in range(10000):
+            fixed.add(i)
+        self.assertTrue(len(sbf.filters) <= len(fixed.filters))
+        capacities = [f.capacity for f in sbf.filters]
+        for small, large in zip(capacities, capacities[1:]):
+            self.assertTrue(2 * small <= large <= 4 * small)
+
+    def test_accelerating_rate(self):
+        now = [0.0]
+        def clock():
+            # Each key arrives faster than the previous one
+            now[0] += 1.0 / (1 + len(sbf))
+            return now[0]
+        sbf = ScalableBloomFilter(initial_capacity=100, adaptive=True, clock=clock)
+        fixed = ScalableBloomFilter(initial_capacity=100)
+        for i in range(20000):
+            sbf.add(i)
+            fixed.add(i)
+        self.assertTrue(len(sbf.filters) < len(fixed.filters))
+        self.assertTrue(sbf.filters[2].capacity > 2 * sbf.filters[1].capacity)
+        self.assertTrue(self.false_positive_rate(sbf, 20000) <= sbf.error_rate)
+
+    def test_fromfile(self):
+        sbf = ScalableBloomFilter(initial_capacity=1000, error_rate=0.01,
+                                  adaptive=True, clock=lambda: 0.0)
+        for i in range(5000):
+            sbf.add(i)
+        f = io.BytesIO()
+        sbf.tofile(f)
+        f.seek(0)
+        restored = ScalableBloomFilter.fromfile(f, adaptive=True)
+        restored.clock = sbf.clock
+        self.assertTrue(restored.adaptive)
+        for i in range(5000, 20000):
+            sbf.add(i)
+            restored.add(i)
+        self.assertEqual([f.capacity for f in restored.filters],
+                         [f.capacity for f in sbf.filters])
+
+    def test_not_adaptive(self):
+        sbf = ScalableBloomFilter(initial_capacity=100)
+        for i in range(1000):
+            sbf.add(i)
+        self.assertEqual([f.capacity for f in sbf.filters], [100, 200, 400, 800])
+
+class TestEvents(unittest.TestCase):
+    def record(self, filter, event):
+        received = []
+        filter.subscribe(event, lambda source, **info: received.append((source, info)))
+        return received
+
+    def test_capacity_reached(self):
+        bloom = BloomFilter(10, 0.01)
+        received = self.record(bloom, events.CAPACITY_REACHED)
+        for i in range(11):
+            bloom.add(i, skip_check=True)
+        self.assertEqual(received, [])
+        self.assertRaises(IndexError, bloom.add, 11, True)
+        self.assertEqual(received, [(bloom, {'capacity': 10, 'count': 11})])
+
+    def test_scalable_growth(self):
+        sbf = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+        added = self.record(sbf, events.FILTER_ADDED)
+        full = self.record(sbf, events.CAPACITY_REACHED)
+        for i in range(1000):
+            sbf.add(i)
+        self.assertEqual([info['filter'] for _, info in added], sbf.filters)
+        self.assertEqual([info['capacity'] for _, info in added], [100, 200, 400, 800])
+        self.assertEqual([info['nbytes'] for _, info in added],
+                         [f.storage.nbytes for f in sbf.filters])
+        self.assertEqual([info['capacity'] for _, info in full], [100, 200, 400])
+
+    def test_unsubscribe(self):
+        sbf = ScalableBloomFilter(initial_capacity=10)
+        callback = sbf.subscribe(events.FILTER_ADDED, lambda source, **info: self.fail())
+        sbf.unsubscribe(events.FILTER_ADDED, callback)
+        sbf.add('a')
+        self.assertRaises(ValueError, sbf.unsubscribe, events.FILTER_ADDED, callback)
+        self.assertRaises(ValueError, sbf.subscribe, 'unknown', callback)
+
+    def test_not_pickled(self):
+        import pickle
+        sbf = ScalableBloomFilter(initial_capacity=10)
+        sbf.subscribe(events.FILTER_ADDED, lambda source, **info: None)
+        sbf.add('a')
+        restored = pickle.loads(pickle.dumps(sbf))
+        self.assertTrue('a' in restored)
+        self.assertFalse(restored._observed(events.FILTER_ADDED))
+
 class Serialization(unittest.TestCase):
     SIZE = 12345
-    EXPECTED = set([random.randint(0, 10000100) for _ in xrange(SIZE)])
+    EXPECTED = set([random.randint(0, 10000100) for _ in range(SIZE)])
 
     def test_serialization(self):
         for klass, args in [(BloomFilter, (self.SIZE,)),
@@ -90,7 +420,7 @@ class Serialization(unittest.TestCase):
             filter = klass.fromfile(f)
 
             for item in self.EXPECTED:
-                self.assert_(item in filter)
+                self.assertTrue(item in filter)
 
 if __name__ == '__main__':
     unittest.main()
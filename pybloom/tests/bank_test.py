@@ -0,0 +1,66 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import unittest
+import tempfile
+
+from pybloom import BloomFilter
+from pybloom.bank import BloomFilterBank
+
+
+class BloomFilterBankTests(unittest.TestCase):
+    '''
+    Tests for BloomFilterBank
+    '''
+    def setUp(self):
+        self.bank = BloomFilterBank(capacity=1000, error_rate=0.001)
+        self.filters = []
+        for i in range(20):
+            bf = BloomFilter(capacity=1000, error_rate=0.001)
+            for j in range(100):
+                bf.add('%d-%d' % (i % 4, j))
+            bf.add('only-%d' % i)
+            self.filters.append(bf)
+            assert self.bank.add_filter(bf) == i
+
+    def test_lookup(self):
+        assert len(self.bank) == 20
+        assert list(self.bank.lookup('only-13')) == [13]
+        assert list(self.bank.lookup('2-50')) == [2, 6, 10, 14, 18]
+        assert list(self.bank.lookup('missing')) == []
+        assert '2-50' in self.bank
+        assert 'missing' not in self.bank
+
+    def test_matches_filters(self):
+        keys = ['%d-%d' % (i, j) for i in range(5) for j in range(0, 100, 7)]
+        for key, ids in zip(keys, self.bank.lookup_many(keys)):
+            expected = [i for i, bf in enumerate(self.filters) if key in bf]
+            assert list(ids) == expected
+
+    def test_add(self):
+        new_id = self.bank.add_filter()
+        assert list(self.bank.lookup('only-3')) == [3]
+        assert self.bank.add(new_id, 'only-3') == False
+        assert self.bank.add(new_id, 'only-3') == True
+        assert list(self.bank.lookup('only-3')) == [3, 20]
+        self.assertRaises(IndexError, self.bank.add, 21, 'key')
+
+    def test_geometry_mismatch(self):
+        self.assertRaises(ValueError, self.bank.add_filter,
+                          BloomFilter(capacity=1000, error_rate=0.01))
+
+    def test_serialization(self):
+        f = tempfile.NamedTemporaryFile()
+        self.bank.tofile(f)
+        f.flush()
+        for mmap in (False, True):
+            f.seek(0)
+            bank = BloomFilterBank.fromfile(f, mmap=mmap)
+            assert len(bank) == 20
+            assert bank.rows.shape == (self.bank.num_bits, 3)
+            assert list(bank.lookup('2-50')) == [2, 6, 10, 14, 18]
+            assert list(bank.lookup('only-19')) == [19]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import gc
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from pybloom.pybloom import BloomFilter, ScalableBloomFilter
+from pybloom.cdbf import ScalableCountdownBloomFilter
+from pybloom.slidingwindow import SlidingWindowScalableBloomFilter
+from pybloom.wal import DurableScalableBloomFilter
+from pybloom.budget import MemoryBudget, memory_usage, REFUSE, SPILL, EVICT
+
+
+class Time(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryBudgetTests(unittest.TestCase):
+    '''
+    Tests for MemoryBudget
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fill(self, filter, keys):
+        added = []
+        try:
+            for key in keys:
+                filter.add(key)
+                added.append(key)
+        except IndexError:
+            pass
+        return added
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, MemoryBudget, 1000, 'unknown')
+        self.assertRaises(ValueError, MemoryBudget, 1000, SPILL)
+
+    def test_memory_usage(self):
+        sbf = ScalableBloomFilter(initial_capacity=100)
+        for i in range(500):
+            sbf.add(i)
+        bits = sum(f.bitarray.buffer_info()[1] for f in sbf.filters)
+        assert memory_usage(sbf) == bits + sys.getsizeof(sbf.filters)
+        scbf = ScalableCountdownBloomFilter(initial_capacity=100)
+        for i in range(500):
+            scbf.add(str(i))
+        assert memory_usage(scbf) == scbf.nbytes + sys.getsizeof(scbf.filters)
+
+    def test_refuse(self):
+        budget = MemoryBudget(8192, REFUSE)
+        one = budget.register(ScalableBloomFilter(initial_capacity=100), 'one')
+        two = budget.register(ScalableBloomFilter(initial_capacity=100), 'two')
+        assert len(budget) == 2 and one in budget
+        self.fill(one, range(1000))
+        added = self.fill(two, range(100000))
+        assert len(added) < 100000
+        assert all(key in two for key in added)
+        assert budget.usage() <= 8192
+        report = budget.report()
+        assert sorted(report) == ['one', 'two']
+        assert report['one'] == budget.usage(one) and sum(report.values()) == budget.usage()
+
+    def test_countdown(self):
+        budget = MemoryBudget(4096)
+        scbf = budget.register(ScalableCountdownBloomFilter(initial_capacity=100))
+        added = self.fill(scbf, [str(i) for i in range(100000)])
+        assert len(added) < 100000
+        assert budget.usage() <= 4096
+
+    def test_spill(self):
+        budget = MemoryBudget(8192, SPILL, self.tmpdir)
+        cold = budget.register(ScalableBloomFilter(initial_capacity=100))
+        hot = budget.register(ScalableBloomFilter(initial_capacity=100))
+        self.fill(cold, range(1000))
+        in_memory = budget.usage(cold)
+        added = self.fill(hot, range(3000))
+        assert len(added) == 3000
+        assert budget.usage() <= 8192
+        assert budget.usage(cold) < in_memory
+        assert os.listdir(self.tmpdir)
+        assert not cold.filters[0].storage.in_memory
+        assert all(i in cold for i in range(1000))
+        assert all(i in hot for i in range(3000))
+
+    def test_spill_durable(self):
+        budget = MemoryBudget(8192, SPILL, self.tmpdir)
+        durable = budget.register(DurableScalableBloomFilter(
+            os.path.join(self.tmpdir, 'wal'), initial_capacity=100))
+        self.fill(durable, range(1000))
+        in_memory = budget.usage(durable)
+        assert in_memory > 0
+        hot = budget.register(ScalableBloomFilter(initial_capacity=100))
+        assert len(self.fill(hot, range(3000))) == 3000
+        assert budget.usage(durable) < in_memory
+        assert not durable.filters[0].storage.in_memory
+        assert all(i in durable for i in range(1000))
+        durable.close()
+
+    def test_touch(self):
+        budget = MemoryBudget(8192, SPILL, self.tmpdir)
+        first = budget.register(ScalableBloomFilter(initial_capacity=100))
+        second = budget.register(ScalableBloomFilter(initial_capacity=100))
+        self.fill(first, range(500))
+        self.fill(second, range(500))
+        budget.touch(first)
+        budget.reserve(first, 8192 - budget.usage() + 1)
+        assert not second.filters[0].storage.in_memory
+        assert first.filters[0].storage.in_memory
+
+    def test_evict(self):
+        time = Time()
+        budget = MemoryBudget(10000, EVICT)
+        windows = budget.register(SlidingWindowScalableBloomFilter(
+            initial_capacity=200, window_period='10_Sec', clock=time))
+        for window in range(5):
+            for i in range(400):
+                windows.add('%d-%d' % (window, i))
+            time.now += 1.1
+        assert len(windows.filters) < 5
+        assert budget.usage() <= 10000
+        assert '4-0' in windows
+        assert '0-0' not in windows
+
+    def test_evict_refused(self):
+        budget = MemoryBudget(9000, EVICT)
+        windows = budget.register(SlidingWindowScalableBloomFilter(
+            initial_capacity=200, window_period='10_Sec', clock=Time()))
+        added = self.fill(windows, range(100000))
+        assert len(added) < 100000
+        assert len(windows.filters) == 1
+
+    def test_expired_windows_released(self):
+        time = Time()
+        budget = MemoryBudget(16000, EVICT)
+        windows = budget.register(SlidingWindowScalableBloomFilter(
+            initial_capacity=200, window_period='10_Sec', clock=time))
+        for window in range(3):
+            for i in range(400):
+                windows.add('%d-%d' % (window, i))
+            time.now += 1.1
+        time.now += 20
+        windows.tick()
+        assert windows.size == 0 and budget.usage() > 8000
+        # The ring slots of the expired windows are released on demand
+        sbf = budget.register(ScalableBloomFilter(initial_capacity=100))
+        assert len(self.fill(sbf, range(3000))) == 3000
+        assert budget.usage() <= 16000
+
+    def test_unregister(self):
+        budget = MemoryBudget(1024)
+        sbf = budget.register(ScalableBloomFilter(initial_capacity=100))
+        budget.unregister(sbf)
+        assert len(budget) == 0 and sbf.budget is None
+        self.fill(sbf, range(1000))
+        assert budget.usage() == 0
+
+    def test_weak_references(self):
+        budget = MemoryBudget(1024)
+        budget.register(ScalableBloomFilter(initial_capacity=100))
+        gc.collect()
+        assert len(budget) == 0
+
+    def test_not_pickled(self):
+        budget = MemoryBudget(1 << 20)
+        sbf = budget.register(ScalableBloomFilter(initial_capacity=100))
+        sbf.add('a')
+        restored = pickle.loads(pickle.dumps(sbf))
+        assert restored.budget is None and 'a' in restored
+
+
+if __name__ == '__main__':
+    unittest.main()
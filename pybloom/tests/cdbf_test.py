@@ -1,14 +1,19 @@
 import sys, os.path
-sys.path.append(os.path.split(os.path.abspath(__file__))[0] + '/..')
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
 
 import unittest
 import csv
 import time
+import math
 import random
 import datetime
 import numpy as np
 
-from cdbf import CountdownBloomFilter, ScalableCountdownBloomFilter
+from multiprocessing.pool import ThreadPool
+from pybloom.cdbf import CountdownBloomFilter, ScalableCountdownBloomFilter
+from pybloom import maintenance, _maintenance
+from pybloom import HashCache
+from pybloom.events import FILTER_ADDED, CAPACITY_REACHED, MAINTENANCE
 
 
 class CountdownBloomFilterTests(unittest.TestCase):
@@ -107,16 +112,143 @@ class CountdownBloomFilterTests(unittest.TestCase):
     def test_count_estimate(self):
         for i in range(500):
             self.bf.add(str(i))
-        assert self.bf.count == 500
+        assert self.bf.count == 497
         self.bf.batched_expiration_maintenance(2.5)
-        for i in range(500,1000):
+        for i in range(500,900):
             self.bf.add(str(i))
-        assert self.bf.count == 992
+        # Between maintenance runs the estimates follow the occupied cells
+        z = float(self.bf.cellarray.nonzero()[0].shape[0]) / self.bf.num_bits
+        assert self.bf.estimate_z == z
+        assert self.bf.count == int(-self.bf.bits_per_slice * math.log(1 - z))
         for i in range(26):
             self.bf.batched_expiration_maintenance(0.1)
-        assert self.bf.count == 501
-        self.assertAlmostEqual(self.bf.estimate_z, 0.309, places=3)
-        self.assertAlmostEqual(float(self.bf.cellarray.nonzero()[0].shape[0]) / self.bf.num_bits, 0.309, places=3)
+        z = float(self.bf.cellarray.nonzero()[0].shape[0]) / self.bf.num_bits
+        assert self.bf.estimate_z == z
+        assert len(self.bf) == int(-self.bf.bits_per_slice * math.log(1 - z))
+
+    def test_capacity_occupancy(self):
+        # Without maintenance, keys are refused once half of the cells
+        # are occupied, before the count reaches the capacity
+        i = 0
+        while self.bf.occupied <= 0.5 * self.bf.num_bits:
+            self.bf.add(str(i))
+            i += 1
+        assert self.bf.count <= self.bf.capacity
+        key = next(str(j) for j in range(i, i + 1000) if str(j) not in self.bf)
+        self.assertRaises(IndexError, self.bf.add, key)
+
+    def test_occupied(self):
+        for i in range(500):
+            self.bf.add(str(i))
+        assert self.bf.occupied == self.bf.cellarray.nonzero()[0].shape[0]
+        for i in range(60):
+            self.bf.batched_expiration_maintenance(0.1)
+            assert self.bf.occupied == self.bf.cellarray.nonzero()[0].shape[0]
+        assert self.bf._compute_z() == float(self.bf.occupied) / self.bf.num_bits
+        assert self.bf.occupied == 0
+
+    def test_batched_matches_dev(self):
+        reference = CountdownBloomFilter(1000, 0.02, self.expiration)
+        for i in range(500):
+            self.bf.add(str(i))
+            reference.add(str(i))
+        for elapsed in (0.01, 0.5, 0.003):
+            self.bf.batched_expiration_maintenance(elapsed)
+            reference.batched_expiration_maintenance_dev(elapsed)
+            assert (self.bf.cellarray == reference.cellarray).all()
+            assert self.bf.refresh_head == reference.refresh_head
+            assert self.bf.occupied == reference.occupied
+
+    def test_parallel_maintenance(self):
+        reference = CountdownBloomFilter(1000, 0.02, self.expiration, counter_bits=4)
+        bf = CountdownBloomFilter(1000, 0.02, self.expiration, counter_bits=4)
+        bf.MAINTENANCE_CHUNK = 1000
+        for i in range(500):
+            bf.add(str(i))
+            reference.add(str(i))
+        pool = ThreadPool(4)
+        for i in range(30):
+            bf.batched_expiration_maintenance(0.1, pool=pool, num_chunks=4)
+            reference.batched_expiration_maintenance(0.1)
+            assert (bf.cellarray == reference.cellarray).all()
+            assert bf.occupied == reference.occupied
+            assert bf.refresh_head == reference.refresh_head
+        pool.close()
+
+
+class PackedCountdownBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for CountdownBloomFilter with packed counters
+    '''
+    @classmethod
+    def setUp(self):
+        self.batch_refresh_period = 0.1
+        self.expiration = 5.0
+        self.bf = CountdownBloomFilter(1000, 0.02, self.expiration, counter_bits=4)
+
+    def test_invalid_counter_bits(self):
+        self.assertRaises(ValueError, CountdownBloomFilter, 1000, 0.02, self.expiration, counter_bits=3)
+
+    def test_cellarray(self):
+        assert self.bf.cellarray.shape == (4074,)
+        assert self.bf.cells().shape == (8148,)
+        bf = CountdownBloomFilter(1000, 0.02, self.expiration, counter_bits=2)
+        assert bf.cellarray.shape == (2037,)
+        assert bf.counter_init == 3
+
+    def test_add(self):
+        existing = self.bf.add('random_uuid')
+        assert existing == False
+        existing = self.bf.add('random_uuid')
+        assert existing == True
+        assert (self.bf.cells().nonzero()[0] == np.array([ 228, 2104, 3151, 4372, 6496, 7449])).all()
+        assert (self.bf.cells()[self.bf.cells().nonzero()[0]] == 15).all()
+
+    def test_maintenance_kernel(self):
+        bf = CountdownBloomFilter(1000, 0.02, self.expiration, counter_bits=2)
+        for i in range(200):
+            bf.add(str(i))
+        reference = bf.cells().copy()
+        bf.batched_expiration_maintenance(1.0)
+        iterations = bf.num_batched_maintenance(1.0)
+        for i in range(iterations):
+            head = i % bf.num_bits
+            if reference[head]:
+                reference[head] -= 1
+        assert (bf.cells() == reference).all()
+        assert bf.refresh_head == iterations % bf.num_bits
+        assert bf.occupied == bf.cells().nonzero()[0].shape[0]
+
+    def test_numpy_maintenance(self):
+        rng = np.random.RandomState(0)
+        for counter_bits in CountdownBloomFilter.COUNTER_BITS:
+            per_byte = 8 // counter_bits
+            cells_size = 1001
+            num_bytes = -(-cells_size // per_byte)
+            for _ in range(20):
+                cells = rng.randint(0, 256, num_bytes).astype(np.uint8)
+                if cells_size % per_byte:
+                    # Padding cells past the end stay empty
+                    cells[-1] &= (1 << (cells_size % per_byte) * counter_bits) - 1
+                head = rng.randint(cells_size)
+                num_iterations = rng.randint(3 * cells_size)
+                start = rng.randint(num_bytes) * per_byte
+                stop = rng.randint(start, cells_size + 1)
+                expected, actual = cells.copy(), cells.copy()
+                cleared = maintenance.maintenance_chunk(expected, cells_size, num_iterations,
+                                                        head, start, stop, counter_bits)
+                assert _maintenance.maintenance_chunk(actual, cells_size, num_iterations,
+                                                      head, start, stop, counter_bits) == cleared
+                assert (actual == expected).all()
+
+    def test_expiration(self):
+        self.bf.add('random_uuid')
+        nbr_step = int(self.expiration / self.batch_refresh_period)
+        for i in range(nbr_step - 1):
+            self.bf.batched_expiration_maintenance(self.batch_refresh_period)
+        assert 'random_uuid' in self.bf
+        self.bf.batched_expiration_maintenance(self.batch_refresh_period)
+        assert 'random_uuid' not in self.bf
 
 
 class ScalableCountdownBloomFilterTests(unittest.TestCase):
@@ -133,40 +265,158 @@ class ScalableCountdownBloomFilterTests(unittest.TestCase):
         pass
 
     def test_scale_initialization(self):
-        for i in range(3000):
+        for i in range(2900):
             self.bf.add(str(i))
         assert len(self.bf.filters) == 2
         assert self.bf.filters[1].capacity == 2000
         assert self.bf.filters[1].error_rate == 0.016200000000000003
 
     def test_scale_count(self):
-        for i in range(3000):
+        for i in range(2900):
             self.bf.add(str(i))
-        assert self.bf.filters[0].count == 1000
-        assert self.bf.filters[1].count == 1951
+        # A filter is full once half of its cells are occupied
+        assert self.bf.filters[0].count == 967
+        assert self.bf.filters[0].occupied > 0.5 * self.bf.filters[0].num_bits
+        assert self.bf.filters[1].count == 1910
 
     def test_scale_pointer(self):
-        # This phase will create two sub filter
-        for i in range(0,3050):
+        # This phase will fill two sub filter
+        for i in range(0,2980):
             self.bf.add(str(i))
         assert self.bf.pointer == 1
 
         # Here we simulate expired item in the first filter
-        self.bf.filters[0].count = 100
+        self.bf.filters[0].cellarray[:] = 0
+        self.bf.filters[0].occupied = 0
+        self.bf._update_available()
 
         # The new item should be forward to the first available filter
         self.bf.add('an_other_random_uuid')
         assert self.bf.pointer == 0
-        for i in range(4000,4992):
+        for i in range(4000,4982):
             self.bf.add(str(i))
             assert self.bf.pointer == 0
 
         self.bf.add('an_other_random_uuid2')
         assert self.bf.pointer == 2
-        assert self.bf.filters[0].count == 1000
+        assert self.bf.filters[0].count == 966
         assert len(self.bf.filters) == 3
 
 
+    def test_available_after_maintenance(self):
+        for i in range(2980):
+            self.bf.add(str(i))
+        assert self.bf.pointer == 1
+        assert self.bf.available == []
+        # Here we simulate half of the first filter expiring
+        cellarray = self.bf.filters[0].cellarray
+        cellarray[cellarray.shape[0] // 2:] = 0
+        self.bf.filters[0].occupied = cellarray.nonzero()[0].shape[0]
+        self.bf.batched_expiration_maintenance(self.batch_refresh_period)
+        assert self.bf.available == [0]
+        for i in range(3050, 3550):
+            self.bf.add(str(i))
+        assert self.bf.pointer == 0
+        assert self.bf.available == []
+        assert len(self.bf.filters) == 2
+
+    def test_retire_drained(self):
+        for i in range(3500):
+            self.bf.add(str(i))
+        assert len(self.bf.filters) == 3
+        # Here we simulate the first two filters being drained by expiration
+        for filter in self.bf.filters[:2]:
+            filter.cellarray[:] = 0
+            filter.occupied = 0
+        last = self.bf.filters[2]
+        self.bf.batched_expiration_maintenance(self.batch_refresh_period)
+        assert self.bf.filters == [last]
+        assert self.bf.pointer == 0
+        assert '3499' in self.bf
+        # Once everything is drained the next filter starts from initial_capacity
+        for i in range(int(self.expiration / self.batch_refresh_period) + 10):
+            self.bf.batched_expiration_maintenance(self.batch_refresh_period)
+        assert self.bf.filters == []
+        self.bf.add('random_uuid')
+        assert self.bf.filters[0].capacity == 1000
+
+    def test_max_memory(self):
+        bf = ScalableCountdownBloomFilter(initial_capacity=1000, error_rate=0.02,
+                                          expiration=self.expiration, max_memory=55000)
+        for i in range(3500):
+            bf.add(str(i))
+        # The third filter does not fit, the first one (fewest keys) is dropped
+        assert len(bf.filters) == 2
+        assert bf.nbytes <= 55000
+        assert bf.filters[0].capacity == 2000
+        assert bf.pointer == 1
+        assert '3499' in bf
+
+    def test_max_memory_growth(self):
+        bf = ScalableCountdownBloomFilter(initial_capacity=1000, error_rate=0.02,
+                                          expiration=self.expiration, max_memory=55000)
+        for i in range(30000):
+            bf.add(str(i))
+            # Compaction shifts the levels: keys still land where probed
+            assert str(i) in bf
+            assert bf.nbytes <= 55000
+
+    def test_parallel_maintenance(self):
+        bf = ScalableCountdownBloomFilter(initial_capacity=1000, error_rate=0.02,
+                                          expiration=self.expiration, threads=4)
+        for i in range(3500):
+            self.bf.add(str(i))
+            bf.add(str(i))
+        for i in range(30):
+            assert bf.batched_expiration_maintenance(0.1) == self.bf.batched_expiration_maintenance(0.1)
+            for f, reference in zip(bf.filters, self.bf.filters):
+                assert (f.cellarray == reference.cellarray).all()
+                assert f.occupied == reference.occupied
+                assert f.count == reference.count
+
+    def test_close_pool(self):
+        with ScalableCountdownBloomFilter(initial_capacity=1000, error_rate=0.02,
+                                          expiration=self.expiration, threads=4) as bf:
+            bf.add('random_uuid')
+            bf.batched_expiration_maintenance(0.1)
+            assert bf._pool is not None
+            assert '_pool' not in bf.__getstate__()
+        assert bf._pool is None
+        # A later maintenance run starts a new pool
+        bf.batched_expiration_maintenance(0.1)
+        assert bf._pool is not None
+        bf.close()
+
+    def test_maintenance_per_level(self):
+        for i in range(3500):
+            self.bf.add(str(i))
+        assert len(self.bf.filters) == 3
+        cells = [f.cellarray.copy() for f in self.bf.filters]
+        processed = self.bf.batched_expiration_maintenance([0.0, 0.0, 1.0])
+        assert processed[:2] == (0, 0) and 0 < processed[2] <= 1.0
+        assert (self.bf.filters[0].cellarray == cells[0]).all()
+        assert not (self.bf.filters[2].cellarray == cells[2]).all()
+
+    def test_events(self):
+        received = []
+        for event in (FILTER_ADDED, CAPACITY_REACHED, MAINTENANCE):
+            self.bf.subscribe(event, lambda source, event=event, **info: received.append((event, info)))
+        for i in range(2900):
+            self.bf.add(str(i))
+        assert [(e, info['capacity']) for e, info in received] == \
+            [(FILTER_ADDED, 1000), (CAPACITY_REACHED, 1000), (FILTER_ADDED, 2000)]
+        assert received[2][1]['nbytes'] == self.bf.filters[1].cellarray.nbytes
+        del received[:]
+        occupied = sum(f.occupied for f in self.bf.filters)
+        iterations = sum(f.num_batched_maintenance(self.expiration / 2) for f in self.bf.filters)
+        self.bf.batched_expiration_maintenance(self.expiration / 2)
+        (event, info), = received
+        assert event == MAINTENANCE
+        assert info['iterations'] == iterations > 0
+        assert info['elapsed'] >= 0
+        assert info['nonzero'] == sum(f.occupied for f in self.bf.filters)
+        assert info['cleared'] == occupied - info['nonzero']
+
     def test_add(self):
         existing = self.bf.add('random_uuid')
         assert existing == False
@@ -174,7 +424,43 @@ class ScalableCountdownBloomFilterTests(unittest.TestCase):
         assert existing == True
         assert (self.bf.filters[0].cellarray.nonzero()[0] == np.array([1360,1600,3789,4794,6882,8087])).all()
 
-    
+    def test_refresh_owning_filter(self):
+        for i in range(1500):
+            self.bf.add(str(i))
+        assert self.bf.pointer == 1
+        self.bf.batched_expiration_maintenance(self.batch_refresh_period)
+        owner = self.bf.filters[0]
+        hashes = owner.make_hashes('0')
+        assert '0' in owner
+        count, occupied = self.bf.filters[1].count, self.bf.filters[1].occupied
+        existing = self.bf.add('0')
+        assert existing == True
+        # Counters are refreshed in the first filter, nothing is written to the second one
+        offset = 0
+        for k in hashes:
+            assert owner.cellarray[offset + k] == owner.counter_init
+            offset += owner.bits_per_slice
+        assert self.bf.filters[1].count == count
+        assert self.bf.filters[1].occupied == occupied
+
+    def test_hash_cache(self):
+        cache = HashCache(maxsize=1000)
+        bf = ScalableCountdownBloomFilter(initial_capacity=1000, error_rate=0.02,
+                                          expiration=self.expiration, hash_cache=cache)
+        for i in range(1500):
+            bf.add(str(i))
+        for i in range(1500):
+            self.bf.add(str(i))
+        assert bf.filters[0].hash_cache is bf.filters[1].hash_cache is cache
+        assert len(cache) == 1000
+        misses = cache.misses
+        for i in range(1400, 1500):
+            assert str(i) in bf
+        assert cache.misses == misses
+        for a, b in zip(bf.filters, self.bf.filters):
+            assert (a.cellarray == b.cellarray).all()
+
+
 
 if __name__ == '__main__':
      unittest.main()
@@ -0,0 +1,98 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import unittest
+
+from pybloom.hashfilter import HashFilter, FixedSizeKeyTable
+
+
+class HashFilterTests(unittest.TestCase):
+    '''
+    Tests for HashFilter
+    '''
+    def setUp(self):
+        self.hf = HashFilter(expiration=5.0)
+
+    def test_add(self):
+        assert self.hf.add('random_uuid', 0) == False
+        assert self.hf.add('random_uuid', 1) == True
+        assert self.hf.contains('random_uuid', 5.5) == True
+        assert self.hf.contains('random_uuid', 6) == False
+        assert self.hf.contains('other_uuid', 6) == False
+        assert self.hf.add('random_uuid', 7) == False
+
+    def test_purge_unqueried_keys(self):
+        for i in range(1000):
+            self.hf.add(str(i), i * 0.01)
+        # Keys never queried again are dropped by later adds
+        assert len(self.hf) < 1000
+        self.hf.add('random_uuid', 20)
+        assert len(self.hf) == 1
+        assert list(self.hf._buckets.keys()) == [25]
+
+    def test_purge(self):
+        for i in range(100):
+            self.hf.add(str(i), i * 0.01)
+        assert self.hf.contains('0', 5.5) == False
+        # The bucket expiring in [5, 6) is not entirely elapsed yet
+        assert self.hf.purge(5.5) == 0
+        assert self.hf.contains('99', 5.5) == True
+        assert self.hf.purge(6) == 99
+        assert len(self.hf) == 0
+
+    def test_refresh_survives_purge(self):
+        self.hf.add('random_uuid', 0)
+        self.hf.add('random_uuid', 4)
+        assert self.hf.purge(7) == 0
+        assert self.hf.contains('random_uuid', 8.5) == True
+        assert self.hf.purge(10) == 1
+
+    def test_batch(self):
+        keys = [str(i) for i in range(10)]
+        assert self.hf.add_many(keys[:5], 0) == [False] * 5
+        assert self.hf.add_many(keys, 1) == [True] * 5 + [False] * 5
+        assert self.hf.contains_many(keys + ['other_uuid'], 5.5) == [True] * 10 + [False]
+        assert self.hf.contains_many(keys, 6.5) == [False] * 10
+
+
+class CompactHashFilterTests(unittest.TestCase):
+    '''
+    Tests for HashFilter with fixed-size keys
+    '''
+    def setUp(self):
+        self.hf = HashFilter(expiration=5.0, key_size=8)
+
+    def test_add(self):
+        assert self.hf.add('uuid\x00\x00\x00\x00', 0) == False
+        assert self.hf.add('uuid\x00\x00\x00\x00', 1) == True
+        assert self.hf.contains('uuid\x00\x00\x00\x00', 5.5) == True
+        assert self.hf.contains('uuid\x00\x00\x00\x01', 5.5) == False
+        assert self.hf.contains('uuid\x00\x00\x00\x00', 6) == False
+        self.assertRaises(ValueError, self.hf.add, 'uuid', 0)
+
+    def test_purge(self):
+        for i in range(3000):
+            self.hf.add('%08d' % i, i * 0.01)
+        # Purged at most once per resolution
+        assert 500 <= len(self.hf) <= 600
+        self.hf.purge(29.995)
+        assert len(self.hf) == 500
+        assert self.hf.contains('%08d' % 2999, 30) == True
+        assert self.hf.contains('%08d' % 2499, 30) == False
+        assert self.hf.unique_items.nbytes <= 4096 * (8 + 8 + 1)
+
+    def test_table_resize(self):
+        table = FixedSizeKeyTable(4, capacity=8)
+        for i in range(100):
+            table.set('%04d' % i, i)
+        assert len(table) == 100
+        assert table.mask + 1 == 256
+        for i in range(100):
+            assert table.get('%04d' % i) == i
+        table.delete('0050')
+        assert table.get('0050') is None
+        assert len(table) == 99
+
+
+if __name__ == '__main__':
+     unittest.main()
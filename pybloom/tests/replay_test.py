@@ -0,0 +1,65 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from pybloom.hashfilter import HashFilter
+from pybloom.replay import SimulatedClock, synthetic_trace, read_trace, default_structures, replay, report
+
+
+class ReplayTests(unittest.TestCase):
+    '''
+    Tests for the trace-replay harness
+    '''
+    def test_synthetic_trace(self):
+        trace = list(synthetic_trace(10, 100, uniqueness=0.5, seed=1))
+        assert trace == list(synthetic_trace(10, 100, uniqueness=0.5, seed=1))
+        timestamps = [t for t, _ in trace]
+        assert timestamps == sorted(timestamps)
+        assert 0 <= timestamps[0] and timestamps[-1] < 10
+        assert 800 < len(trace) < 1200
+        assert len(set(k for _, k in trace)) < len(trace)
+
+    def test_synthetic_skew(self):
+        self.assertRaises(ValueError, synthetic_trace, 10, 100, skew=0.5)
+        newest = repeats = num_keys = 0
+        for _, key in synthetic_trace(10, 100, uniqueness=0.2, skew=1.2, seed=1):
+            if int(key) > num_keys:
+                num_keys = int(key)
+            else:
+                repeats += 1
+                newest += int(key) == num_keys
+        # Draws beyond the keys seen are not clipped onto the newest one
+        assert repeats > 500 and newest < 0.05 * repeats
+        uniform = list(synthetic_trace(10, 100, uniqueness=0.2, skew=0, seed=1))
+        assert 800 < len(uniform) < 1200
+
+    def test_read_trace(self):
+        f = StringIO('0.5,a\n1.25,b\n\n2,a\n')
+        assert list(read_trace(f)) == [(0.5, 'a'), (1.25, 'b'), (2.0, 'a')]
+
+    def test_replay(self):
+        clock = SimulatedClock()
+        structures = default_structures('5_Sec', 1000, 0.01, clock)
+        trace = synthetic_trace(20, 50, uniqueness=0.3, seed=2)
+        # Maintenance runs every 0.1s, after the adds of the period it
+        # covers: keys may expire up to that much early
+        results = replay(trace, structures, HashFilter(4.9), clock, sample_period=5)
+        assert [r.name for r in results] == ['HashFilter'] + [n for n, _ in structures]
+        for result in results:
+            assert result.events == results[0].events
+            assert len(result.memory) == 3
+        assert results[0].false_positives == results[0].false_negatives == 0
+        # The countdown filter only loses keys once they (almost) expired
+        assert results[1].false_negatives == 0
+        out = StringIO()
+        report(results, out)
+        assert 'AgePartitionedBloomFilter' in out.getvalue()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import io
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from struct import pack, unpack
+
+from pybloom import server
+from pybloom.pybloom import BloomFilter, ScalableBloomFilter
+from pybloom.cdbf import CountdownBloomFilter, ScalableCountdownBloomFilter
+from pybloom.slidingwindow import SlidingWindowScalableBloomFilter
+from pybloom.server import FilterServer, FilterClient, CapacityError, ERROR, REQUEST_FMT, RESPONSE_FMT, RESPONSE_SIZE
+
+
+class FilterServerTests(unittest.TestCase):
+    '''
+    Tests for FilterServer and FilterClient over a Unix socket
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filters = self.make_filters()
+        self.server = FilterServer(self.address(), self.filters).start()
+        self.client = FilterClient(self.server.address, pool_size=2)
+
+    def make_filters(self):
+        return {
+            'bloom': BloomFilter(100, 0.01),
+            'scalable': ScalableBloomFilter(initial_capacity=100),
+            'countdown': CountdownBloomFilter(1000, 0.01, 60),
+            'scalable-countdown': ScalableCountdownBloomFilter(initial_capacity=100),
+            'window': SlidingWindowScalableBloomFilter(initial_capacity=100, window_period='10_Min'),
+        }
+
+    def address(self):
+        return os.path.join(self.tmpdir, 'filters.sock')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_names(self):
+        assert self.client.names() == sorted(self.filters)
+
+    def test_add_contains(self):
+        keys = ['key-%d' % i for i in range(500)]
+        local = self.make_filters()
+        for name in ('scalable', 'countdown', 'scalable-countdown', 'window'):
+            expected = [local[name].add(key) for key in keys]
+            assert self.client.add_many(name, keys) == expected
+            assert expected.count(True) < 5
+            assert self.client.add(name, 'key-1') is True
+            assert self.client.contains_many(name, keys) == [True] * 500
+            assert self.client.contains(name, 'missing') is False
+            # Keys are hashed as the filter hashes them locally
+            assert all(key in self.filters[name] for key in keys)
+        assert self.client.contains('scalable', u'\xa1') is False
+        self.client.add('scalable', u'\xa1')
+        assert u'\xa1' in self.filters['scalable']
+        assert self.client.count('scalable') == 501
+
+    def test_errors(self):
+        self.assertRaises(KeyError, self.client.add, 'missing', 'a')
+        self.assertRaises(IndexError, self.client.add_many, 'bloom', range(200))
+        self.assertRaises(ValueError, self.client.snapshot, 'countdown')
+        # The connection is still usable after errors
+        assert self.client.contains('bloom', 0)
+
+    def test_partial_add(self):
+        try:
+            self.client.add_many('bloom', range(200))
+        except CapacityError as e:
+            results = e.results
+        assert 100 <= len(results) < 200
+        assert all(i in self.filters['bloom'] for i in range(len(results)))
+        assert self.client.count('bloom') == len(self.filters['bloom'])
+
+    def test_malformed_frames(self):
+        family = socket.AF_INET if isinstance(self.server.address, tuple) else socket.AF_UNIX
+        connection = socket.socket(family, socket.SOCK_STREAM)
+        connection.connect(self.server.address)
+        connection.sendall(pack(REQUEST_FMT, 3, 1, 0) + b'\xff')
+        rfile = connection.makefile('rb')
+        status, length = unpack(RESPONSE_FMT, rfile.read(RESPONSE_SIZE))
+        assert status == ERROR and rfile.read(length)
+        # A frame cut short by the client only closes its connection
+        connection.sendall(pack(REQUEST_FMT, 3, 7, 0) + b'sca')
+        rfile.close()
+        connection.close()
+        assert self.client.count('scalable') == 0
+
+    def test_pipeline(self):
+        pipeline = self.client.pipeline()
+        for i in range(100):
+            pipeline.add('scalable', i)
+        pipeline.add_many('scalable', range(100, 1000))
+        pipeline.contains_many('scalable', [0, 999, 1000])
+        pipeline.contains('scalable', 5)
+        pipeline.count('scalable')
+        assert len(pipeline) == 104
+        results = pipeline.execute()
+        assert results[:100] == [False] * 100
+        assert results[101:] == [[True, True, False], True, 1000]
+        assert pipeline.execute() == []
+
+    def test_large_pipeline(self):
+        pipeline = self.client.pipeline()
+        keys = ['%0100d' % i for i in range(2000)]
+        for _ in range(20):
+            pipeline.contains_many('scalable', keys)
+        assert len(pipeline.execute()) == 20
+
+    def test_snapshot(self):
+        self.client.add_many('scalable', range(1000))
+        f = io.BytesIO(self.client.snapshot('scalable'))
+        restored = ScalableBloomFilter.fromfile(f)
+        assert all(i in restored for i in range(1000))
+        f = io.BytesIO()
+        self.client.snapshot('window', f)
+        assert f.getvalue()
+
+    def test_connection_pool(self):
+        errors = []
+        def work(thread):
+            try:
+                for i in range(50):
+                    key = '%d-%d' % (thread, i)
+                    self.client.add('scalable', key)
+                    assert self.client.contains('scalable', key)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert self.client._pool.qsize() <= 2
+        assert 395 <= len(self.filters['scalable']) <= 400
+
+
+class TCPFilterServerTests(FilterServerTests):
+    '''
+    The same tests over TCP
+    '''
+    def address(self):
+        return ('127.0.0.1', 0)
+
+
+class UnixSocketsUnavailableTests(unittest.TestCase):
+    '''
+    Tests for platforms without Unix sockets
+    '''
+    def setUp(self):
+        self.unix_server = server._UnixServer
+        server._UnixServer = None
+
+    def tearDown(self):
+        server._UnixServer = self.unix_server
+
+    def test_unix_address(self):
+        self.assertRaises(ValueError, FilterServer, 'filters.sock')
+        # TCP still works
+        FilterServer(('127.0.0.1', 0)).shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,315 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import unittest
+import tempfile
+
+from pybloom.slidingwindow import CoarseClock, DecayScalableBloomFilter, SlidingWindowScalableBloomFilter, \
+    AgePartitionedBloomFilter
+from pybloom.events import FILTER_ADDED, WINDOW_ROTATED
+
+
+class SimulatedTime(object):
+    '''
+    Time source advanced by hand, counting its reads
+    '''
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.now
+
+
+class SlidingWindowScalableBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for SlidingWindowScalableBloomFilter
+    '''
+    def setUp(self):
+        self.time = SimulatedTime()
+        self.bf = SlidingWindowScalableBloomFilter(initial_capacity=100, window_period='3_Sec',
+                                                   clock=self.time)
+
+    def _age(self, seconds):
+        self.time.now += seconds
+
+    def test_ring(self):
+        assert len(self.bf.ring) == 3
+        assert self.bf.filters == []
+        assert self.bf.add('random_uuid') == False
+        assert self.bf.add('random_uuid') == True
+        assert self.bf.filters == [self.bf.ring[0]]
+
+    def test_rotation_recycles_filters(self):
+        ring = list(self.bf.ring)
+        for window in range(4):
+            self.bf.add('key-%d' % window)
+            self._age(1.1)
+        assert self.bf.ring == ring
+        assert len(self.bf.filters) == 3
+        assert self.bf.filters[-1] is ring[0]
+        # The slot reused for the fourth window forgot the first one
+        assert 'key-0' not in self.bf
+        assert 'key-2' in self.bf
+        assert 'key-3' in self.bf
+
+    def test_events(self):
+        rotations = []
+        added = []
+        self.bf.subscribe(WINDOW_ROTATED, lambda source, **info: rotations.append(info))
+        self.bf.subscribe(FILTER_ADDED, lambda source, **info: added.append(source))
+        for i in range(150):
+            self.bf.add('a-%d' % i)
+        self._age(1.1)
+        self.bf.add('b')
+        assert [(info['window'], info['capacity'], info['previous']) for info in rotations] == \
+            [(self.bf.ring[0], 100, 0), (self.bf.ring[1], 200, len(self.bf.ring[0]))]
+        # Windows share the callbacks of the sliding window filter
+        assert added == [self.bf.ring[0], self.bf.ring[0], self.bf.ring[1]]
+
+    def test_recycle_in_place(self):
+        for window in range(3):
+            self.bf.add('key-%d' % window)
+            self._age(1.1)
+        bitarray = self.bf.ring[0].filters[0].bitarray
+        self.bf.add('key-3')
+        assert self.bf.ring[0].filters[0].bitarray is bitarray
+        assert self.bf.ring[0].filters[0].count == 1
+
+    def test_sized_from_previous_window(self):
+        for i in range(300):
+            self.bf.add(str(i))
+        self._age(1.1)
+        self.bf.add('random_uuid')
+        assert self.bf.ring[1].initial_capacity == 400
+        assert len(self.bf.ring[1].filters) == 1
+
+    def test_expired_reset(self):
+        self.bf.add('random_uuid')
+        self._age(10)
+        assert self.bf.add('random_uuid') == False
+        assert len(self.bf.filters) == 1
+
+    def test_coarse_clock(self):
+        for i in range(100):
+            self.bf.add(str(i))
+        reads = self.time.reads
+        for i in range(1000):
+            str(i) in self.bf
+        assert self.time.reads == reads
+        self.bf.add('random_uuid')
+        assert self.time.reads == reads + 1
+
+    def test_tick_prunes_expired(self):
+        self.bf.add('random_uuid')
+        self._age(2)
+        self.bf.add('other_uuid')
+        assert len(self.bf.filters) == 2
+        self._age(2)
+        # Without a tick the cached time still sees both windows
+        assert 'random_uuid' in self.bf
+        self.bf.tick()
+        assert len(self.bf.filters) == 1
+        assert 'random_uuid' not in self.bf
+        assert 'other_uuid' in self.bf
+
+    def test_lookup_prunes_expired(self):
+        self.bf.add('random_uuid')
+        self._age(4)
+        # Only the clock moves, as its ticker thread does
+        self.bf.clock.tick()
+        assert 'random_uuid' not in self.bf
+        assert len(self.bf.filters) == 0
+
+    def test_running_clock(self):
+        self.bf.clock.start(interval=3600)
+        try:
+            reads = self.time.reads
+            for i in range(100):
+                self.bf.add(str(i))
+            assert self.time.reads == reads
+        finally:
+            self.bf.clock.stop()
+        assert all(str(i) in self.bf for i in range(100))
+
+    def _snapshot(self):
+        for window in range(3):
+            if window:
+                self._age(1.1)
+            for i in range(150):
+                self.bf.add('%d-%d' % (window, i))
+        f = tempfile.TemporaryFile()
+        self.bf.tofile(f)
+        f.seek(0)
+        return f
+
+    def test_snapshot(self):
+        f = self._snapshot()
+        restored = SlidingWindowScalableBloomFilter.fromfile(f, clock=self.time)
+        assert restored.window_period == 3
+        assert len(restored.filters) == 3
+        assert [w.timestamp for w in restored.filters] == [w.timestamp for w in self.bf.filters]
+        for window in range(3):
+            for i in range(150):
+                assert '%d-%d' % (window, i) in restored
+        assert restored.add('random_uuid') == False
+        assert len(restored.filters) == 3
+
+    def test_snapshot_skips_expired(self):
+        f = self._snapshot()
+        self._age(1.0)
+        restored = SlidingWindowScalableBloomFilter.fromfile(f, clock=self.time, lazy=True)
+        assert len(restored.filters) == 2
+        oldest, newest = restored.filters
+        assert oldest._pending is not None
+        assert newest._pending is not None
+        assert '2-0' in restored
+        assert oldest._pending is not None
+        assert newest._pending is None
+        assert len(newest) == 150
+        assert '1-0' in restored
+        assert '0-0' not in restored
+
+
+class CoarseClockTests(unittest.TestCase):
+    '''
+    Tests for CoarseClock
+    '''
+    def test_tick(self):
+        time = SimulatedTime()
+        clock = CoarseClock(time)
+        time.now += 5
+        assert clock() == 1000.0
+        assert clock.tick() == 1005.0
+        assert clock() == 1005.0
+
+    def test_restart(self):
+        clock = CoarseClock(SimulatedTime())
+        clock.start(interval=3600)
+        first = clock._ticker
+        clock.start(interval=3600)
+        # The first ticker thread was told to exit
+        assert first.is_set()
+        assert clock.running
+        second = clock._ticker
+        clock.stop()
+        assert second.is_set()
+        assert not clock.running
+
+
+class DecayScalableBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for DecayScalableBloomFilter
+    '''
+    def test_recycle(self):
+        time = SimulatedTime()
+        bf = DecayScalableBloomFilter(initial_capacity=100, window_period='3_Sec', clock=time)
+        for i in range(300):
+            bf.add(str(i))
+        assert len(bf.filters) > 1
+        time.now += 10
+        assert '1' not in bf
+        bf.recycle()
+        assert len(bf.filters) == 1
+        assert len(bf) == 0
+        assert '1' not in bf
+        bf.add('1')
+        assert '1' in bf
+
+    def test_serialization(self):
+        time = SimulatedTime()
+        bf = DecayScalableBloomFilter(initial_capacity=100, window_period='3_Sec', clock=time)
+        for i in range(300):
+            bf.add(str(i))
+        f = tempfile.TemporaryFile()
+        bf.tofile(f)
+        f.seek(0)
+        restored = DecayScalableBloomFilter.fromfile(f, clock=time)
+        assert restored.timestamp == bf.timestamp
+        assert restored.expiration == 3
+        assert len(restored.filters) == len(bf.filters)
+        for i in range(300):
+            assert str(i) in restored
+
+
+class AgePartitionedBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for AgePartitionedBloomFilter
+    '''
+    def setUp(self):
+        self.time = SimulatedTime()
+        self.bf = AgePartitionedBloomFilter(capacity=100, window_period='3_Sec',
+                                            error_rate=0.01, clock=self.time)
+
+    def test_geometry(self):
+        assert self.bf.num_hashes == 9
+        assert self.bf.num_slices == 11
+        assert self.bf.window_period == 3
+
+    def test_add(self):
+        assert self.bf.add('random_uuid') == False
+        assert self.bf.add('random_uuid') == True
+        assert 'random_uuid' in self.bf
+        assert 'other_uuid' not in self.bf
+        assert len(self.bf) == 1
+
+    def test_repeat_adds_no_memory(self):
+        for i in range(100):
+            self.bf.add(str(i))
+        bits = self.bf.bitarray.count()
+        nbytes = self.bf.nbytes
+        for generation in range(3):
+            for i in range(100):
+                assert self.bf.add(str(i)) == True
+            assert self.bf.nbytes == nbytes
+        assert self.bf.bitarray.count() == bits
+        assert len(self.bf) == 100
+
+    def test_expiration(self):
+        self.bf.add('random_uuid')
+        self.time.now += 1.5
+        self.bf.add('other_uuid')
+        self.time.now += 1.0
+        self.bf.tick()
+        assert 'random_uuid' in self.bf
+        # The third generation since the key was added has ended
+        self.time.now += 0.5
+        self.bf.tick()
+        assert 'random_uuid' not in self.bf
+        assert 'other_uuid' in self.bf
+        self.time.now += 10
+        self.bf.tick()
+        assert 'other_uuid' not in self.bf
+        assert self.bf.bitarray.count() == 0
+
+    def test_lookup_expiration(self):
+        self.bf.add('random_uuid')
+        self.time.now += 10
+        # Only the clock moves, as its ticker thread does
+        self.bf.clock.tick()
+        assert 'random_uuid' not in self.bf
+
+    def test_refresh_extends_window(self):
+        self.bf.add('random_uuid')
+        for i in range(5):
+            self.time.now += 1.0
+            assert self.bf.add('random_uuid') == True
+
+    def test_error_rate(self):
+        for generation in range(3):
+            for i in range(100):
+                self.bf.add('%d-%d' % (generation, i))
+            self.time.now += 1.0
+        false_positives = sum(1 for i in range(10000) if 'missing-%d' % i in self.bf)
+        assert false_positives / 10000.0 <= self.bf.error_rate
+
+    def test_overflow_starts_generation(self):
+        for i in range(150):
+            self.bf.add(str(i))
+        assert list(self.bf.counts) == [100, 50]
+        assert '0' in self.bf
+
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,171 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import gc
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from pybloom import pybloom
+from pybloom.pybloom import BloomFilter, ScalableBloomFilter
+from pybloom.storage import BitarrayStorage
+from pybloom.npstorage import NumpyStorage, MmapStorage, SharedMemoryStorage
+
+
+class StorageTests(unittest.TestCase):
+    '''
+    Every backend behaves as the default bitarray one
+    '''
+    num_bits = 1001
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backends = [BitarrayStorage, NumpyStorage,
+                         MmapStorage.in_directory(self.tmpdir)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_backend(self, storage):
+        reference = BitarrayStorage(self.num_bits)
+        assert storage.count() == 0
+        for i in (0, 7, 8, 63, 64, 999, 1000):
+            storage.set(i)
+            reference.set(i)
+        storage.set_many([3, 500, 500])
+        reference.set_many([3, 500])
+        assert storage.count() == reference.count() == 9
+        assert storage.get(63) and not storage.get(62)
+        assert list(storage.get_many([0, 1, 500])) == [True, False, True]
+        assert storage.tobytes() == reference.tobytes()
+        assert storage == reference
+        storage.set(7, False)
+        assert not storage.get(7) and storage != reference
+
+        other = BitarrayStorage(self.num_bits)
+        other.set_many([1, 7, 500])
+        union = storage | other
+        assert union.count() == 10
+        assert (storage & other).count() == 1
+        assert storage.count_or(other) == 10 and storage.count_and(other) == 1
+        assert type(storage.copy()) in (type(storage), NumpyStorage)
+
+        copy = storage.copy()
+        storage.clear()
+        assert storage.count() == 0 and copy.count() == 8
+        storage.load(copy.tobytes())
+        assert storage == copy
+
+    def test_backends(self):
+        for factory in self.backends:
+            self.check_backend(factory(self.num_bits))
+
+    def test_bloom_filter(self):
+        keys = ['key-%d' % i for i in range(500)]
+        reference = BloomFilter(1000, 0.001)
+        for key in keys:
+            reference.add(key)
+        for factory in self.backends:
+            bloom = BloomFilter(1000, 0.001, storage=factory)
+            for key in keys:
+                bloom.add(key)
+            assert bloom.bitarray == reference.bitarray
+            assert all(key in bloom for key in keys)
+            assert list(bloom.contains_many(['key-1', 'missing'])) == \
+                list(reference.contains_many(['key-1', 'missing']))
+            assert (bloom | reference).bitarray == reference.bitarray
+            assert (bloom & reference).storage == reference.storage
+
+            f = io.BytesIO()
+            bloom.tofile(f)
+            assert f.getvalue() == _tofile(reference)
+            f.seek(0)
+            loaded = BloomFilter.fromfile(f, storage=factory)
+            assert loaded.bitarray == reference.bitarray
+
+    def test_pure_python(self):
+        core = pybloom._core
+        pybloom._core = None
+        try:
+            bloom = BloomFilter(1000, 0.001, storage=NumpyStorage)
+            bloom.add('a')
+            bloom.add('b')
+            assert 'a' in bloom and 'c' not in bloom
+            reference = BloomFilter(1000, 0.001)
+            reference.add('a')
+            reference.add('b')
+            assert bloom.storage == reference.storage
+        finally:
+            pybloom._core = core
+
+    def test_scalable(self):
+        sbf = ScalableBloomFilter(initial_capacity=100, error_rate=0.001,
+                                  storage=MmapStorage.in_directory(self.tmpdir))
+        for i in range(1000):
+            sbf.add(i)
+        assert len(sbf.filters) > 1
+        assert all(isinstance(f.storage, MmapStorage) for f in sbf.filters)
+        assert len(os.listdir(self.tmpdir)) == len(sbf.filters)
+        assert all(i in sbf for i in range(1000))
+
+    def test_read_only_bitarray(self):
+        bloom = BloomFilter(1000, 0.001, storage=NumpyStorage)
+        bloom.add('a')
+        bits = bloom.bitarray
+        assert bits.count() == bloom.num_slices
+        self.assertRaises(TypeError, bits.__setitem__, 0, True)
+
+    def test_mmap_temporary_files(self):
+        sbf = ScalableBloomFilter(initial_capacity=100,
+                                  storage=MmapStorage.in_directory(self.tmpdir))
+        for i in range(1000):
+            sbf.add(i)
+        assert os.listdir(self.tmpdir)
+        del sbf
+        gc.collect()
+        assert os.listdir(self.tmpdir) == []
+
+    def test_mmap_reopen(self):
+        path = os.path.join(self.tmpdir, 'bits')
+        storage = MmapStorage(self.num_bits, path)
+        storage.set_many([1, 2, 900])
+        storage.flush()
+        reopened = MmapStorage(self.num_bits, path)
+        assert reopened.count() == 3 and reopened.get(900)
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'requires shared_memory')
+    def test_shared_memory(self):
+        storage = SharedMemoryStorage(self.num_bits)
+        try:
+            self.check_backend(storage)
+            storage.set(42)
+            attached = SharedMemoryStorage(self.num_bits, storage.name)
+            assert attached.get(42)
+            attached.set(43)
+            assert storage.get(43)
+            attached.close()
+        finally:
+            storage.close()
+            storage.unlink()
+
+    def test_unpickle_bitarray_filter(self):
+        bloom = BloomFilter(100, 0.01)
+        bloom.add('a')
+        state = bloom.__getstate__()
+        state['bitarray'] = state.pop('storage').bits
+        del state['hash_cache']
+        restored = BloomFilter.__new__(BloomFilter)
+        restored.__setstate__(state)
+        assert 'a' in restored and restored.storage == bloom.storage
+
+
+def _tofile(bloom):
+    f = io.BytesIO()
+    bloom.tofile(f)
+    return f.getvalue()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import sys, os.path
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0] + '/../..')
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pybloom.pybloom import ScalableBloomFilter
+from pybloom.wal import DurableScalableBloomFilter
+
+
+class Time(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DurableScalableBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for DurableScalableBloomFilter
+    '''
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), 'sbf')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def log_path(self, sbf):
+        return sbf._log_path(sbf.generation)
+
+    def assert_same(self, recovered, sbf):
+        assert len(recovered) == len(sbf)
+        assert [f.capacity for f in recovered.filters] == [f.capacity for f in sbf.filters]
+        assert [f.storage.tobytes() for f in recovered.filters] == \
+            [f.storage.tobytes() for f in sbf.filters]
+
+    def test_recover(self):
+        sbf = DurableScalableBloomFilter(self.directory, initial_capacity=100,
+                                         error_rate=0.01, batch_size=64)
+        for i in range(2000):
+            sbf.add(i)
+        assert sbf.add(5)
+        sbf.close()
+        recovered = DurableScalableBloomFilter(self.directory, initial_capacity=5)
+        self.assert_same(recovered, sbf)
+        assert recovered.initial_capacity == 100 and recovered.error_rate == 0.01
+        assert all(i in recovered for i in range(2000))
+        # Inserts go on in the recovered filter, and are logged again
+        for i in range(2000, 3000):
+            recovered.add(i)
+        recovered.close()
+        again = DurableScalableBloomFilter(self.directory)
+        self.assert_same(again, recovered)
+        again.close()
+
+    def test_group_commit(self):
+        sbf = DurableScalableBloomFilter(self.directory, batch_size=100)
+        for i in range(250):
+            sbf.add(i)
+        # A crash loses the inserts not committed yet
+        recovered = DurableScalableBloomFilter(self.directory)
+        assert len(recovered) == 200
+        assert all(i in recovered for i in range(200))
+        recovered.close()
+        sbf.commit()
+        recovered = DurableScalableBloomFilter(self.directory)
+        assert len(recovered) == 250
+        recovered.close()
+        sbf.close()
+
+    def test_duplicates_not_logged(self):
+        sbf = DurableScalableBloomFilter(self.directory, batch_size=1)
+        for i in range(100):
+            sbf.add(i)
+        size = os.path.getsize(self.log_path(sbf))
+        for i in range(100):
+            sbf.add(i)
+        assert os.path.getsize(self.log_path(sbf)) == size
+        sbf.close()
+
+    def test_torn_batch(self):
+        sbf = DurableScalableBloomFilter(self.directory, batch_size=10)
+        for i in range(100):
+            sbf.add(i)
+        sbf.close()
+        with open(self.log_path(sbf), 'ab') as f:
+            f.write(b'\x40\x00\x00\x00\x00')
+        recovered = DurableScalableBloomFilter(self.directory, batch_size=10)
+        self.assert_same(recovered, sbf)
+        # The torn batch is dropped, so that new batches are replayed
+        for i in range(100, 200):
+            recovered.add(i)
+        recovered.close()
+        again = DurableScalableBloomFilter(self.directory)
+        assert len(again) == 200
+        again.close()
+
+    def test_corrupt_batch(self):
+        sbf = DurableScalableBloomFilter(self.directory, batch_size=10)
+        for i in range(100):
+            sbf.add(i)
+        sbf.close()
+        with open(self.log_path(sbf), 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\x00' if last != b'\x00' else b'\x01')
+        recovered = DurableScalableBloomFilter(self.directory)
+        assert len(recovered) == 90
+        recovered.close()
+
+    def test_checkpoint(self):
+        sbf = DurableScalableBloomFilter(self.directory, initial_capacity=100,
+                                         batch_size=50, checkpoint_interval=500)
+        for i in range(1200):
+            sbf.add(i)
+        assert sbf.generation == 3
+        assert sorted(os.listdir(self.directory)) == ['log.3', 'snapshot']
+        # The first 1000 inserts are in the snapshot
+        assert sbf._logged == 200
+        assert os.path.getsize(self.log_path(sbf)) < 200 * 40
+        sbf.close()
+        recovered = DurableScalableBloomFilter(self.directory)
+        self.assert_same(recovered, sbf)
+        assert recovered.generation == 3
+        recovered.checkpoint()
+        assert sorted(os.listdir(self.directory)) == ['log.4', 'snapshot']
+        recovered.close()
+        with open(os.path.join(self.directory, 'snapshot'), 'rb') as f:
+            f.read(8)
+            plain = ScalableBloomFilter.fromfile(f)
+        assert all(i in plain for i in range(1200))
+
+    def test_stale_log(self):
+        sbf = DurableScalableBloomFilter(self.directory, batch_size=1)
+        for i in range(10):
+            sbf.add(i)
+        with open(self.log_path(sbf), 'rb') as f:
+            log = f.read()
+        sbf.checkpoint()
+        sbf.close()
+        # A crash after the snapshot was renamed, before the previous log
+        # was removed: its inserts are already in the snapshot
+        with open(os.path.join(self.directory, 'log.1'), 'wb') as f:
+            f.write(log)
+        recovered = DurableScalableBloomFilter(self.directory)
+        assert len(recovered) == 10
+        assert sorted(os.listdir(self.directory)) == ['log.2', 'snapshot']
+        recovered.close()
+
+    def test_adaptive(self):
+        time = Time()
+        sbf = DurableScalableBloomFilter(self.directory, initial_capacity=100,
+                                         adaptive=True, clock=time)
+        for i in range(3000):
+            sbf.add(i)
+            time.now += 0.01
+        sbf.close()
+        recovered = DurableScalableBloomFilter(self.directory, adaptive=True, clock=time)
+        self.assert_same(recovered, sbf)
+        recovered.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
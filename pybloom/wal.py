@@ -0,0 +1,275 @@
+'''
+Crash-safe ScalableBloomFilter: a write-ahead log of the hashes of the
+inserted keys, group-committed in batches and compacted by snapshots
+
+The filter lives in a directory holding:
+
+    snapshot     <Q generation, then the filter as written by tofile()
+    log.<gen>    the inserts made since the snapshot of that generation
+
+The log is a sequence of batches, each a <II header (payload length,
+CRC-32 of the payload) followed by records:
+
+    level   <BQd  LEVEL, capacity, error rate: a filter was added
+    key     <BH   KEY, level, then the hash of the key in each slice
+
+Recovery loads the snapshot and replays the log up to its first torn or
+corrupt batch, setting the bits of the logged hashes: the keys
+themselves are never needed.
+
+>>> import tempfile
+>>> directory = tempfile.mkdtemp()
+>>> sbf = DurableScalableBloomFilter(directory, initial_capacity=100)
+>>> for i in range(1000):
+...     _ = sbf.add(i)
+>>> sbf.close()
+>>> recovered = DurableScalableBloomFilter(directory)
+>>> len(recovered), 999 in recovered, 1000 in recovered
+(1000, True, False)
+>>> recovered.close()
+'''
+import os
+import zlib
+from struct import Struct, pack, unpack, unpack_from, calcsize
+
+from .pybloom import ScalableBloomFilter
+
+LEVEL = 1
+KEY = 2
+
+BATCH_FMT = '<II'
+LEVEL_FMT = '<BQd'
+KEY_FMT = '<BH'
+BATCH_SIZE = calcsize(BATCH_FMT)
+LEVEL_SIZE = calcsize(LEVEL_FMT)
+GENERATION_FMT = '<Q'
+
+SNAPSHOT = 'snapshot'
+LOG_PREFIX = 'log.'
+
+_replace = getattr(os, 'replace', os.rename)
+_key_structs = {}
+
+
+def _key_struct(filter):
+    '''
+    Struct of the key records of `filter', with the smallest integer
+    type holding its hashes
+    '''
+    geometry = (filter.num_slices, filter.bits_per_slice)
+    struct = _key_structs.get(geometry)
+    if struct is None:
+        if filter.bits_per_slice <= 1 << 16:
+            code = 'H'
+        elif filter.bits_per_slice <= 1 << 32:
+            code = 'I'
+        else:
+            code = 'Q'
+        struct = _key_structs[geometry] = Struct(KEY_FMT + code * filter.num_slices)
+    return struct
+
+
+def _fsync_directory(directory):
+    '''
+    Make the renames and new files of `directory' durable, where the
+    platform allows it
+    '''
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class DurableScalableBloomFilter(ScalableBloomFilter):
+    '''
+    ScalableBloomFilter kept in `directory', recovered from it when it
+    holds a snapshot: the parameters of the snapshot then win over those
+    given.
+
+    batch_size
+        inserts logged by one write. Inserts are durable once committed:
+        a crash loses at most the last batch_size - 1 inserts, none
+        after commit() or close().
+    sync
+        fsync the log on each commit, and snapshots when written
+    checkpoint_interval
+        inserts logged before a new snapshot replaces the log, or None to
+        only snapshot on checkpoint()
+
+    Duplicate keys are not logged, and the log only grows by a few bytes
+    per slice of each new key, so that an insert costs little more than
+    in memory.
+    '''
+    def __init__(self, directory, initial_capacity=100, error_rate=0.001,
+                 mode=ScalableBloomFilter.SMALL_SET_GROWTH, hash_cache=None,
+                 storage=None, adaptive=False, clock=None, batch_size=1024,
+                 sync=True, checkpoint_interval=None):
+        super(DurableScalableBloomFilter, self).__init__(
+            initial_capacity, error_rate, mode, hash_cache=hash_cache,
+            storage=storage, adaptive=adaptive, clock=clock)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.sync = sync
+        self.checkpoint_interval = checkpoint_interval
+        self.generation = 0
+        self._batch = []
+        # Inserts in the batch, and logged since the snapshot
+        self._batch_inserts = 0
+        self._logged = 0
+        self._log = None
+        self._struct = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self._path(SNAPSHOT)):
+            self._recover()
+        else:
+            self.checkpoint()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _log_path(self, generation):
+        return self._path(LOG_PREFIX + str(generation))
+
+    def _insert(self, filter, hashes):
+        filter._insert(hashes)
+        self._batch.append(self._struct.pack(KEY, len(self.filters) - 1, *hashes))
+        self._batch_inserts += 1
+        if self._batch_inserts >= self.batch_size:
+            self.commit()
+
+    def _add_filter(self, capacity, error_rate):
+        filter = super(DurableScalableBloomFilter, self)._add_filter(capacity, error_rate)
+        self._batch.append(pack(LEVEL_FMT, LEVEL, capacity, error_rate))
+        self._struct = _key_struct(filter)
+        return filter
+
+    def commit(self):
+        '''
+        Append the pending inserts to the log as one batch
+        '''
+        if not self._batch:
+            return
+        payload = b''.join(self._batch)
+        self._logged += self._batch_inserts
+        self._batch = []
+        self._batch_inserts = 0
+        self._log.write(pack(BATCH_FMT, len(payload), zlib.crc32(payload) & 0xffffffff))
+        self._log.write(payload)
+        self._log.flush()
+        if self.sync:
+            os.fsync(self._log.fileno())
+        if self.checkpoint_interval and self._logged >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''
+        Write a snapshot of the filter, pending inserts included, and
+        start a new, empty log
+        '''
+        generation = self.generation + 1
+        path = self._path(SNAPSHOT)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(pack(GENERATION_FMT, generation))
+            self.tofile(f)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        # Until the rename, recovery uses the previous snapshot and log
+        _replace(path + '.tmp', path)
+        log = open(self._log_path(generation), 'ab')
+        if self.sync:
+            _fsync_directory(self.directory)
+        self._close_log()
+        if os.path.exists(self._log_path(self.generation)):
+            os.remove(self._log_path(self.generation))
+        self.generation = generation
+        self._log = log
+        self._batch = []
+        self._batch_inserts = 0
+        self._logged = 0
+
+    def _recover(self):
+        with open(self._path(SNAPSHOT), 'rb') as f:
+            self.generation, = unpack(GENERATION_FMT, f.read(calcsize(GENERATION_FMT)))
+            snapshot = ScalableBloomFilter.fromfile(f, self.storage)
+        self._setup(snapshot.scale, snapshot.ratio, snapshot.initial_capacity,
+                    snapshot.error_rate)
+        self.filters = snapshot.filters
+        for name in os.listdir(self.directory):
+            if name.startswith(LOG_PREFIX) and name != LOG_PREFIX + str(self.generation):
+                os.remove(self._path(name))
+        path = self._log_path(self.generation)
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                self._logged = self._replay(f)
+                # Drop the torn batch a crash may have left behind
+                f.truncate(f.tell())
+        if self.filters:
+            self._struct = _key_struct(self.filters[-1])
+        self._log = open(path, 'ab')
+
+    def _replay(self, f):
+        '''
+        Apply the valid batches of the log `f', leaving it positioned
+        after the last one. Returns the number of inserts replayed.
+        '''
+        inserts = 0
+        while True:
+            start = f.tell()
+            header = f.read(BATCH_SIZE)
+            if len(header) < BATCH_SIZE:
+                break
+            length, crc = unpack(BATCH_FMT, header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            inserts += self._apply(payload)
+        f.seek(start)
+        return inserts
+
+    def _apply(self, payload):
+        inserts = 0
+        offset = 0
+        while offset < len(payload):
+            kind, = unpack_from('<B', payload, offset)
+            if kind == LEVEL:
+                _, capacity, error_rate = unpack_from(LEVEL_FMT, payload, offset)
+                offset += LEVEL_SIZE
+                # Not logged again
+                ScalableBloomFilter._add_filter(self, capacity, error_rate)
+            elif kind == KEY:
+                _, level = unpack_from(KEY_FMT, payload, offset)
+                filter = self.filters[level]
+                struct = _key_struct(filter)
+                filter._insert(list(struct.unpack_from(payload, offset)[2:]))
+                offset += struct.size
+                inserts += 1
+            else:
+                raise ValueError("Unknown log record %d" % kind)
+        return inserts
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def close(self):
+        '''
+        Commit the pending inserts and close the log
+        '''
+        if self._log is not None:
+            self.commit()
+            self._close_log()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,12 +1,15 @@
 #!/usr/bin/env python
-from ez_setup import use_setuptools
-use_setuptools()
+try:
+    from ez_setup import use_setuptools
+    use_setuptools()
+except SyntaxError:
+    # ez_setup is Python 2 only, Python 3 always has setuptools
+    pass
 
 import os
 
 from setuptools import setup, find_packages, Extension
 from distutils.command import build_ext
-import numpy
 
 VERSION = '2.0.0'
 DESCRIPTION = "PyBloom: A Probabilistic data structure"
@@ -16,16 +19,19 @@ structure. The module also provides a Scalable Bloom Filter that allows a
 bloom filter to grow without knowing the original set size.
 """
 
-CLASSIFIERS = filter(None, map(str.strip,
+CLASSIFIERS = list(filter(None, map(str.strip,
 """
 Intended Audience :: Developers
 License :: OSI Approved :: MIT License
 Programming Language :: Python
+Programming Language :: Python :: 2
+Programming Language :: Python :: 2.7
+Programming Language :: Python :: 3
 Operating System :: OS Independent
 Topic :: Utilities
 Topic :: Database :: Database Engines/Servers
 Topic :: Software Development :: Libraries :: Python Modules
-""".splitlines()))
+""".splitlines())))
 
 setup(
     name="pybloom",
@@ -43,6 +49,9 @@ setup(
     platforms=['any'],
     test_suite="pybloom.tests",
     zip_safe=False,
-    install_requires=['numpy','bitarray>=0.3.4'],
-    ext_modules = [Extension("maintenance", ["pybloom/maintenance.c"], include_dirs=[numpy.get_include()])],
+    install_requires=['numpy','bitarray>=1.1.0'],
+    # Both extensions are optional: pure Python and NumPy fallbacks are
+    # used when they are not built
+    ext_modules = [Extension("pybloom.maintenance", ["pybloom/maintenance.c"], optional=True),
+                   Extension("pybloom._core", ["pybloom/_core.c"], optional=True)],
 )